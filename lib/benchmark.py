@@ -0,0 +1,516 @@
+# This file contains the benchmarks for the database layer and flow generation.
+# Run it with: $ python lib/benchmark.py
+# Every benchmark works on a throwaway database in a temporary directory, so yoga.db is never touched.
+#
+# $ python lib/benchmark.py models --poses 100000 --flows 1000 --output results.json
+# $ python lib/benchmark.py models --poses 100000 --flows 1000 --baseline results.json
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from db import batch, cache, composer, connection, history, models, profiler, seed, snapshot, transitions
+from db.lookup import CHAKRA_IDS
+from db.models import Flow, FlowCatalog, FlowPose, Pose
+from db.plan import build_plan
+from db.player import SessionPlayer, null_sink
+
+def synthesize(path, poses, flows, rng_seed=0):
+    """Create a database with the given number of random poses and flows."""
+    connection.configure(db_file=path)
+    seed.seed_database(poses, flows, poses_per_flow=0, seed=rng_seed, builtin=False)
+    cache.configure(enabled=True)
+
+
+def ops_per_second(func, seconds=1.0):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        func()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def median_ms(func, seconds=0.5, min_runs=3):
+    # Runs func for about `seconds` (at least min_runs times) and returns the median call time
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < min_runs or time.perf_counter() - start < seconds:
+        call_start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - call_start)
+    return statistics.median(timings) * 1000
+
+
+def bench_connections(path, args):
+    # The old models opened a new connection for every call
+    def find_flow_per_call_connection():
+        with sqlite3.connect(path) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM flows WHERE id = ?", (1,))
+            return cursor.fetchone()
+
+    def create_flows_per_call_connection():
+        for _ in range(50):
+            with sqlite3.connect(path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("INSERT INTO flows (chakra_id, duration, difficulty_id) VALUES (?,?,?)", (1, 30, 1))
+                conn.commit()
+
+    def create_flows_one_transaction():
+        with connection.transaction():
+            for _ in range(50):
+                Flow.create("Root", 30, "Easy")
+
+    cache.configure(enabled=False)
+    return [
+        ("find_by_id, new connection per call", ops_per_second(find_flow_per_call_connection), "ops/sec"),
+        ("find_by_id, pooled connection", ops_per_second(lambda: Flow.find_by_id(1)), "ops/sec"),
+        ("50 creates, commit per row", ops_per_second(create_flows_per_call_connection), "ops/sec"),
+        ("50 creates, single transaction", ops_per_second(create_flows_one_transaction), "ops/sec"),
+    ]
+
+
+def bench_models(path, args):
+    cache.configure(enabled=False)
+    flow_ids = [row[0] for row in Flow.get_all()]
+    rng = random.Random(0)
+
+    start = time.perf_counter()
+    seed.insert_flow_poses(seed=0)
+    insert_flow_poses_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    seed.build_flow_catalog()
+    build_catalog_ms = (time.perf_counter() - start) * 1000
+
+    results = [
+        ("seed.insert_flow_poses", insert_flow_poses_ms, "ms"),
+        ("seed.build_flow_catalog", build_catalog_ms, "ms"),
+        ("FlowCatalog.get_page", median_ms(lambda: FlowCatalog.get_page(0, 20, chakra="Heart")), "ms"),
+        ("Pose.get_all", median_ms(Pose.get_all), "ms"),
+        ("Pose.filter_by_chakra", median_ms(lambda: Pose.filter_by_chakra("Heart")), "ms"),
+        ("Flow.get_all", median_ms(Flow.get_all), "ms"),
+        ("Flow.find_by_id", median_ms(lambda: Flow.find_by_id(rng.choice(flow_ids))), "ms"),
+        ("Flow.filter_by_chakra", median_ms(lambda: Flow.filter_by_chakra("Heart")), "ms"),
+        ("Flow.filter_by_duration", median_ms(lambda: Flow.filter_by_duration(30)), "ms"),
+        ("Flow.filter_by_difficulty", median_ms(lambda: Flow.filter_by_difficulty("Easy")), "ms"),
+        ("FlowPose.get_poses_for_flow", median_ms(lambda: FlowPose.get_poses_for_flow(rng.choice(flow_ids))), "ms"),
+        ("FlowPose.get_flows_for_pose", median_ms(lambda: FlowPose.get_flows_for_pose(rng.randint(1, args.poses))), "ms"),
+        ("FlowPose.get_poses_for_flows (20)", median_ms(lambda: FlowPose.get_poses_for_flows(rng.sample(flow_ids, min(20, len(flow_ids))))), "ms"),
+    ]
+
+    cache.configure(enabled=True)
+    results.append(("Flow.find_by_id (cached)", median_ms(lambda: Flow.find_by_id(flow_ids[0])), "ms"))
+    return results
+
+
+def bench_plans(path, args):
+    cache.configure(enabled=False)
+    poses = Pose.filter_by_chakra("Heart")
+    seeds = iter(range(10 ** 9))
+
+    # Timers are stubbed out so only the generation work is measured
+    real_sleep = models.time.sleep
+    models.time.sleep = lambda seconds: None
+    try:
+        with redirect_stdout(io.StringIO()):
+            generate_ms = median_ms(lambda: Flow.generate_flow_with_timers("Heart", 30, seed=next(seeds)))
+    finally:
+        models.time.sleep = real_sleep
+
+    results = [
+        ("Flow.plan (query + build)", ops_per_second(lambda: Flow.plan("Heart", 30, "Easy", seed=next(seeds))), "plans/sec"),
+        ("build_plan (poses already loaded)", ops_per_second(lambda: build_plan(poses, "Heart", 30, "Easy", seed=next(seeds))), "plans/sec"),
+        ("generate_flow_with_timers (no sleep)", generate_ms, "ms"),
+        ("Flow.plan_for_flow (flow catalog)", ops_per_second(lambda: Flow.plan_for_flow(1, seed=next(seeds))), "plans/sec"),
+    ]
+    cache.configure(enabled=True)
+    results.append(("Flow.plan (cached poses)", ops_per_second(lambda: Flow.plan("Heart", 30, "Easy", seed=next(seeds))), "plans/sec"))
+    return results
+
+
+def allocated_bytes(func):
+    # Memory still allocated by the result of func, measured with tracemalloc
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_snapshot(path, args):
+    cache.configure(enabled=False)
+    rows_bytes = allocated_bytes(Pose.get_all)
+    index_bytes = allocated_bytes(snapshot.PoseIndex.load)
+    index = snapshot.PoseIndex.load()
+    seeds = iter(range(10 ** 9))
+
+    results = [
+        ("Pose.get_all rows", rows_bytes / args.poses, "bytes/pose"),
+        ("PoseIndex", index_bytes / args.poses, "bytes/pose"),
+        ("PoseIndex.footprint", index.footprint() / args.poses, "bytes/pose"),
+        ("PoseIndex.load", median_ms(snapshot.PoseIndex.load), "ms"),
+        ("Flow.plan (rows)", ops_per_second(lambda: Flow.plan("Heart", 30, "Easy", seed=next(seeds))), "plans/sec"),
+        ("PoseIndex.plan", ops_per_second(lambda: index.plan("Heart", 30, "Easy", seed=next(seeds))), "plans/sec"),
+    ]
+    snapshot.configure(enabled=True)
+    try:
+        results.append(("Flow.plan_for_flow (snapshot)",
+                        ops_per_second(lambda: Flow.plan_for_flow(1, seed=next(seeds))), "plans/sec"))
+    finally:
+        snapshot.configure(enabled=False)
+    return results
+
+
+def bench_composer(path, args):
+    # Exact-length plans: the first plan for a (chakra, difficulty, duration) solves the knapsack, later ones reuse it
+    poses = Pose.filter_by_chakra("Heart")
+    seeds = iter(range(10 ** 9))
+
+    def solve(duration):
+        composer.clear()
+        composer.compose(poses, "Heart", duration, "Intermediate", seed=next(seeds))
+
+    results = []
+    for duration in (60, 3600):
+        results.append((f"compose {duration}s (solve)", median_ms(lambda: solve(duration)), "ms"))
+        results.append((f"compose {duration}s (memoised)",
+                        median_ms(lambda: composer.compose(poses, "Heart", duration, "Intermediate", seed=next(seeds))),
+                        "ms"))
+    results.append(("Flow.compose_for_flow", ops_per_second(lambda: Flow.compose_for_flow(1, seed=next(seeds))),
+                    "plans/sec"))
+    return results
+
+
+def bench_transitions(path, args):
+    # Full graph build vs keeping it up to date for a single pose, and sequencing a 60 minute flow (900 poses)
+    seeds = iter(range(10 ** 9))
+
+    def rolled_back(func):
+        def run():
+            with connection.connection() as conn:
+                conn.execute("BEGIN")
+                try:
+                    func(conn.cursor())
+                finally:
+                    conn.execute("ROLLBACK")
+        return run
+
+    pose_id = Pose.filter_by_chakra("Heart")[0]['id']
+    results = [
+        ("build", median_ms(rolled_back(transitions.build)), "ms"),
+        ("add_pose", median_ms(rolled_back(lambda cursor: transitions.add_pose(cursor, pose_id))), "ms"),
+        ("remove_pose", median_ms(rolled_back(lambda cursor: transitions.remove_pose(cursor, pose_id, CHAKRA_IDS["Heart"]))), "ms"),
+        ("load graph", median_ms(lambda: transitions.TransitionGraph.load("Heart")), "ms"),
+    ]
+    graph = transitions.get_graph("Heart")
+    results.append(("walk 900 poses", median_ms(lambda: graph.walk(900, next(seeds))), "ms"))
+    results.append(("Flow.walk_for_flow", ops_per_second(lambda: Flow.walk_for_flow(1, seed=next(seeds))), "plans/sec"))
+    return results
+
+
+def bench_batch(path, args, jobs=20000):
+    # Plans per second at 1, 2, 4 and 8 worker processes. Scaling is limited by the number of CPUs (see meta).
+    rng = random.Random(0)
+    flow_ids = [row[0] for row in Flow.get_all()]
+    job_list = [{'user_id': user_id, 'flow_id': rng.choice(flow_ids), 'seed': user_id} for user_id in range(jobs)]
+    output = os.path.join(os.path.dirname(path), 'plans.jsonl')
+
+    results = []
+    single = None
+    for workers in (1, 2, 4, 8):
+        count, seconds = batch.generate_plans(iter(job_list), output, workers)
+        rate = count / seconds
+        single = single or rate
+        results.append((f"{workers} worker(s)", rate, "plans/sec"))
+        results.append((f"{workers} worker(s) speedup", rate / single, "x"))
+    return results
+
+
+def bench_history(path, args, count=2000):
+    # Recording finished sessions one commit per session versus in batches
+    plans = [Flow.plan("Heart", 30, "Easy", seed=i) for i in range(count)]
+
+    def record(batch_size):
+        writer = history.HistoryWriter(batch_size=batch_size)
+        start = time.perf_counter()
+        for user_id, plan in enumerate(plans):
+            record = writer.start(plan, user_id=str(user_id % 100))
+            for segment in plan.segments:
+                if segment.kind == 'pose':
+                    record.pose_completed(segment)
+            record.finish()
+        writer.close()
+        return count / (time.perf_counter() - start)
+
+    results = [
+        ("record session, commit per session", record(1), "sessions/sec"),
+        ("record session, batches of 50", record(50), "sessions/sec"),
+    ]
+    cache.configure(enabled=False)
+    return results + [
+        ("History.recent_sessions", median_ms(lambda: models.History.recent_sessions("7", 10)), "ms"),
+        ("History.most_used_poses", median_ms(lambda: models.History.most_used_poses(10)), "ms"),
+    ]
+
+
+def ns_per_call(func, calls=200000, repeat=3):
+    # Best of a few runs, so warm-up and noise don't hide a difference of a few percent
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        timings.append((time.perf_counter() - start) / calls * 1e9)
+    return min(timings)
+
+
+def bench_profiler(path, args):
+    # Cost of the instrumentation on a cached Flow.find_by_id (the cheapest model call, so overhead shows most)
+    cache.configure(enabled=True)
+    profiler.configure(enabled=True)
+    uninstrumented = Flow.find_by_id.__func__.__wrapped__
+    profiler.configure(enabled=False)
+    Flow.find_by_id(1)
+    raw_ns = ns_per_call(lambda: uninstrumented(Flow, 1))
+    disabled_ns = ns_per_call(lambda: Flow.find_by_id(1))
+    profiler.configure(enabled=True)
+    enabled_ns = ns_per_call(lambda: Flow.find_by_id(1))
+
+    # Uncached calls also go through the profiling cursor when it is on
+    cache.configure(enabled=False)
+    queries_enabled_ns = ns_per_call(lambda: Flow.find_by_id(1), 20000)
+    profiler.configure(enabled=False)
+    queries_disabled_ns = ns_per_call(lambda: Flow.find_by_id(1), 20000)
+    profiler.reset()
+
+    return [
+        ("cached call, not instrumented", raw_ns, "ns"),
+        ("cached call, profiler off", disabled_ns, "ns"),
+        ("cached call, profiler on", enabled_ns, "ns"),
+        ("profiler off overhead", (disabled_ns - raw_ns) / raw_ns * 100, "%"),
+        ("query, profiler off", queries_disabled_ns, "ns"),
+        ("query, profiler on", queries_enabled_ns, "ns"),
+    ]
+
+
+def bench_seed(path, args):
+    # A full seed (built-in and synthetic rows, 5 poses per flow) into a separate database
+    steps = []
+    connection.configure(db_file=os.path.join(os.path.dirname(path), 'seeded.db'))
+    start = time.perf_counter()
+    rows = seed.seed_database(args.poses, args.flows, seed=0, report=lambda *step: steps.append(step))
+    seconds = time.perf_counter() - start
+    connection.configure(db_file=path)
+
+    results = []
+    for step, step_rows, step_seconds in steps:
+        results.append((step, step_seconds * 1000, "ms"))
+        if step_rows and step_seconds:
+            results.append((f"{step} rows", step_rows / step_seconds, "rows/sec"))
+    results.append(("seed_database", seconds * 1000, "ms"))
+    results.append(("seed_database rows", rows / seconds, "rows/sec"))
+    return results
+
+
+def bench_sessions(path, args, count=5000, tick_seconds=0.1):
+    # Stress test: thousands of concurrent sessions on one event loop (one core).
+    # Ticks are shortened to tick_seconds so the run finishes quickly.
+    plans = [Flow.plan("Heart", 20, "Easy", seed=i) for i in range(count)]
+
+    async def run():
+        player = SessionPlayer()
+        sessions = [player.start(plan, null_sink, tick_seconds) for plan in plans]
+        await player.wait()
+        return sessions
+
+    start = time.perf_counter()
+    sessions = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+
+    ticks = sum(plan.total_seconds for plan in plans)
+    return [
+        ("sessions", count, "sessions"),
+        ("expected duration", max(plan.total_seconds for plan in plans) * tick_seconds, "s"),
+        ("wall time", elapsed, "s"),
+        ("ticks", ticks / elapsed, "ticks/sec"),
+        ("worst tick lag", max(s.max_lag for s in sessions) * 1000, "ms"),
+    ]
+
+
+def bench_server(path, args, seconds=3.0, connections=20):
+    # The HTTP service in its own process, loaded by lib/loadtest.py. Cached GETs are answered on the event loop,
+    # unseeded plans go through the worker threads every time.
+    import loadtest
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    server = subprocess.Popen([sys.executable, cli, 'serve', '--port', '0'], env=dict(os.environ, PY_FLOWS_DB=path),
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        url = server.stdout.readline().split()[4]  # "Serving Py Flows on http://127.0.0.1:PORT with ..."
+        results = []
+        for name, paths, revalidate in (("cached reads", loadtest.DEFAULT_PATHS, False),
+                                        ("cached reads, If-None-Match", loadtest.DEFAULT_PATHS, True),
+                                        ("unseeded plans", ('/flows/1/plan', '/flows/2/plan'), False)):
+            stats = asyncio.run(loadtest.run(url, paths, connections, seconds, revalidate))
+            results.append((name, stats['requests_per_sec'], "req/sec"))
+            results.append((f"{name} p99", stats['p99_ms'], "ms"))
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def bench_startup(path, args, runs=10):
+    # Time a one-shot command in a fresh interpreter, compared with an interpreter that does nothing
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    env = dict(os.environ, PY_FLOWS_DB=path)
+
+    def run(command):
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings) * 1000
+
+    empty_ms = run([sys.executable, '-c', 'pass'])
+    command_ms = run([sys.executable, cli, 'flows', 'show', '1'])
+
+    # -X importtime writes "import time: self | cumulative | module" lines to stderr
+    output = subprocess.run([sys.executable, '-X', 'importtime', cli, 'flows', 'show', '1'], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True).stderr
+    imports = []
+    for line in output.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[0].split(':')[-1].strip().isdigit():
+            imports.append((int(parts[0].split(':')[-1]), parts[2].strip()))
+    imports_ms = sum(self_us for self_us, _ in imports) / 1000
+
+    if command_ms - empty_ms > args.startup_budget:
+        print(f"Startup is over budget: {command_ms - empty_ms:.1f} ms > {args.startup_budget:.1f} ms")
+        args.failed = True
+
+    results = [
+        ("python -c pass", empty_ms, "ms"),
+        ("cli.py flows show 1", command_ms, "ms"),
+        ("startup overhead", command_ms - empty_ms, "ms"),
+        ("total import time", imports_ms, "ms"),
+    ]
+    for self_us, module in sorted(imports, reverse=True)[:5]:
+        results.append((f"import {module}", self_us / 1000, "ms"))
+    return results
+
+
+BENCHMARKS = {
+    'connections': bench_connections,
+    'models': bench_models,
+    'plans': bench_plans,
+    'snapshot': bench_snapshot,
+    'composer': bench_composer,
+    'transitions': bench_transitions,
+    'batch': bench_batch,
+    'history': bench_history,
+    'profiler': bench_profiler,
+    'seed': bench_seed,
+    'sessions': bench_sessions,
+    'server': bench_server,
+    'startup': bench_startup,
+}
+
+
+def higher_is_better(unit):
+    return unit.endswith('/sec')
+
+
+def compare(results, baseline, threshold):
+    """Print the change against a baseline file and return the number of regressions."""
+    regressions = 0
+    print(f"\nComparison with baseline (threshold {threshold:.0%})\n" + '-' * 40)
+    for name, metrics in results.items():
+        for metric, result in metrics.items():
+            before = baseline.get(name, {}).get(metric)
+            if not before or result['unit'] in ('s', 'sessions', 'x', '%') or not before['value']:
+                continue
+            change = result['value'] / before['value'] - 1
+            worse = -change if higher_is_better(result['unit']) else change
+            flag = ""
+            if worse > threshold:
+                flag = "REGRESSION"
+                regressions += 1
+            print(f"{name + ': ' + metric:60} {change:+8.1%} {flag}")
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Py Flows benchmarks")
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--poses', type=int, default=1000, help="number of synthetic poses")
+    parser.add_argument('--flows', type=int, default=100, help="number of synthetic flows")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="compare against a JSON file written by --output")
+    parser.add_argument('--threshold', type=float, default=0.2, help="relative slowdown reported as a regression")
+    parser.add_argument('--startup-budget', type=float, default=60.0,
+                        help="allowed startup time of a one-shot command on top of a bare interpreter, in ms")
+    args = parser.parse_args(argv)
+    args.failed = False
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.names or BENCHMARKS:
+            path = os.path.join(tmp, f"{name}.db")
+            synthesize(path, args.poses, args.flows)
+            print(f"\n{name}\n" + '-' * 40)
+            results[name] = {}
+            for metric, value, unit in BENCHMARKS[name](path, args):
+                print(f"{metric:40} {value:14.3f} {unit}")
+                results[name][metric] = {'value': value, 'unit': unit}
+            connection.close_all()
+            cache.configure(enabled=True)
+
+    report = {
+        'meta': {
+            'poses': args.poses,
+            'flows': args.flows,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 1 if args.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
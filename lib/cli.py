@@ -1,13 +1,29 @@
 # This file contains the main entry point (main menu) for the CLI application. It defines the command-line interface, including commands, options, arguments, and their corresponding actions or functions.
+import sys
 import time
-from colorama import init, Fore, Style
-init()
 
-from db.models import Flow, Pose
+from db.models import Flow, FlowCatalog, Pose, PAGE_SIZE
 
-DB_FILE = 'yoga.db'
+class NoColor:
+    # Stands in for colorama's Fore and Style when the output is not a terminal
+    def __getattr__(self, name):
+        return ''
+
+Fore = Style = NoColor()
+colors_ready = False
+
+def init_colors():
+    # colorama is only imported (and initialised once) when we are actually writing to a terminal
+    global Fore, Style, colors_ready
+    if colors_ready:
+        return
+    colors_ready = True
+    if sys.stdout.isatty():
+        from colorama import init, Fore, Style
+        init()
 
 def main():
+    init_colors()
 
     while True:
         print(
@@ -55,7 +71,8 @@ def search_flows():
         print("2. Filter templates by chakra")
         print("3. Filter templates by duration")
         print("4. Filter templates by difficulty")
-        print("5. Back to Main Menu\n")
+        print("5. Search templates with several filters")
+        print("6. Back to Main Menu\n")
         
     
         search_choice = input("Enter your choice: ")
@@ -69,11 +86,13 @@ def search_flows():
         elif search_choice == '4':
             filter_by_difficulty()
         elif search_choice == '5':
+            search_by_criteria()
+        elif search_choice == '6':
             break
         else:
             print("Invalid choice. Please try again.")
 
-        if search_choice in ['1', '2', '3', '4']:
+        if search_choice in ['1', '2', '3', '4', '5']:
             flow_id = input("Enter the ID of the flow template you want to generate: ")
             generate_flow(flow_id)
 
@@ -90,7 +109,14 @@ def generate_flow(flow_id):
 
     ''' + Style.RESET_ALL)  
         time.sleep(2)
-        Flow.generate_flow_with_timers(flow['chakra'], flow['duration'])
+        try:
+            plan = Flow.compose_for_flow(flow['id'])
+        except ValueError as error:
+            print(f"This flow can't be generated: {error}")
+            return
+        from db.history import HistoryWriter
+        with HistoryWriter() as writer:
+            Flow.play(plan, writer, flow_id=flow['id'])
     else:
         print("Flow not found.")
 
@@ -124,7 +150,8 @@ def manage_poses():
         print("2. Create a new pose")
         print("3. Update a pose by ID")
         print("4. Delete a pose by ID")
-        print("5. Back to Main Menu\n")
+        print("5. Search poses by name")
+        print("6. Back to Main Menu\n")
 
         pose_choice = input("Enter your choice: ")
 
@@ -137,19 +164,35 @@ def manage_poses():
         elif pose_choice == '4':
             delete_yoga_pose_by_id()
         elif pose_choice == '5':
+            search_yoga_poses()
+        elif pose_choice == '6':
             break
         else:
             print("Invalid choice. Please try again.")
 
+def read_pose_id(prompt):
+    # Returns None (after saying why) if the answer is not a number
+    answer = input(prompt).strip()
+    if not answer.isdigit():
+        print("The pose ID must be a whole number.")
+        return None
+    return int(answer)
+
 def update_yoga_pose_by_id():
-    pose_id = input("Enter the ID of the pose you want to update: ")
+    pose_id = read_pose_id("Enter the ID of the pose you want to update: ")
+    if pose_id is None:
+        return
     name = input("Enter the updated name of the pose: ")
     chakra = input("Enter the updated chakra of the pose: ")
     difficulty = input("Enter the updated difficulty of the pose: ")
 
-    # Check if any field is updated
+    # Check if any field is updated (an empty answer leaves that field as it is)
     if name or chakra or difficulty:
-        Pose.update(pose_id, name=name, chakra=chakra, difficulty=difficulty)
+        try:
+            Pose.update(pose_id, name=name or None, chakra=chakra or None, difficulty=difficulty or None)
+        except ValueError as error:
+            print(error)
+            return
         print("Yoga pose updated successfully!")
     else:
         print("No updates provided. Pose remains unchanged.")
@@ -161,7 +204,11 @@ def create_yoga_flow():
     chakra = input("Enter the chakra of the flow (Root, Sacral, Solar Plexus, Heart, Throat, Third Eye, or Crown): ")
     duration = input("Enter the duration of the flow (10, 20, 30, 40, 50, or 60 minutes): ")
     difficulty = input("Enter the difficulty of the flow (Easy, Intermediate, or Advanced): ")
-    Flow.create(chakra, duration, difficulty)
+    try:
+        Flow.create(chakra, int(duration), difficulty)
+    except ValueError as error:
+        print(error if duration.strip().isdigit() else "The duration must be a whole number of minutes.")
+        return
     print("Yoga flow created successfully!")
 
 def delete_yoga_flow_by_id():
@@ -169,73 +216,160 @@ def delete_yoga_flow_by_id():
     Flow.delete(flow_id)
     print("Yoga flow deleted successfully!")
 
-def list_all_yoga_flows():
-    flows = Flow.get_all()
-    if flows:
-        
-        print(Style.BRIGHT +"\n id | chakra        | duration | difficulty \n"+ Style.RESET_ALL)
-        for flow in flows:
-            print(f"{flow['id']:3} | {flow['chakra']:13} | {flow['duration']:8} | {flow['difficulty']}")
+def page_through(get_page, print_header, print_row):
+    # Prints one page at a time so large tables show up immediately. Returns the number of rows shown.
+    after_id = 0
+    shown = 0
+    while True:
+        # Ask for one extra row to know whether there is another page
+        rows = get_page(after_id, PAGE_SIZE + 1)
+        if not rows:
+            break
+        if shown == 0:
+            print_header()
+        for row in rows[:PAGE_SIZE]:
+            print_row(row)
+        shown += len(rows[:PAGE_SIZE])
+        if len(rows) <= PAGE_SIZE:
+            break
+        after_id = rows[PAGE_SIZE - 1]['id']
+        if input("Press Enter for more or q to stop: ").lower() == 'q':
+            break
+    if shown:
         print("\n")
-    else:
+    return shown
+
+def print_flow_header():
+    print(Style.BRIGHT +"\n id | chakra        | duration | difficulty   | poses | est. time \n"+ Style.RESET_ALL)
+
+def print_flow_row(flow):
+    # Pose count and estimated time come from the flow catalog
+    pose_count = flow['pose_count'] if flow['pose_count'] is not None else '-'
+    estimate = f"{flow['estimated_seconds']}s" if flow['estimated_seconds'] is not None else '-'
+    print(f"{flow['id']:3} | {flow['chakra']:13} | {flow['duration']:8} | {flow['difficulty']:12} | {pose_count:5} | {estimate}")
+
+def list_flows_page(title=None, **filters):
+    def print_header():
+        if title:
+            print(title)
+        print_flow_header()
+
+    return page_through(lambda after_id, limit: FlowCatalog.get_page(after_id, limit, **filters),
+                        print_header, print_flow_row)
+
+def list_all_yoga_flows():
+    if not list_flows_page():
         print("No yoga flows found.")
 
 def filter_by_chakra():
     chakra = input("Enter the chakra to filter by (Root, Sacral, Solar Plexus, Heart, Throat, Third Eye, or Crown): ")
-    flows = Flow.filter_by_chakra(chakra)
-    if flows:
-        print(f"Yoga Flows with Chakra '{chakra}':")
-        for flow in flows:
-            print(flow)
-    else:
+    if not list_flows_page(f"Yoga Flows with Chakra '{chakra}':", chakra=chakra):
         print(f"No yoga flows found with Chakra '{chakra}'.")
 
 def filter_by_duration():
     duration = input("Enter the duration to filter by: ")
-    flows = Flow.filter_by_duration(duration)
-    if flows:
-        print(f"Yoga Flows with Duration '{duration}' minutes:")
-        for flow in flows:
-            print(flow)
-    else:
+    if not list_flows_page(f"Yoga Flows with Duration '{duration}' minutes:", duration=duration):
         print(f"No yoga flows found with Duration '{duration}' minutes.")
 
 def filter_by_difficulty():
     difficulty = input("Enter the difficulty level to filter by: ")
-    flows = Flow.filter_by_difficulty(difficulty)
-    if flows:
-        print(f"Yoga Flows with Difficulty Level '{difficulty}':")
-        for flow in flows:
-            print(flow)
-    else:
+    if not list_flows_page(f"Yoga Flows with Difficulty Level '{difficulty}':", difficulty=difficulty):
         print(f"No yoga flows found with Difficulty '{difficulty}'.")
 
+def split_values(text):
+    # "Heart, Root" -> ['Heart', 'Root'], blank -> None (any value)
+    values = [value.strip() for value in text.split(',') if value.strip()]
+    return values or None
+
+def search_by_criteria():
+    print("Leave a filter blank to match anything. Separate several values with commas.")
+    chakras = split_values(input("Chakras (Root, Sacral, Solar Plexus, Heart, Throat, Third Eye, Crown): "))
+    difficulties = split_values(input("Difficulties (Easy, Intermediate, Advanced): "))
+    min_duration = input("Minimum duration: ").strip()
+    max_duration = input("Maximum duration: ").strip()
+    sort = input("Sort by (id, chakra, duration or difficulty, add - in front for descending): ").strip() or 'id'
+
+    try:
+        criteria = {
+            'chakra': chakras,
+            'difficulty': difficulties,
+            'min_duration': int(min_duration) if min_duration else None,
+            'max_duration': int(max_duration) if max_duration else None,
+            'sort': sort,
+        }
+        offset = 0
+        while True:
+            # One extra row tells us whether there is another page
+            flows = Flow.search(**criteria, limit=PAGE_SIZE + 1, offset=offset)
+            if not flows:
+                break
+            if offset == 0:
+                print_flow_header()
+            for flow in flows[:PAGE_SIZE]:
+                print_flow_row(flow)
+            if len(flows) <= PAGE_SIZE:
+                break
+            offset += PAGE_SIZE
+            if input("Press Enter for more or q to stop: ").lower() == 'q':
+                break
+    except ValueError as error:
+        print(f"Invalid search: {error}")
+        return
+
+    if offset == 0 and not flows:
+        print("No yoga flows found matching your search.")
+    else:
+        print("\n")
+
 # POSE METHODS 
 
 def create_yoga_pose():
     name = input("Enter the name of the pose: ")
     chakra = input("Enter the chakra of the pose (Root, Sacral, Solar Plexus, Heart, Throat, Third Eye, or Crown): ")
     difficulty = input("Enter the difficulty of the pose (Easy, Intermediate, Advanced): ")
-    Pose.create(name, chakra, difficulty)
+    try:
+        Pose.create(name, chakra, difficulty)
+    except ValueError as error:
+        print(error)
+        return
     print("Yoga pose added successfully!")
 
 def delete_yoga_pose_by_id():
-    pose_id = input("Enter the ID of the pose you want to delete: ")
+    pose_id = read_pose_id("Enter the ID of the pose you want to delete: ")
+    if pose_id is None:
+        return
     Pose.delete(pose_id)
     print("Yoga pose deleted successfully!")
 
-def list_all_yoga_poses():
-    poses = Pose.get_all()
+def print_pose_header():
+    print(Style.BRIGHT +"\n id | name                           | chakra        | difficulty \n"+ Style.RESET_ALL)
+
+def print_pose_row(pose):
+    print(f"{pose['id']:3} | {pose['name']:30} | {pose['chakra']:13} | {pose['difficulty']}")
+
+def search_yoga_poses():
+    text = input("Enter part of the pose name: ")
+    poses = Pose.search(text, limit=PAGE_SIZE)
     if poses:
-        print(Style.BRIGHT +"\n id | name                           | chakra        | difficulty \n"+ Style.RESET_ALL)
+        print_pose_header()
         for pose in poses:
-            print(f"{pose['id']:3} | {pose['name']:30} | {pose['chakra']:13} | {pose['difficulty']}")
+            print_pose_row(pose)
         print("\n")
     else:
+        print(f"No yoga poses found matching '{text}'.")
+
+def list_all_yoga_poses():
+    if not page_through(Pose.get_page, print_pose_header, print_pose_row):
         print("No yoga poses found.")
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # Arguments given: run a single command (see commands.py) instead of the menu
+        from commands import main as run_command
+        sys.exit(run_command(sys.argv[1:]))
     main()
 
-
+    from db import profiler
+    if profiler.is_enabled():
+        print(profiler.format_summary())
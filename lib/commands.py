@@ -0,0 +1,373 @@
+# This file contains the non-interactive command line interface. Every command runs in one shot and prints JSON,
+# so Py Flows can be scripted. `batch` reads many commands from stdin and runs them in one process on one connection.
+#
+# $ python lib/cli.py flows list --chakra Heart
+# $ python lib/cli.py generate --flow-id 3 --no-timers --seed 7
+# $ python lib/cli.py batch < commands.txt
+
+import argparse
+import json
+import sys
+
+from db import profiler
+from db.connection import DatabaseBusy, connection, transaction
+from db.models import Flow, FlowPose, History, Pose, PAGE_SIZE
+
+# Only these tables can be imported or exported (kept here so db.bulk is only imported when it is used)
+BULK_TABLES = ('poses', 'flows')
+
+
+class CommandError(Exception):
+    pass
+
+
+def row_to_dict(row):
+    return dict(row) if row is not None else None
+
+
+def write_json(value, out):
+    out.write(json.dumps(value) + "\n")
+
+
+def write_rows(rows, out):
+    # Streams a JSON array so large tables are never held in memory
+    out.write("[")
+    for index, row in enumerate(rows):
+        if index:
+            out.write(", ")
+        out.write(json.dumps(dict(row)))
+    out.write("]\n")
+
+
+def limited(rows, limit):
+    for index, row in enumerate(rows):
+        if limit is not None and index >= limit:
+            break
+        yield row
+
+
+# FLOW COMMANDS
+
+def flows_list(args, out):
+    filters = {'chakra': args.chakra, 'duration': args.duration, 'difficulty': args.difficulty}
+    if args.after_id is None:
+        rows = Flow.iter_all(**filters)
+    else:
+        rows = Flow.get_page(args.after_id, args.limit or PAGE_SIZE, **filters)
+    write_rows(limited(rows, args.limit), out)
+
+
+def flows_filter(args, out):
+    if args.chakra is None and args.duration is None and args.difficulty is None:
+        raise CommandError("Give at least one of --chakra, --duration or --difficulty.")
+    flows_list(args, out)
+
+
+def flows_search(args, out):
+    rows = Flow.search(chakra=args.chakra, difficulty=args.difficulty, duration=args.duration,
+                       min_duration=args.min_duration, max_duration=args.max_duration,
+                       sort=args.sort, limit=args.limit, offset=args.offset)
+    write_rows(rows, out)
+
+
+def flows_show(args, out):
+    flow = Flow.find_by_id(args.id)
+    if flow is None:
+        raise CommandError(f"Flow {args.id} not found.")
+    result = row_to_dict(flow)
+    result['poses'] = [row_to_dict(pose) for pose in FlowPose.get_poses_for_flows([args.id])[args.id]]
+    write_json(result, out)
+
+
+def flows_create(args, out):
+    flow_id = Flow.create(args.chakra, args.duration, args.difficulty)
+    write_json({'id': flow_id}, out)
+
+
+def flows_delete(args, out):
+    Flow.delete(args.id)
+    write_json({'deleted': args.id}, out)
+
+
+# POSE COMMANDS
+
+def poses_list(args, out):
+    filters = {'chakra': args.chakra, 'difficulty': args.difficulty}
+    if args.after_id is None:
+        rows = Pose.iter_all(**filters)
+    else:
+        rows = Pose.get_page(args.after_id, args.limit or PAGE_SIZE, **filters)
+    write_rows(limited(rows, args.limit), out)
+
+
+def poses_filter(args, out):
+    if args.chakra is None and args.difficulty is None:
+        raise CommandError("Give at least one of --chakra or --difficulty.")
+    poses_list(args, out)
+
+
+def poses_search(args, out):
+    write_rows(Pose.search(args.text, limit=args.limit), out)
+
+
+def poses_show(args, out):
+    pose = Pose.find_by_id(args.id)
+    if pose is None:
+        raise CommandError(f"Pose {args.id} not found.")
+    write_json(row_to_dict(pose), out)
+
+
+def poses_create(args, out):
+    pose_id = Pose.create(args.name, args.chakra, args.difficulty, args.hold_seconds)
+    write_json({'id': pose_id}, out)
+
+
+def poses_update(args, out):
+    if args.name is None and args.chakra is None and args.difficulty is None and args.hold_seconds is None:
+        raise CommandError("Give at least one of --name, --chakra, --difficulty or --hold-seconds.")
+    Pose.update(args.id, name=args.name, chakra=args.chakra, difficulty=args.difficulty,
+                hold_seconds=args.hold_seconds)
+    write_json({'updated': args.id}, out)
+
+
+def poses_delete(args, out):
+    Pose.delete(args.id)
+    write_json({'deleted': args.id}, out)
+
+
+# OTHER COMMANDS
+
+def generate(args, out):
+    if args.walk:
+        plan = Flow.walk_for_flow(args.flow_id, seed=args.seed)
+    else:
+        plan = Flow.compose_for_flow(args.flow_id, seed=args.seed)
+    if plan is None:
+        raise CommandError(f"Flow {args.flow_id} not found.")
+    if args.no_timers:
+        from db.plan import plan_to_dict
+        write_json(plan_to_dict(plan), out)
+    else:
+        from db.history import HistoryWriter
+        with HistoryWriter() as writer:
+            Flow.play(plan, writer, user_id=args.user, flow_id=args.flow_id)
+
+
+def history_sessions(args, out):
+    write_rows(History.recent_sessions(args.user, args.limit), out)
+
+
+def history_poses(args, out):
+    write_rows(History.most_used_poses(args.limit), out)
+
+
+def generate_batch(args, out):
+    from db import batch
+    count, seconds = batch.generate_plans(batch.read_jobs(args.jobs, args.format), args.output, args.workers)
+    write_json({'plans': count, 'seconds': seconds, 'plans_per_sec': count / seconds if seconds else None}, out)
+
+
+def import_command(args, out):
+    from db import bulk
+    rows, seconds = bulk.import_file(args.table, args.file, args.format)
+    write_json({'table': args.table, 'rows': rows, 'seconds': seconds,
+                'rows_per_sec': rows / seconds if seconds else None}, out)
+
+
+def export_command(args, out):
+    from db import bulk
+    rows, seconds = bulk.export_file(args.table, args.file, args.format)
+    write_json({'table': args.table, 'rows': rows, 'seconds': seconds,
+                'rows_per_sec': rows / seconds if seconds else None}, out)
+
+
+def profile(args, out):
+    if args.table:
+        out.write(profiler.format_summary(args.limit) + "\n")
+    else:
+        write_json(profiler.summary(), out)
+    if args.reset:
+        profiler.reset()
+
+
+def serve(args, out):
+    from server import serve as run_server  # Imported here so other commands don't load asyncio
+    run_server(args.host, args.port, args.workers)
+
+
+def batch(args, out, stdin=None):
+    """Run one command per line from stdin. Each command prints one JSON line; errors are reported and skipped."""
+    import shlex
+    stdin = stdin or sys.stdin
+    parser = build_parser()
+    failures = 0
+    # Hold one connection for the whole batch (and one transaction with --transaction)
+    with (transaction() if args.transaction else connection()):
+        for line_number, line in enumerate(stdin, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                command = parser.parse_args(shlex.split(line))
+                if command.handler is batch:
+                    raise CommandError("batch can't be nested.")
+                if command.handler is serve:
+                    raise CommandError("serve can't run inside a batch.")
+                run(command, out)
+            except (CommandError, DatabaseBusy, ValueError, OSError) as error:
+                failures += 1
+                write_json({'error': str(error), 'line': line_number}, out)
+            except SystemExit:
+                # argparse already printed the usage error to stderr
+                failures += 1
+                write_json({'error': 'invalid command', 'line': line_number}, out)
+            out.flush()
+        if failures and args.transaction:
+            # Raising inside the transaction rolls back every command in the batch
+            raise CommandError(f"{failures} command(s) failed, nothing was saved.")
+    return failures
+
+
+def add_filters(parser, duration=True):
+    parser.add_argument('--chakra')
+    if duration:
+        parser.add_argument('--duration', type=int)
+    parser.add_argument('--difficulty')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--after-id', type=int, help="return the page of rows after this id")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Py Flows. Run without arguments for the interactive menu.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    flows = commands.add_parser('flows', help="manage flow templates").add_subparsers(dest='action', required=True)
+    command = flows.add_parser('list')
+    add_filters(command)
+    command.set_defaults(handler=flows_list)
+    command = flows.add_parser('filter')
+    add_filters(command)
+    command.set_defaults(handler=flows_filter)
+    command = flows.add_parser('search', help="combine filters; --chakra, --difficulty and --duration can be repeated")
+    command.add_argument('--chakra', action='append')
+    command.add_argument('--difficulty', action='append')
+    command.add_argument('--duration', type=int, action='append')
+    command.add_argument('--min-duration', type=int)
+    command.add_argument('--max-duration', type=int)
+    command.add_argument('--sort', default='id', help="id, chakra, duration or difficulty, prefix with - for descending (--sort=-duration)")
+    command.add_argument('--limit', type=int)
+    command.add_argument('--offset', type=int, default=0)
+    command.set_defaults(handler=flows_search)
+    command = flows.add_parser('show')
+    command.add_argument('id', type=int)
+    command.set_defaults(handler=flows_show)
+    command = flows.add_parser('create')
+    command.add_argument('--chakra', required=True)
+    command.add_argument('--duration', type=int, required=True)
+    command.add_argument('--difficulty', required=True)
+    command.set_defaults(handler=flows_create)
+    command = flows.add_parser('delete')
+    command.add_argument('id', type=int)
+    command.set_defaults(handler=flows_delete)
+
+    poses = commands.add_parser('poses', help="manage poses").add_subparsers(dest='action', required=True)
+    command = poses.add_parser('list')
+    add_filters(command, duration=False)
+    command.set_defaults(handler=poses_list)
+    command = poses.add_parser('filter')
+    add_filters(command, duration=False)
+    command.set_defaults(handler=poses_filter)
+    command = poses.add_parser('search', help="find poses by name (prefix and fuzzy matching)")
+    command.add_argument('text')
+    command.add_argument('--limit', type=int, default=10)
+    command.set_defaults(handler=poses_search)
+    command = poses.add_parser('show')
+    command.add_argument('id', type=int)
+    command.set_defaults(handler=poses_show)
+    command = poses.add_parser('create')
+    command.add_argument('--name', required=True)
+    command.add_argument('--chakra', required=True)
+    command.add_argument('--difficulty', required=True)
+    command.add_argument('--hold-seconds', type=int, help="how long the pose is held in composed flows")
+    command.set_defaults(handler=poses_create)
+    command = poses.add_parser('update')
+    command.add_argument('id', type=int)
+    command.add_argument('--name')
+    command.add_argument('--chakra')
+    command.add_argument('--difficulty')
+    command.add_argument('--hold-seconds', type=int)
+    command.set_defaults(handler=poses_update)
+    command = poses.add_parser('delete')
+    command.add_argument('id', type=int)
+    command.set_defaults(handler=poses_delete)
+
+    command = commands.add_parser('generate', help="generate a flow from a template")
+    command.add_argument('--flow-id', type=int, required=True)
+    command.add_argument('--seed', type=int)
+    command.add_argument('--no-timers', action='store_true', help="print the plan as JSON instead of playing it")
+    command.add_argument('--user', help="record the session in this user's history")
+    command.add_argument('--walk', action='store_true',
+                         help="order the poses along the pose transition graph instead of fitting the duration exactly")
+    command.set_defaults(handler=generate)
+
+    history = commands.add_parser('history', help="past sessions and pose usage").add_subparsers(dest='action', required=True)
+    command = history.add_parser('sessions', help="most recent sessions of a user")
+    command.add_argument('--user')
+    command.add_argument('--limit', type=int, default=10)
+    command.set_defaults(handler=history_sessions)
+    command = history.add_parser('poses', help="most used poses")
+    command.add_argument('--limit', type=int, default=10)
+    command.set_defaults(handler=history_poses)
+
+    command = commands.add_parser('generate-batch', help="generate the plans listed in a jobs file in parallel")
+    command.add_argument('jobs', help="JSONL or CSV file with flow_id and seed columns")
+    command.add_argument('output', help="JSONL file to write the plans to")
+    command.add_argument('--workers', type=int, help="number of processes (default: number of CPUs)")
+    command.add_argument('--format', choices=['jsonl', 'csv'], help="format of the jobs file")
+    command.set_defaults(handler=generate_batch)
+
+    for name, handler in (('import', import_command), ('export', export_command)):
+        command = commands.add_parser(name, help=f"{name} poses or flows as JSONL or CSV")
+        command.add_argument('table', choices=BULK_TABLES)
+        command.add_argument('file')
+        command.add_argument('--format', choices=['jsonl', 'csv'])
+        command.set_defaults(handler=handler)
+
+    command = commands.add_parser('profile', help="print the profiler statistics (set PY_FLOWS_PROFILE=1), e.g. at the end of a batch")
+    command.add_argument('--table', action='store_true', help="print a text table instead of JSON")
+    command.add_argument('--limit', type=int, default=20, help="rows per table with --table")
+    command.add_argument('--reset', action='store_true', help="clear the statistics afterwards")
+    command.set_defaults(handler=profile)
+
+    command = commands.add_parser('serve', help="serve flows, poses and plans as a local HTTP/JSON service")
+    command.add_argument('--host', default='127.0.0.1')
+    command.add_argument('--port', type=int, default=8000, help="0 picks a free port")
+    command.add_argument('--workers', type=int, help="threads for database calls (default: connection pool size)")
+    command.set_defaults(handler=serve)
+
+    command = commands.add_parser('batch', help="run commands read from stdin, one per line")
+    command.add_argument('--transaction', action='store_true', help="commit every command together at the end")
+    command.set_defaults(handler=batch)
+
+    return parser
+
+
+def run(args, out):
+    # Every command is timed as "command <name>" when the profiler is on
+    name = " ".join(part for part in ('command', args.command, getattr(args, 'action', None)) if part)
+    return profiler.timed(name)(args.handler)(args, out)
+
+
+def main(argv, out=None):
+    out = out or sys.stdout
+    args = build_parser().parse_args(argv)
+    try:
+        result = run(args, out)
+    except (CommandError, DatabaseBusy, ValueError, OSError) as error:
+        sys.stderr.write(f"Error: {error}\n")
+        return 1
+    finally:
+        if profiler.is_enabled() and args.handler is not profile:
+            sys.stderr.write(profiler.format_summary() + "\n")
+    # batch returns the number of failed commands
+    return 1 if result else 0
@@ -0,0 +1,119 @@
+# This file generates many flow plans at once, e.g. to precompute every user's plan overnight.
+# Each job is a flow template id and a seed (plus any other fields, such as a user id, which are copied to the output).
+# The poses are loaded once into a PoseIndex snapshot that is handed to every worker process, so workers never query
+# the database, and the plans are written to a JSONL file as they come back, in the same order as the jobs.
+# Plans are built by the composer (see composer.py), so they last exactly as long as their flow, like Flow.compose_for_flow.
+# Each worker needs MIN_JOBS_PER_WORKER jobs to pay for starting it; smaller batches use fewer workers.
+#
+# $ python lib/db/batch.py jobs.jsonl plans.jsonl --workers 4
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+if __name__ == "__main__":
+    # Make the lib directory importable when this file is run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db.bulk import chunks, read_records
+from db.connection import connection
+from db.lookup import FLOW_SELECT
+from db.plan import plan_to_dict
+from db.snapshot import PoseIndex
+
+CHUNK_SIZE = 500
+MIN_JOBS_PER_WORKER = 1000  # Below this a process costs more to start (and send the snapshot to) than it saves
+
+# Set in every worker by init_worker
+_index = None
+_flows = None
+
+
+def load_flows():
+    """Returns {flow_id: (chakra, duration, difficulty)} for every flow template."""
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(FLOW_SELECT)
+        return {row[0]: tuple(row[1:]) for row in cursor}
+
+
+def init_worker(index, flows):
+    global _index, _flows
+    _index = index
+    _flows = flows
+
+
+def generate_chunk(jobs):
+    """Build the plans of a list of jobs and return them as JSON lines."""
+    lines = []
+    for job in jobs:
+        result = dict(job)
+        flow = _flows.get(job.get('flow_id'))
+        try:
+            if flow is None:
+                raise ValueError(f"Flow {job.get('flow_id')} not found.")
+            result['plan'] = plan_to_dict(_index.compose(*flow, seed=job.get('seed')))
+        except ValueError as error:
+            result['error'] = str(error)
+        lines.append(json.dumps(result) + '\n')
+    return lines
+
+
+def generate_plans(jobs, path, workers=None, chunk_size=CHUNK_SIZE):
+    """Write one JSON line per job to path. Returns (jobs done, seconds taken).
+
+    workers is the number of processes (the number of CPUs by default); with 1 worker everything runs in this process.
+    No more workers are started than there are MIN_JOBS_PER_WORKER jobs, so a small batch runs in this process too.
+    """
+    workers = workers or os.cpu_count() or 1
+    jobs = iter(jobs)
+    head = list(itertools.islice(jobs, workers * MIN_JOBS_PER_WORKER))
+    workers = max(1, min(workers, len(head) // MIN_JOBS_PER_WORKER))
+    jobs = itertools.chain(head, jobs)
+    start = time.perf_counter()
+    index = PoseIndex.load()
+    flows = load_flows()
+
+    count = 0
+    with open(path, 'w', encoding='utf-8') as file:
+        if workers == 1:
+            init_worker(index, flows)
+            for lines in map(generate_chunk, chunks(jobs, chunk_size)):
+                file.writelines(lines)
+                count += len(lines)
+        else:
+            # The snapshot is sent to each worker once, when it starts, instead of with every chunk
+            with multiprocessing.Pool(workers, initializer=init_worker, initargs=(index, flows)) as pool:
+                for lines in pool.imap(generate_chunk, chunks(jobs, chunk_size)):
+                    file.writelines(lines)
+                    count += len(lines)
+    return count, time.perf_counter() - start
+
+
+def read_jobs(path, fmt=None):
+    for line_number, record in enumerate(read_records(path, fmt), 1):
+        try:
+            record['flow_id'] = int(record['flow_id'])
+            if record.get('seed') not in (None, ''):
+                record['seed'] = int(record['seed'])
+            else:
+                record['seed'] = None
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Job {line_number}: flow_id and seed must be whole numbers.")
+        yield record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate flow plans in bulk.")
+    parser.add_argument('jobs', help="JSONL or CSV file with flow_id and seed columns")
+    parser.add_argument('output', help="JSONL file to write the plans to")
+    parser.add_argument('--workers', type=int, help="number of processes (default: number of CPUs)")
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help="format of the jobs file")
+    args = parser.parse_args()
+
+    count, seconds = generate_plans(read_jobs(args.jobs, args.format), args.output, args.workers)
+    rate = count / seconds if seconds else 0
+    print(f"Generated {count} plans in {seconds:.2f}s ({rate:.0f} plans/sec)")
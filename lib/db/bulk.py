@@ -0,0 +1,170 @@
+# This file imports and exports poses and flows in bulk as JSONL or CSV.
+# Files are streamed in chunks, so a large catalog is never held in memory,
+# and every chunk is written with executemany inside a single transaction.
+#
+# $ python lib/db/bulk.py import poses catalog.jsonl
+# $ python lib/db/bulk.py export flows flows.csv
+
+import csv
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+if __name__ == "__main__":
+    # Make the lib directory importable when this file is run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import catalog, transitions
+from db.cache import invalidate
+from db.connection import connection, transaction
+from db.lookup import FLOW_SELECT, POSE_SELECT, chakra_id, difficulty_id, pose_name, whole_number
+
+CHUNK_SIZE = 10000
+
+# Columns in the files
+TABLES = {
+    'poses': ('name', 'chakra', 'difficulty'),
+    'flows': ('chakra', 'duration', 'difficulty'),
+}
+
+# Columns that may be missing or empty in a file
+OPTIONAL_COLUMNS = {
+    'poses': ('hold_seconds',),
+    'flows': (),
+}
+
+# Columns in the database, where chakra and difficulty are lookup ids
+INSERT_COLUMNS = {
+    'poses': ('name', 'chakra_id', 'difficulty_id', 'hold_seconds'),
+    'flows': ('chakra_id', 'duration', 'difficulty_id'),
+}
+
+SELECTS = {'poses': POSE_SELECT, 'flows': FLOW_SELECT}
+
+
+def detect_format(path, fmt=None):
+    if fmt is None:
+        fmt = os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in ('jsonl', 'csv'):
+        raise ValueError(f"Unsupported format '{fmt}', use jsonl or csv.")
+    return fmt
+
+
+def read_records(path, fmt=None):
+    fmt = detect_format(path, fmt)
+    with open(path, newline='', encoding='utf-8') as file:
+        if fmt == 'csv':
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def validate(table, record, line_number):
+    columns = TABLES[table]
+    missing = [column for column in columns if record.get(column) in (None, '')]
+    if missing:
+        raise ValueError(f"Record {line_number}: missing {', '.join(missing)}.")
+
+    try:
+        if table == 'poses':
+            hold_seconds = record.get('hold_seconds')
+            if hold_seconds in (None, ''):
+                hold_seconds = None
+            else:
+                hold_seconds = whole_number(to_int(hold_seconds, "hold_seconds"), "hold_seconds")
+            return (pose_name(record['name']), chakra_id(record['chakra']), difficulty_id(record['difficulty']),
+                    hold_seconds)
+        duration = whole_number(to_int(record['duration'], "duration"), "duration")
+        return chakra_id(record['chakra']), duration, difficulty_id(record['difficulty'])
+    except ValueError as error:
+        raise ValueError(f"Record {line_number}: {error}")
+
+
+def to_int(value, label):
+    # CSV gives every value as a string, so numbers are converted before they are checked
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"{label} must be a positive whole number.")
+    return value
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_file(table, path, fmt=None, chunk_size=CHUNK_SIZE):
+    """Load a JSONL or CSV file into poses or flows. Returns (rows inserted, seconds taken)."""
+    columns = INSERT_COLUMNS[table]
+    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+    rows = (validate(table, record, number) for number, record in enumerate(read_records(path, fmt), 1))
+
+    count = 0
+    start = time.perf_counter()
+    try:
+        for chunk in chunks(rows, chunk_size):
+            with transaction() as conn:
+                conn.executemany(query, chunk)
+            count += len(chunk)
+    finally:
+        # Earlier chunks are committed even if a later one fails
+        with transaction() as conn:
+            catalog.refresh(conn.cursor())
+            if table == 'poses':
+                # One rebuild is cheaper than connecting every imported pose on its own
+                transitions.build(conn.cursor())
+        invalidate(table, 'flow_catalog', 'pose_transitions')
+    return count, time.perf_counter() - start
+
+
+def export_file(table, path, fmt=None, chunk_size=CHUNK_SIZE):
+    """Write poses or flows to a JSONL or CSV file. Returns (rows written, seconds taken)."""
+    fmt = detect_format(path, fmt)
+    columns = ('id',) + TABLES[table] + OPTIONAL_COLUMNS[table]
+
+    count = 0
+    start = time.perf_counter()
+    with connection() as conn, open(path, 'w', newline='', encoding='utf-8') as file:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(columns)} FROM ({SELECTS[table]}) ORDER BY id")
+        writer = csv.writer(file) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(columns)
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            if writer:
+                writer.writerows(rows)
+            else:
+                file.writelines(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+            count += len(rows)
+    return count, time.perf_counter() - start
+
+
+def report(action, table, count, seconds):
+    rate = count / seconds if seconds else 0
+    print(f"{action} {count} {table} in {seconds:.2f}s ({rate:.0f} rows/sec)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5) or sys.argv[1] not in ('import', 'export') or sys.argv[2] not in TABLES:
+        print("Usage: python lib/db/bulk.py import|export poses|flows FILE [jsonl|csv]")
+        sys.exit(1)
+
+    action, table, path = sys.argv[1:4]
+    fmt = sys.argv[4] if len(sys.argv) == 5 else None
+    if action == 'import':
+        report("Imported", table, *import_file(table, path, fmt))
+    else:
+        report("Exported", table, *export_file(table, path, fmt))
@@ -0,0 +1,141 @@
+# This file contains the in-process read cache used by the models.
+# Results are kept in an LRU cache (bounded size, entries expire after ttl seconds), keyed by method and arguments.
+# Each entry is tagged with the tables it reads, and writes to a table drop every entry tagged with it.
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+
+class QueryCache:
+    def __init__(self, max_size=1024, ttl=60.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.enabled = True
+        self.generation = 0  # Bumped by every invalidate(), see set()
+        self._entries = OrderedDict()  # key -> (expires_at, tables, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns (True, value) on a hit and (False, None) on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[2]
+            if entry is not None:
+                del self._entries[key]  # Expired
+            self.misses += 1
+            return False, None
+
+    def set(self, key, tables, value, generation=None):
+        """Store a result. generation is self.generation from before the query ran: if anything was invalidated
+        since, the result may predate that write and is not stored."""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (self.clock() + self.ttl, tables, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *tables):
+        """Drop cached results that read any of the given tables (all results if no table is given)."""
+        with self._lock:
+            self.generation += 1
+            if not tables:
+                self._entries.clear()
+            else:
+                stale = [key for key, entry in self._entries.items() if not entry[1].isdisjoint(tables)]
+                for key in stale:
+                    del self._entries[key]
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+
+query_cache = QueryCache()
+
+
+def configure(max_size=None, ttl=None, enabled=None):
+    if max_size is not None:
+        query_cache.max_size = max_size
+    if ttl is not None:
+        query_cache.ttl = ttl
+    if enabled is not None:
+        query_cache.enabled = enabled
+    query_cache.invalidate()
+
+
+def cached(*tables):
+    """Cache a model classmethod that reads the given tables. Place it below @classmethod; list results are copied on every hit."""
+    tables = frozenset(tables)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(cls, *args, **kwargs):
+            if not query_cache.enabled:
+                return func(cls, *args, **kwargs)
+
+            key = (func.__qualname__, args, tuple(sorted(kwargs.items())))
+            try:
+                hit, value = query_cache.get(key)
+            except TypeError:
+                return func(cls, *args, **kwargs)  # Unhashable arguments are not cached
+
+            if hit:
+                is_list, value = value
+                return list(value) if is_list else value
+
+            generation = query_cache.generation
+            value = func(cls, *args, **kwargs)
+            # Lists are stored as tuples so callers can't change the cached copy
+            if isinstance(value, list):
+                query_cache.set(key, tables, (True, tuple(value)), generation)
+            else:
+                query_cache.set(key, tables, (False, value), generation)
+            return value
+        return wrapper
+    return decorator
+
+
+_listeners = []
+
+
+def on_invalidate(listener):
+    """Call listener(tables) after every invalidate(), e.g. to drop other in-memory copies of the tables."""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    """Stop calling a listener added with on_invalidate()."""
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def invalidate(*tables):
+    query_cache.invalidate(*tables)
+    for listener in list(_listeners):
+        listener(tables)
@@ -0,0 +1,151 @@
+# This file maintains the catalog, three tables derived from flows and poses so generating a flow or listing
+# templates does not have to scan the poses table:
+# - chakra_poses lists the poses of each chakra (which are the poses that can be used in a flow with that chakra),
+#   one (chakra_id, pose_id) row per pose
+# - chakra_catalog counts them per chakra (all poses, and Easy/Intermediate/Advanced ones)
+# - flow_catalog stores the estimated length of every flow template
+# The poses and their counts are kept once per chakra rather than once per flow, so the catalog grows with
+# poses + flows instead of poses * flows. A single pose write changes one chakra_poses row and one count; flow
+# estimates are only recomputed when the chakra has so few poses that they can't fill its longest flow.
+# The functions take a cursor so they run inside the caller's transaction. They are all cached under 'flow_catalog'.
+
+from db.lookup import CHAKRA_IDS, DIFFICULTY_IDS
+
+CREATE_CHAKRA_POSES_TABLE = '''CREATE TABLE IF NOT EXISTS chakra_poses (
+                    chakra_id INTEGER NOT NULL,
+                    pose_id INTEGER NOT NULL,
+                    PRIMARY KEY(chakra_id, pose_id),
+                    FOREIGN KEY(chakra_id) REFERENCES chakras(id),
+                    FOREIGN KEY(pose_id) REFERENCES poses(id)
+                ) WITHOUT ROWID'''
+
+CREATE_CHAKRA_TABLE = '''CREATE TABLE IF NOT EXISTS chakra_catalog (
+                    chakra_id INTEGER PRIMARY KEY,
+                    pose_count INTEGER NOT NULL DEFAULT 0,
+                    easy_count INTEGER NOT NULL DEFAULT 0,
+                    intermediate_count INTEGER NOT NULL DEFAULT 0,
+                    advanced_count INTEGER NOT NULL DEFAULT 0,
+                    FOREIGN KEY(chakra_id) REFERENCES chakras(id)
+                )'''
+
+CREATE_TABLE = '''CREATE TABLE IF NOT EXISTS flow_catalog (
+                    flow_id INTEGER PRIMARY KEY,
+                    estimated_seconds INTEGER NOT NULL,
+                    FOREIGN KEY(flow_id) REFERENCES flows(id)
+                )'''
+
+TABLE_COLUMNS = {
+    'chakra_poses': ('chakra_id', 'pose_id'),
+    'chakra_catalog': ('chakra_id', 'pose_count', 'easy_count', 'intermediate_count', 'advanced_count'),
+    'flow_catalog': ('flow_id', 'estimated_seconds'),
+}
+
+# Column of chakra_catalog that counts the poses of each difficulty
+COUNT_COLUMNS = {DIFFICULTY_IDS['Easy']: 'easy_count', DIFFICULTY_IDS['Intermediate']: 'intermediate_count',
+                 DIFFICULTY_IDS['Advanced']: 'advanced_count'}
+
+
+def create_table(cursor):
+    # Older versions kept the pose ids in flow_catalog, then as a JSON list per chakra in chakra_catalog. The tables
+    # only hold derived data, so any other layout is dropped and rebuilt by the next refresh (seed.py migrate does that).
+    for table, columns in TABLE_COLUMNS.items():
+        cursor.execute(f"PRAGMA table_info({table})")
+        existing = tuple(row[1] for row in cursor.fetchall())
+        if existing and existing != columns:
+            cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(CREATE_TABLE)
+    cursor.execute(CREATE_CHAKRA_TABLE)
+    cursor.execute(CREATE_CHAKRA_POSES_TABLE)
+
+
+def drop_tables(cursor):
+    for table in TABLE_COLUMNS:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+
+
+def refresh(cursor):
+    """Rebuild the whole catalog from flows and poses. Returns the number of flows in it."""
+    from db.composer import estimate_seconds
+
+    for table in TABLE_COLUMNS:
+        cursor.execute(f"DELETE FROM {table}")
+    cursor.execute("INSERT INTO chakra_poses (chakra_id, pose_id) SELECT chakra_id, id FROM poses")
+
+    # Every chakra gets a row, so chakras without poses show counts of 0
+    counts = {chakra_id: dict.fromkeys(COUNT_COLUMNS, 0) for chakra_id in CHAKRA_IDS.values()}
+    cursor.execute("SELECT chakra_id, difficulty_id, COUNT(*) FROM poses GROUP BY chakra_id, difficulty_id")
+    for chakra_id, difficulty_id, count in cursor.fetchall():
+        counts.setdefault(chakra_id, dict.fromkeys(COUNT_COLUMNS, 0))[difficulty_id] = count
+    cursor.executemany('''INSERT INTO chakra_catalog
+                          (chakra_id, pose_count, easy_count, intermediate_count, advanced_count)
+                          VALUES (?, ?, ?, ?, ?)''',
+                       [(chakra_id, sum(by_difficulty.values()), *(by_difficulty[difficulty_id]
+                                                                   for difficulty_id in COUNT_COLUMNS))
+                        for chakra_id, by_difficulty in counts.items()])
+
+    cursor.execute("SELECT id, chakra_id, duration FROM flows")
+    rows = [(flow_id, estimate_seconds(duration, sum(counts.get(chakra_id, {}).values())))
+            for flow_id, chakra_id, duration in cursor.fetchall()]
+    cursor.executemany("INSERT INTO flow_catalog (flow_id, estimated_seconds) VALUES (?, ?)", rows)
+    return len(rows)
+
+
+def pose_count(cursor, chakra_id):
+    cursor.execute("SELECT pose_count FROM chakra_catalog WHERE chakra_id = ?", (chakra_id,))
+    row = cursor.fetchone()
+    return row[0] if row is not None else 0
+
+
+def longest_duration(cursor, chakra_id):
+    # One MAX per difficulty, so each is a single seek in idx_flows_chakra_difficulty_duration
+    durations = []
+    for difficulty_id in COUNT_COLUMNS:
+        cursor.execute("SELECT MAX(duration) FROM flows WHERE chakra_id = ? AND difficulty_id = ?",
+                       (chakra_id, difficulty_id))
+        durations.append(cursor.fetchone()[0] or 0)
+    return max(durations)
+
+
+def count_pose(cursor, chakra_id, difficulty_id, change):
+    # Adds change (1 or -1) to the counts of the chakra, then updates the estimates that depend on them
+    from db.composer import estimate_seconds
+
+    before = pose_count(cursor, chakra_id)
+    column = COUNT_COLUMNS[difficulty_id]
+    cursor.execute("INSERT OR IGNORE INTO chakra_catalog (chakra_id) VALUES (?)", (chakra_id,))
+    cursor.execute(f"UPDATE chakra_catalog SET pose_count = pose_count + ?, {column} = {column} + ? WHERE chakra_id = ?",
+                   (change, change, chakra_id))
+
+    # An estimate only depends on the count while the poses can't fill the flow, so with enough poses for the
+    # longest flow of the chakra nothing else changes
+    longest = longest_duration(cursor, chakra_id)
+    if estimate_seconds(longest, before) == estimate_seconds(longest, before + change):
+        return
+    cursor.execute("SELECT id, duration FROM flows WHERE chakra_id = ?", (chakra_id,))
+    cursor.executemany("UPDATE flow_catalog SET estimated_seconds = ? WHERE flow_id = ?",
+                       [(estimate_seconds(duration, before + change), flow_id)
+                        for flow_id, duration in cursor.fetchall()])
+
+
+def add_pose(cursor, pose_id, chakra_id, difficulty_id):
+    """Add a pose with the given chakra and difficulty (lookup ids) to the catalog."""
+    cursor.execute("INSERT OR IGNORE INTO chakra_poses (chakra_id, pose_id) VALUES (?, ?)", (chakra_id, pose_id))
+    if cursor.rowcount:
+        count_pose(cursor, chakra_id, difficulty_id, 1)
+
+
+def remove_pose(cursor, pose_id, chakra_id, difficulty_id):
+    """Remove a pose from the catalog; chakra_id and difficulty_id are the ones it was added with."""
+    cursor.execute("DELETE FROM chakra_poses WHERE chakra_id = ? AND pose_id = ?", (chakra_id, pose_id))
+    if cursor.rowcount:
+        count_pose(cursor, chakra_id, difficulty_id, -1)
+
+
+def add_flow(cursor, flow_id, chakra_id, duration):
+    from db.composer import estimate_seconds
+    cursor.execute("INSERT OR REPLACE INTO flow_catalog (flow_id, estimated_seconds) VALUES (?, ?)",
+                   (flow_id, estimate_seconds(duration, pose_count(cursor, chakra_id))))
+
+
+def remove_flow(cursor, flow_id):
+    cursor.execute("DELETE FROM flow_catalog WHERE flow_id = ?", (flow_id,))
@@ -0,0 +1,171 @@
+# This file composes flows that last exactly as long as their template.
+# The duration is a budget in seconds: after the opening breaths every pose costs its hold time plus the pause
+# after it, and the poses are chosen with a bounded knapsack so the costs add up to the budget exactly.
+# Poses with the same cost are interchangeable for the knapsack, so it only decides how many poses of each cost
+# to use. That choice is memoised per (chakra, difficulty, duration); which poses fill it (and their order)
+# comes from the seed, so every plan is different but costs nothing to recompute.
+
+import random
+import threading
+
+from db.cache import on_invalidate
+from db.constants import DIFFICULTIES
+from db.plan import (BREATH_SECONDS, MIN_POSES, PAUSE_SECONDS, POSE_SECONDS, duration_seconds,
+                     plan_from_poses)
+
+# Hold time of a pose without its own hold_seconds
+HOLD_SECONDS = {'Easy': POSE_SECONDS, 'Intermediate': POSE_SECONDS + 1, 'Advanced': POSE_SECONDS + 2}
+MAX_HOLD_SECONDS = 60  # Holds are stretched up to this to absorb seconds the knapsack can't fill
+
+_memo = {}  # (chakra, difficulty, duration) -> (difficulty level, {cost: number of poses})
+_lock = threading.Lock()
+
+
+def hold_seconds(pose):
+    if 'hold_seconds' in pose.keys() and pose['hold_seconds']:
+        return pose['hold_seconds']
+    return HOLD_SECONDS.get(pose['difficulty'], POSE_SECONDS)
+
+
+def difficulty_level(difficulty):
+    # Flows allow poses up to their own difficulty; unknown or missing difficulties allow every pose
+    return DIFFICULTIES.index(difficulty) if difficulty in DIFFICULTIES else len(DIFFICULTIES) - 1
+
+
+def allowed_poses(poses, level):
+    return [pose for pose in poses if difficulty_level(pose['difficulty']) <= level]
+
+
+def group_by_cost(poses):
+    groups = {}
+    for pose in sorted(poses, key=lambda pose: pose['id']):
+        groups.setdefault(hold_seconds(pose) + PAUSE_SECONDS, []).append(pose)
+    return groups
+
+
+def solve(counts, budget, min_poses=1):
+    """Bounded knapsack: given {cost: available poses}, returns {cost: poses to use} with the highest total cost
+    that fits the budget (the budget itself whenever it can be reached) with at least min_poses poses, using as many
+    poses as possible. Returns {} if min_poses poses don't fit."""
+    # Each group is split into chunks of 1, 2, 4, ... poses, which turns it into a 0/1 knapsack over few items
+    items = []
+    for cost, available in sorted(counts.items()):
+        chunk = 1
+        while available > 0:
+            size = min(chunk, available)
+            items.append((cost, size))
+            available -= size
+            chunk *= 2
+
+    # best[s] is the largest number of poses whose costs add up to exactly s (-1 if s can't be reached)
+    best = [0] + [-1] * budget
+    taken = []
+    for cost, size in items:
+        weight = cost * size
+        if weight > budget:
+            taken.append(None)
+            continue
+        shifted = [-1] * weight + [count + size if count >= 0 else -1 for count in best[:budget + 1 - weight]]
+        taken.append([new > old for new, old in zip(shifted, best)])
+        best = list(map(max, best, shifted))
+
+    total = max((seconds for seconds in range(budget + 1) if best[seconds] >= min_poses), default=None)
+    if total is None:
+        return {}
+    used = {}
+    for (cost, size), took in zip(reversed(items), reversed(taken)):
+        if took is not None and took[total]:
+            used[cost] = used.get(cost, 0) + size
+            total -= cost * size
+    return used
+
+
+def arc(poses, difficulty_of):
+    # Easier poses at the start and the end, the hardest ones in the middle
+    ordered = sorted(poses, key=difficulty_of)
+    return ordered[0::2] + ordered[1::2][::-1]
+
+
+def compose(poses, chakra, duration, difficulty=None, seed=None):
+    """Build a FlowPlan from the poses of the chakra that lasts exactly duration (see duration_seconds)."""
+    budget = duration_seconds(duration) - 2 * BREATH_SECONDS
+    key = (chakra, difficulty, duration)
+    with _lock:
+        memo = _memo.get(key)
+
+    groups = memo and group_by_cost(allowed_poses(poses, memo[0]))
+    if memo is None or any(len(groups.get(cost, ())) < count for cost, count in memo[1].items()):
+        # Not solved yet, or solved for poses that have changed since
+        memo = solve_for_flow(poses, budget, difficulty)
+        groups = group_by_cost(allowed_poses(poses, memo[0]))
+        with _lock:
+            _memo[key] = memo
+    used = memo[1]
+
+    rng = random.Random(seed)
+    selected = []
+    for cost, count in used.items():
+        selected.extend(rng.sample(groups[cost], count))
+    rng.shuffle(selected)
+    selected = arc(selected, lambda pose: difficulty_level(pose['difficulty']))
+
+    holds = [hold_seconds(pose) for pose in selected]
+    stretch(holds, budget - sum(holds) - PAUSE_SECONDS * len(holds))
+    return plan_from_poses(selected, chakra, duration, difficulty, seed, holds=holds)
+
+
+def estimate_seconds(duration, pose_count):
+    """Length of a composed plan for this duration when pose_count poses are eligible. The composer fills the
+    duration exactly unless holding every pose for MAX_HOLD_SECONDS still falls short."""
+    budget = max(0, duration_seconds(duration) - 2 * BREATH_SECONDS)
+    return 2 * BREATH_SECONDS + min(budget, pose_count * (MAX_HOLD_SECONDS + PAUSE_SECONDS))
+
+
+def solve_for_flow(poses, budget, difficulty):
+    # Start with the poses allowed by the flow's difficulty; if they are too few to fill the budget,
+    # allow the next difficulty up
+    cheapest = min((cost for cost in group_by_cost(poses)), default=None)
+    if cheapest is None or cheapest > budget:
+        raise ValueError(f"{budget} seconds after the opening breaths is too short for a pose of this chakra."
+                         if cheapest else "There are no poses matching the chakra.")
+    # A budget too short for MIN_POSES poses (a 10 second flow has room for one) gets as many as fit
+    min_poses = min(MIN_POSES, budget // cheapest)
+    for level in range(difficulty_level(difficulty), len(DIFFICULTIES)):
+        allowed = allowed_poses(poses, level)
+        if len(allowed) < min_poses:
+            continue
+        counts = {cost: len(group) for cost, group in group_by_cost(allowed).items()}
+        used = solve(counts, budget, min_poses)
+        if used and budget - sum(cost * count for cost, count in used.items()) <= slack(used):
+            return level, used
+    raise ValueError(f"There are not enough poses matching the chakra to fill {budget} seconds.")
+
+
+def slack(used):
+    # Seconds the chosen poses can still be stretched by (a lower bound, as if every one had the longest hold).
+    # A pose can have its own hold_seconds above MAX_HOLD_SECONDS, which is never stretched, so this can't go below 0
+    longest = max(used) - PAUSE_SECONDS
+    return sum(used.values()) * max(0, MAX_HOLD_SECONDS - longest)
+
+
+def stretch(holds, seconds):
+    # Spread the seconds the knapsack left over across the holds, one second at a time
+    index = 0
+    while seconds > 0:
+        if holds[index] < MAX_HOLD_SECONDS:
+            holds[index] += 1
+            seconds -= 1
+        index = (index + 1) % len(holds)
+
+
+def clear():
+    with _lock:
+        _memo.clear()
+
+
+def _poses_changed(tables):
+    if not tables or 'poses' in tables:
+        clear()
+
+
+on_invalidate(_poses_changed)
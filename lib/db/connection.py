@@ -0,0 +1,208 @@
+# This file manages the SQLite connections shared by the database models.
+# Connections are kept in a small pool and reused across calls instead of opening a new one for every query,
+# and transaction() groups several writes into a single commit.
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from db import profiler
+from db.constants import SCHEMA_VERSION
+
+DB_FILE = os.environ.get('PY_FLOWS_DB', 'yoga.db')
+
+# Pragmas applied to every new connection
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': -8000,  # negative value is in KiB (~8 MB)
+    'busy_timeout': 5000,  # ms a transaction waits for another connection's write lock
+}
+
+_config = {
+    'db_file': DB_FILE,
+    'pool_size': 4,
+    'cached_statements': 256,
+    'pragmas': dict(PRAGMAS),
+}
+
+BUSY_RETRIES = 2  # Extra attempts to take the write lock once busy_timeout has run out
+
+
+class DatabaseBusy(Exception):
+    """Another connection kept the write lock for longer than the busy timeout."""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+class ConnectionPool:
+    def __init__(self, db_file, size, cached_statements, pragmas):
+        self.db_file = db_file
+        self.size = size
+        self.cached_statements = cached_statements
+        self.pragmas = pragmas
+        self.opened = 0
+        self.upgraded = False
+        self.closed = False  # Set by close(); connections still checked out are closed when they come back
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._all = []
+
+    def _open(self):
+        # isolation_level=None puts the driver in autocommit mode, transactions are started explicitly by transaction()
+        conn = sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=False,
+                               cached_statements=self.cached_statements, factory=profiler.connection_factory())
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        if not self.upgraded:
+            self._upgrade(conn)
+        self._all.append(conn)
+        self.opened += 1
+        return conn
+
+    def _upgrade(self, conn):
+        # A database made by an older version is migrated the first time it is opened
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            from db import seed  # Only needed for old databases
+            seed.upgrade(conn)
+        self.upgraded = True
+
+    def acquire(self):
+        """Returns a connection, or None once the pool has been closed."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self.closed:
+                    return None
+                if self.opened < self.size:
+                    return self._open()
+
+            # Every connection is checked out, wait for one to come back
+            if profiler.is_enabled():
+                profiler.count('connection waits')
+            conn = self._idle.get()
+        if conn is None:
+            self._idle.put(None)  # Pass the wake-up from close() on to the next waiting thread
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            if self.closed:
+                self._all.remove(conn)
+                conn.close()
+                return
+        self._idle.put(conn)
+
+    def close(self):
+        # Only the idle connections are closed here, another thread may still be using the others
+        with self._lock:
+            self.closed = True
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if conn is not None:
+                    self._all.remove(conn)
+                    conn.close()
+            self._idle.put(None)  # Wakes up the threads waiting in acquire()
+
+
+def configure(db_file=None, pool_size=None, cached_statements=None, **pragmas):
+    """Change connection settings. The pool is replaced so the new settings take effect on the next call; its idle
+    connections are closed now and the ones still in use when they are released."""
+    if db_file is not None:
+        _config['db_file'] = db_file
+    if pool_size is not None:
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1.")
+        _config['pool_size'] = pool_size
+    if cached_statements is not None:
+        _config['cached_statements'] = cached_statements
+    _config['pragmas'].update(pragmas)
+    close_all()
+
+
+def get_db_file():
+    return _config['db_file']
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(_config['db_file'], _config['pool_size'],
+                                   _config['cached_statements'], _config['pragmas'])
+        return _pool
+
+
+def close_all():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection. Nested calls on the same thread reuse the connection already checked out."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+
+    conn = None
+    while conn is None:
+        # acquire() gives None when configure() closed the pool in the meantime, the next one is used instead
+        pool = get_pool()
+        conn = pool.acquire()
+    _local.conn = conn
+    _local.tx_depth = 0
+    try:
+        yield conn
+    finally:
+        _local.conn = None
+        pool.release(conn)
+
+
+def begin_immediate(conn):
+    # IMMEDIATE takes the write lock up front. A deferred BEGIN that reads before it writes fails at once with
+    # "database is locked" when another connection writes in between, without waiting out busy_timeout.
+    for attempt in range(BUSY_RETRIES + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as error:
+            if 'locked' not in str(error) and 'busy' not in str(error):
+                raise
+            if profiler.is_enabled():
+                profiler.count('busy retries')
+    raise DatabaseBusy("The database is busy with another write, try again.")
+
+
+@contextmanager
+def transaction():
+    """Unit of work: every write made inside the block (including nested blocks) is committed once at the end."""
+    with connection() as conn:
+        outermost = _local.tx_depth == 0
+        if outermost:
+            begin_immediate(conn)
+        _local.tx_depth += 1
+        try:
+            yield conn
+        except BaseException:
+            _local.tx_depth -= 1
+            if outermost:
+                conn.execute("ROLLBACK")
+            raise
+        _local.tx_depth -= 1
+        if outermost:
+            conn.execute("COMMIT")
@@ -0,0 +1,10 @@
+# Allowed values for the chakra and difficulty columns, and the durations used for generated flow templates
+
+CHAKRAS = ("Root", "Sacral", "Solar Plexus", "Heart", "Throat", "Third Eye", "Crown")
+
+DIFFICULTIES = ("Easy", "Intermediate", "Advanced")
+
+DURATIONS = (10, 20, 30, 40, 50, 60)
+
+# Stored in PRAGMA user_version. A database with a lower version is migrated when it is opened (see seed.upgrade)
+SCHEMA_VERSION = 2  # 2: the catalog lists the poses of a chakra in chakra_poses
@@ -0,0 +1,207 @@
+# This file records generated flows and the practice sessions played from them.
+# generated_flows keeps every plan that was played (the pose ids in order, so it can be replayed), sessions keeps one
+# row per practice, session_poses the poses that were completed and pose_usage a running count per pose.
+# HistoryWriter buffers finished sessions in memory and writes them in batches, so playback never waits on SQLite.
+#
+#     with HistoryWriter() as writer:
+#         Flow.play(plan, writer, user_id="sam", flow_id=3)
+
+import json
+import threading
+import time
+
+from db.cache import invalidate
+from db.connection import transaction
+
+TABLES = ('generated_flows', 'sessions', 'session_poses', 'pose_usage')
+
+CREATE_TABLES = (
+    '''CREATE TABLE IF NOT EXISTS generated_flows (
+           id INTEGER PRIMARY KEY,
+           flow_id INTEGER,
+           user_id TEXT,
+           chakra TEXT NOT NULL,
+           duration INTEGER NOT NULL,
+           difficulty TEXT,
+           seed INTEGER,
+           pose_ids TEXT NOT NULL,
+           created_at REAL NOT NULL,
+           FOREIGN KEY(flow_id) REFERENCES flows(id)
+       )''',
+    '''CREATE TABLE IF NOT EXISTS sessions (
+           id INTEGER PRIMARY KEY,
+           generated_flow_id INTEGER NOT NULL,
+           user_id TEXT,
+           status TEXT NOT NULL,
+           started_at REAL NOT NULL,
+           ended_at REAL NOT NULL,
+           poses_completed INTEGER NOT NULL,
+           FOREIGN KEY(generated_flow_id) REFERENCES generated_flows(id)
+       )''',
+    '''CREATE TABLE IF NOT EXISTS session_poses (
+           session_id INTEGER NOT NULL,
+           position INTEGER NOT NULL,
+           pose_id INTEGER NOT NULL,
+           completed_at REAL NOT NULL,
+           PRIMARY KEY (session_id, position),
+           FOREIGN KEY(session_id) REFERENCES sessions(id)
+       ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS pose_usage (
+           pose_id INTEGER PRIMARY KEY,
+           count INTEGER NOT NULL,
+           last_used_at REAL NOT NULL
+       )''',
+    # Used by History.recent_sessions and History.most_used_poses
+    "CREATE INDEX IF NOT EXISTS idx_sessions_user_started ON sessions (user_id, started_at)",
+    "CREATE INDEX IF NOT EXISTS idx_pose_usage_count ON pose_usage (count)",
+)
+
+BATCH_SIZE = 50
+FLUSH_SECONDS = 5.0
+
+
+def create_tables(cursor):
+    for statement in CREATE_TABLES:
+        cursor.execute(statement)
+
+
+def drop_tables(cursor):
+    for table in TABLES:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+
+
+def insert_generated_flow(cursor, plan, user_id=None, flow_id=None, created_at=None):
+    pose_ids = [segment.pose_id for segment in plan.segments if segment.kind == 'pose']
+    cursor.execute('''INSERT INTO generated_flows
+                      (flow_id, user_id, chakra, duration, difficulty, seed, pose_ids, created_at)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                   (flow_id, user_id, plan.chakra, plan.duration, plan.difficulty, plan.seed,
+                    json.dumps(pose_ids), created_at or time.time()))
+    return cursor.lastrowid
+
+
+class SessionRecord:
+    """Collects the events of one session in memory until it ends."""
+    def __init__(self, writer, plan, user_id=None, flow_id=None):
+        self.writer = writer
+        self.plan = plan
+        self.user_id = user_id
+        self.flow_id = flow_id
+        self.started_at = time.time()
+        self.ended_at = None
+        self.status = None
+        self.poses = []  # (pose_id, completed_at)
+
+    def pose_completed(self, segment):
+        self.poses.append((segment.pose_id, time.time()))
+
+    def finish(self, status='complete'):
+        if self.status is None:
+            self.status = status
+            self.ended_at = time.time()
+            self.writer.add(self)
+
+
+class HistoryWriter:
+    """Writes finished sessions in one transaction per batch_size sessions, or after flush_seconds."""
+    def __init__(self, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS, clock=time.monotonic):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+        self.pending = []
+        self.written = 0
+        self._tables_created = False
+        self._last_flush = clock()
+        self._lock = threading.Lock()
+
+    def start(self, plan, user_id=None, flow_id=None):
+        return SessionRecord(self, plan, user_id, flow_id)
+
+    def add(self, record):
+        with self._lock:
+            self.pending.append(record)
+            due = len(self.pending) >= self.batch_size or self.clock() - self._last_flush >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            records, self.pending = self.pending, []
+            self._last_flush = self.clock()
+        if not records:
+            return 0
+
+        try:
+            self._write(records)
+        except Exception:
+            # Keep the sessions so the next flush tries again
+            with self._lock:
+                self.pending[:0] = records
+            raise
+        invalidate(*TABLES)
+        self.written += len(records)
+        return len(records)
+
+    def _write(self, records):
+        with transaction() as conn:
+            cursor = conn.cursor()
+            if not self._tables_created:
+                # The tables may be missing from a yoga.db created before history was added
+                create_tables(cursor)
+                self._tables_created = True
+            usage = {}
+            for record in records:
+                generated_flow_id = insert_generated_flow(cursor, record.plan, record.user_id, record.flow_id,
+                                                          record.started_at)
+                cursor.execute('''INSERT INTO sessions
+                                  (generated_flow_id, user_id, status, started_at, ended_at, poses_completed)
+                                  VALUES (?, ?, ?, ?, ?, ?)''',
+                               (generated_flow_id, record.user_id, record.status, record.started_at,
+                                record.ended_at, len(record.poses)))
+                session_id = cursor.lastrowid
+                cursor.executemany("INSERT INTO session_poses (session_id, position, pose_id, completed_at) VALUES (?, ?, ?, ?)",
+                                   [(session_id, position, pose_id, completed_at)
+                                    for position, (pose_id, completed_at) in enumerate(record.poses, 1)])
+                for pose_id, completed_at in record.poses:
+                    count, last_used_at = usage.get(pose_id, (0, 0))
+                    usage[pose_id] = (count + 1, max(last_used_at, completed_at))
+
+            # One upsert per pose instead of one per completed pose
+            cursor.executemany('''INSERT INTO pose_usage (pose_id, count, last_used_at) VALUES (?, ?, ?)
+                                  ON CONFLICT(pose_id) DO UPDATE SET count = count + excluded.count,
+                                      last_used_at = MAX(last_used_at, excluded.last_used_at)''',
+                               [(pose_id, count, last_used_at) for pose_id, (count, last_used_at) in usage.items()])
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class HistorySink:
+    """Wraps a player sink and records the session with a HistoryWriter."""
+    def __init__(self, writer, sink, user_id=None, flow_id=None):
+        self.writer = writer
+        self.sink = sink
+        self.user_id = user_id
+        self.flow_id = flow_id
+        self.records = {}  # player session id -> [SessionRecord, current segment]
+
+    def __call__(self, session, event):
+        self.sink(session, event)
+        if session.id not in self.records:
+            self.records[session.id] = [self.writer.start(session.plan, self.user_id, self.flow_id), None]
+        entry = self.records[session.id]
+        record, segment = entry
+
+        if event['type'] == 'segment':
+            entry[1] = event['segment']
+        elif event['type'] == 'tick' and event['remaining'] == 0 and segment is not None and segment.kind == 'pose':
+            record.pose_completed(segment)
+        elif event['type'] in ('complete', 'cancelled'):
+            del self.records[session.id]
+            record.finish(event['type'])
@@ -0,0 +1,98 @@
+# This file holds the chakras and difficulties lookup tables and the checks used on every write.
+# poses and flows store a small integer id (chakra_id, difficulty_id) instead of repeating the name in every row,
+# so the filters are integer comparisons on compact indexes. The ids follow the order of CHAKRAS and DIFFICULTIES,
+# which makes difficulty_id usable for "no harder than" comparisons. Reads join the names back in (POSE_SELECT,
+# FLOW_SELECT), so rows still have chakra and difficulty columns holding the names.
+
+from db.constants import CHAKRAS, DIFFICULTIES
+
+CHAKRA_IDS = {name: number for number, name in enumerate(CHAKRAS, 1)}
+DIFFICULTY_IDS = {name: number for number, name in enumerate(DIFFICULTIES, 1)}
+
+# Input is matched ignoring case and surrounding spaces ("heart " is Heart)
+_chakra_keys = {name.casefold(): name for name in CHAKRAS}
+_difficulty_keys = {name.casefold(): name for name in DIFFICULTIES}
+
+CREATE_TABLES = (
+    '''CREATE TABLE IF NOT EXISTS chakras (
+           id INTEGER PRIMARY KEY,
+           name TEXT NOT NULL UNIQUE
+       )''',
+    '''CREATE TABLE IF NOT EXISTS difficulties (
+           id INTEGER PRIMARY KEY,
+           name TEXT NOT NULL UNIQUE
+       )''',
+)
+
+# Columns of a pose or flow row, in the same order as the old text-column tables
+POSE_SELECT = '''SELECT poses.id, poses.name, chakras.name AS chakra, difficulties.name AS difficulty, poses.hold_seconds
+                 FROM poses JOIN chakras ON chakras.id = poses.chakra_id
+                 JOIN difficulties ON difficulties.id = poses.difficulty_id'''
+
+FLOW_SELECT = '''SELECT flows.id, chakras.name AS chakra, flows.duration, difficulties.name AS difficulty
+                 FROM flows JOIN chakras ON chakras.id = flows.chakra_id
+                 JOIN difficulties ON difficulties.id = flows.difficulty_id'''
+
+
+def create_tables(cursor):
+    for statement in CREATE_TABLES:
+        cursor.execute(statement)
+    cursor.executemany("INSERT OR IGNORE INTO chakras (id, name) VALUES (?, ?)",
+                       [(number, name) for name, number in CHAKRA_IDS.items()])
+    cursor.executemany("INSERT OR IGNORE INTO difficulties (id, name) VALUES (?, ?)",
+                       [(number, name) for name, number in DIFFICULTY_IDS.items()])
+
+
+def drop_tables(cursor):
+    cursor.execute("DROP TABLE IF EXISTS chakras")
+    cursor.execute("DROP TABLE IF EXISTS difficulties")
+
+
+# CHECKS
+
+def chakra_name(value):
+    name = _chakra_keys.get(value.strip().casefold()) if isinstance(value, str) else None
+    if name is None:
+        raise ValueError(f"Unknown chakra {value!r}, use one of {', '.join(CHAKRAS)}.")
+    return name
+
+
+def difficulty_name(value):
+    name = _difficulty_keys.get(value.strip().casefold()) if isinstance(value, str) else None
+    if name is None:
+        raise ValueError(f"Unknown difficulty {value!r}, use one of {', '.join(DIFFICULTIES)}.")
+    return name
+
+
+def chakra_id(value):
+    return CHAKRA_IDS[chakra_name(value)]
+
+
+def difficulty_id(value):
+    return DIFFICULTY_IDS[difficulty_name(value)]
+
+
+def whole_number(value, label):
+    # Strict: 30 is accepted, "30", 30.0 and True are not
+    if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+        raise ValueError(f"{label} must be a positive whole number, got {value!r}.")
+    return value
+
+
+def pose_name(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError("A pose needs a name.")
+    return value.strip()
+
+
+def filter_ids(ids_of, value):
+    """Ids for a filter on names: None stays None (no filter), a name or a list of names becomes ids.
+    Unknown names become 0, which matches no row, so filtering by them finds nothing instead of failing."""
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, set)):
+        return [filter_ids(ids_of, item) for item in value]
+    try:
+        return ids_of(value)
+    except ValueError:
+        return 0
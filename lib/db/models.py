@@ -1,165 +1,611 @@
 # This file defines the structure and behavior of the database models. It contains classes that represent tables or collections in the database schema. 
 
+import json
 import sqlite3
-import random
 import time
-from colorama import init, Fore, Style
-init()
-
-DB_FILE = 'yoga.db'
 
+from db.cache import cached, invalidate
+from db.connection import connection, transaction
+from db.lookup import (FLOW_SELECT, POSE_SELECT, chakra_id, chakra_name, difficulty_id, difficulty_name, filter_ids,
+                       pose_name, whole_number)
+from db.profiler import instrument
+
+PAGE_SIZE = 20
+BATCH_SIZE = 500  # Rows fetched at a time when iterating over a table
+
+
+# Flow templates together with their catalog stats
+FLOW_CATALOG_SELECT = FLOW_SELECT.replace(
+    " FROM flows", """, chakra_catalog.pose_count, chakra_catalog.easy_count, chakra_catalog.intermediate_count,
+                 chakra_catalog.advanced_count, flow_catalog.estimated_seconds
+                 FROM flows""", 1) + """ LEFT JOIN flow_catalog ON flow_catalog.flow_id = flows.id
+                 LEFT JOIN chakra_catalog ON chakra_catalog.chakra_id = flows.chakra_id"""
+
+
+def where_clause(after_id=None, table=None, **filters):
+    # Builds " WHERE ..." from the filters that are set. after_id is used for keyset pagination.
+    # Columns are prefixed with table, which is needed when the lookup tables are joined in.
+    prefix = f"{table}." if table else ""
+    conditions = []
+    params = []
+
+    if after_id is not None:
+        conditions.append(f"{prefix}id > ?")
+        params.append(after_id)
+
+    for column, value in filters.items():
+        if value is not None:
+            conditions.append(f"{prefix}{column} = ?")
+            params.append(value)
+
+    if not conditions:
+        return "", ()
+    return " WHERE " + " AND ".join(conditions), tuple(params)
+
+
+def id_filters(chakra=None, difficulty=None, **filters):
+    # Filters on chakra and difficulty names become filters on the chakra_id and difficulty_id columns
+    return dict(filters, chakra_id=filter_ids(chakra_id, chakra), difficulty_id=filter_ids(difficulty_id, difficulty))
+
+
+def iter_rows(query, params=(), batch_size=BATCH_SIZE):
+    # Yields rows a batch at a time instead of loading the whole result
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+def rank_by_similarity(text, poses, cutoff=0.5):
+    # Orders poses by how close their name is to text and drops the ones below cutoff
+    from difflib import SequenceMatcher
+
+    text = text.lower().strip()
+    scored = []
+    for pose in poses:
+        score = SequenceMatcher(None, text, pose['name'].lower()).ratio()
+        if score >= cutoff:
+            scored.append((score, pose))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return [pose for _, pose in scored]
+
+
+@instrument
 class Pose:
-    def __init__(self, name, difficulty):
-        self.name = name
-        self.difficulty = difficulty
+    def __init__(self, name, chakra, difficulty, hold_seconds=None):
+        # Checks the values and normalises them ("heart " becomes "Heart"), raises ValueError if one is invalid
+        self.name = pose_name(name)
+        self.chakra = chakra_name(chakra)
+        self.difficulty = difficulty_name(difficulty)
+        self.hold_seconds = None if hold_seconds is None else whole_number(hold_seconds, "hold_seconds")
 
     @classmethod
-    def create(cls, name, difficulty):
-        with sqlite3.connect(DB_FILE) as conn:
+    def create(cls, name, chakra, difficulty, hold_seconds=None):
+        # hold_seconds is how long the composer holds the pose (a default for its difficulty when None)
+        from db import catalog, transitions  # Imported here to keep startup fast
+        pose = cls(name, chakra, difficulty, hold_seconds)
+        with transaction() as conn:
             cursor = conn.cursor()
-            cursor.execute("INSERT INTO poses (name, difficulty) VALUES (?, ?)", (name, difficulty))
-            conn.commit()
+            cursor.execute("INSERT INTO poses (name, chakra_id, difficulty_id, hold_seconds) VALUES (?, ?, ?, ?)",
+                           (pose.name, chakra_id(pose.chakra), difficulty_id(pose.difficulty), pose.hold_seconds))
+            pose_id = cursor.lastrowid
+            catalog.add_pose(cursor, pose_id, chakra_id(pose.chakra), difficulty_id(pose.difficulty))
+            transitions.add_pose(cursor, pose_id)
+        invalidate('poses', 'flow_catalog', 'pose_transitions')
+        return pose_id
 
     @classmethod
     def delete(cls, pose_id):
-        with sqlite3.connect(DB_FILE) as conn:
+        from db import catalog, transitions
+        pose_id = int(pose_id)  # The transition graph compares it with row ids
+        with transaction() as conn:
             cursor = conn.cursor()
+            cursor.execute("SELECT chakra_id, difficulty_id FROM poses WHERE id = ?", (pose_id,))
+            old = cursor.fetchone()
+            cursor.execute("DELETE FROM flow_poses WHERE pose_id = ?", (pose_id,))
             cursor.execute("DELETE FROM poses WHERE id = ?", (pose_id,))
-            conn.commit()
+            if old is not None:
+                catalog.remove_pose(cursor, pose_id, *old)
+                transitions.remove_pose(cursor, pose_id, old[0])
+        invalidate('poses', 'flow_poses', 'flow_catalog', 'pose_transitions')
 
     @classmethod
-    def update(cls, pose_id, name=None, chakra=None, difficulty=None):
+    def update(cls, pose_id, name=None, chakra=None, difficulty=None, hold_seconds=None):
+        # Only the given fields change; they are checked like in the constructor
         update_query = "UPDATE poses SET "
         update_params = []
 
         if name is not None:
             update_query += "name = ?, "
-            update_params.append(name)
+            update_params.append(pose_name(name))
 
         if chakra is not None:
-            update_query += "chakra = ?, "
-            update_params.append(chakra)
+            update_query += "chakra_id = ?, "
+            update_params.append(chakra_id(chakra))
         
         if difficulty is not None:
-            update_query += "difficulty = ?, "
-            update_params.append(difficulty)
+            update_query += "difficulty_id = ?, "
+            update_params.append(difficulty_id(difficulty))
+
+        if hold_seconds is not None:
+            update_query += "hold_seconds = ?, "
+            update_params.append(whole_number(hold_seconds, "hold_seconds"))
+
+        if not update_params:
+            raise ValueError("Give at least one of name, chakra, difficulty or hold_seconds to update.")
 
         # Remove the trailing comma and space
         update_query = update_query.rstrip(', ')
 
         update_query += " WHERE id = ?"
+        pose_id = int(pose_id)  # The transition graph compares it with row ids
         update_params.append(pose_id)
 
-        with sqlite3.connect(DB_FILE) as conn:
+        from db import catalog, transitions
+        with transaction() as conn:
             cursor = conn.cursor()
+            cursor.execute("SELECT chakra_id, difficulty_id FROM poses WHERE id = ?", (pose_id,))
+            old = cursor.fetchone()
             cursor.execute(update_query, tuple(update_params))
-            conn.commit()
+            if old is not None and (chakra is not None or difficulty is not None):
+                # The pose moves to another chakra or difficulty count in the catalog
+                catalog.remove_pose(cursor, pose_id, *old)
+                cursor.execute("SELECT chakra_id, difficulty_id FROM poses WHERE id = ?", (pose_id,))
+                catalog.add_pose(cursor, pose_id, *cursor.fetchone())
+            if old is not None and (name is not None or chakra is not None or difficulty is not None):
+                # The pose may belong to other groups now, so its edges are drawn again
+                transitions.remove_pose(cursor, pose_id, old[0])
+                transitions.add_pose(cursor, pose_id)
+        invalidate('poses', 'flow_catalog', 'pose_transitions')
 
     @classmethod
+    @cached('poses')
     def get_all(cls):
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row  
+        with connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM poses")
+            cursor.row_factory = sqlite3.Row  
+            cursor.execute(POSE_SELECT)
             return cursor.fetchall()
 
     @classmethod
+    @cached('poses')
     def find_by_id(cls, pose_id):
-        with sqlite3.connect(DB_FILE) as conn:
+        with connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM poses WHERE id = ?", (pose_id,))
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(POSE_SELECT + " WHERE poses.id = ?", (pose_id,))
             return cursor.fetchone()
 
+    @classmethod
+    def get_many(cls, pose_ids):
+        # Returns the poses with the given ids, in the same order (missing ids are skipped)
+        pose_ids = list(pose_ids)
+        poses_by_id = {}
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            # Stay well below SQLite's limit on the number of query parameters
+            for start in range(0, len(pose_ids), 500):
+                chunk = pose_ids[start:start + 500]
+                placeholders = ", ".join("?" for _ in chunk)
+                cursor.execute(f"{POSE_SELECT} WHERE poses.id IN ({placeholders})", chunk)
+                for row in cursor:
+                    poses_by_id[row['id']] = row
+        return [poses_by_id[pose_id] for pose_id in pose_ids if pose_id in poses_by_id]
+
+    @classmethod
+    @cached('poses')
+    def search(cls, text, limit=10):
+        # Finds poses by name, best matches first. Every word is matched as a prefix ("warr" finds "Warrior");
+        # if that finds fewer than limit poses, close spellings are added from the trigram index.
+        from db.search import prefix_query, trigram_query
+
+        query = prefix_query(text)
+        if not query:
+            return []
+
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            try:
+                cursor.execute(POSE_SELECT + """ JOIN poses_fts ON poses_fts.rowid = poses.id
+                                  WHERE poses_fts MATCH ? ORDER BY poses_fts.rank LIMIT ?""", (query, limit))
+            except sqlite3.OperationalError:
+                # No FTS5 in this SQLite build (or the database was not migrated)
+                cursor.execute(POSE_SELECT + " WHERE poses.name LIKE ? ORDER BY poses.name LIMIT ?",
+                               (f"%{text.strip()}%", limit))
+                return cursor.fetchall()
+            results = cursor.fetchall()
+
+            fuzzy = trigram_query(text)
+            if len(results) < limit and fuzzy:
+                try:
+                    cursor.execute(POSE_SELECT + """ JOIN poses_trigram ON poses_trigram.rowid = poses.id
+                                      WHERE poses_trigram MATCH ? ORDER BY poses_trigram.rank LIMIT ?""",
+                                   (fuzzy, limit * 10))
+                except sqlite3.OperationalError:
+                    # No trigram tokenizer in this SQLite build, so there are no close spellings to add
+                    return results
+                found = {pose['id'] for pose in results}
+                candidates = [pose for pose in cursor.fetchall() if pose['id'] not in found]
+                results.extend(rank_by_similarity(text, candidates)[:limit - len(results)])
+            return results
+
+    # Filter poses (served by the idx_poses_* indexes)
+    @classmethod
+    @cached('poses')
+    def filter(cls, chakra=None, difficulty=None):
+        where, params = where_clause(table='poses', **id_filters(chakra, difficulty))
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(POSE_SELECT + where, params)
+            return cursor.fetchall()
+
+    @classmethod
+    def filter_by_chakra(cls, chakra):
+        return cls.filter(chakra=chakra)
+
+    @classmethod
+    def filter_by_difficulty(cls, difficulty):
+        return cls.filter(difficulty=difficulty)
+
+    # Paging
+    @classmethod
+    def get_page(cls, after_id=0, limit=PAGE_SIZE, chakra=None, difficulty=None):
+        # Returns the next limit poses with an id greater than after_id
+        where, params = where_clause(after_id, 'poses', **id_filters(chakra, difficulty))
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(POSE_SELECT + where + " ORDER BY poses.id LIMIT ?", params + (limit,))
+            return cursor.fetchall()
 
+    @classmethod
+    def iter_all(cls, batch_size=BATCH_SIZE, chakra=None, difficulty=None):
+        where, params = where_clause(table='poses', **id_filters(chakra, difficulty))
+        return iter_rows(POSE_SELECT + where + " ORDER BY poses.id", params, batch_size)
+
+
+@instrument
 class FlowPose:
     @classmethod
-    def create(cls, flow_id, pose_id):
-        with sqlite3.connect(DB_FILE) as conn:
+    def create(cls, flow_id, pose_id, position=None):
+        with transaction() as conn:
             cursor = conn.cursor()
-            cursor.execute("INSERT INTO flow_pose (flow_id, pose_id) VALUES (?, ?)", (flow_id, pose_id))
-            conn.commit()
+            if position is None:
+                # Add the pose to the end of the flow
+                cursor.execute("SELECT COALESCE(MAX(position), 0) + 1 FROM flow_poses WHERE flow_id = ?", (flow_id,))
+                position = cursor.fetchone()[0]
+            cursor.execute("INSERT INTO flow_poses (flow_id, pose_id, position) VALUES (?, ?, ?)", (flow_id, pose_id, position))
+        invalidate('flow_poses')
 
     @classmethod
     def delete(cls, flow_id, pose_id):
-        with sqlite3.connect(DB_FILE) as conn:
+        with transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM flow_poses WHERE flow_id = ? AND pose_id = ?", (flow_id, pose_id))
+        invalidate('flow_poses')
+
+    @classmethod
+    def set_poses_for_flow(cls, flow_id, pose_ids):
+        # Replaces the poses of a flow, in the given order
+        with transaction() as conn:
             cursor = conn.cursor()
-            cursor.execute("DELETE FROM flow_pose WHERE flow_id = ? AND pose_id = ?", (flow_id, pose_id))
-            conn.commit()
+            cursor.execute("DELETE FROM flow_poses WHERE flow_id = ?", (flow_id,))
+            cursor.executemany("INSERT INTO flow_poses (flow_id, pose_id, position) VALUES (?, ?, ?)",
+                               [(flow_id, pose_id, position) for position, pose_id in enumerate(pose_ids, 1)])
+        invalidate('flow_poses')
 
     @classmethod
+    @cached('flows', 'poses', 'flow_poses')
     def get_poses_for_flow(cls, flow_id):
-        with sqlite3.connect(DB_FILE) as conn:
+        with connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT poses.* FROM poses JOIN flow_pose ON poses.id = flow_pose.pose_id WHERE flow_pose.flow_id = ?", (flow_id,))
+            cursor.execute(POSE_SELECT + " JOIN flow_poses ON poses.id = flow_poses.pose_id WHERE flow_poses.flow_id = ? ORDER BY flow_poses.position", (flow_id,))
             return cursor.fetchall()
 
     @classmethod
+    def get_poses_for_flows(cls, flow_ids):
+        # Fetches the poses of many flows in one query, returns {flow_id: [pose rows in order]}
+        flow_ids = list(flow_ids)
+        poses_by_flow = {flow_id: [] for flow_id in flow_ids}
+        if not flow_ids:
+            return poses_by_flow
+
+        placeholders = ", ".join("?" for _ in flow_ids)
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(f"""SELECT flow_poses.flow_id, flow_poses.position, poses.id, poses.name,
+                                      chakras.name AS chakra, difficulties.name AS difficulty, poses.hold_seconds
+                               FROM flow_poses JOIN poses ON poses.id = flow_poses.pose_id
+                               JOIN chakras ON chakras.id = poses.chakra_id
+                               JOIN difficulties ON difficulties.id = poses.difficulty_id
+                               WHERE flow_poses.flow_id IN ({placeholders})
+                               ORDER BY flow_poses.flow_id, flow_poses.position""", flow_ids)
+            for row in cursor:
+                poses_by_flow.setdefault(row['flow_id'], []).append(row)
+        return poses_by_flow
+
+    @classmethod
+    @cached('flows', 'poses', 'flow_poses')
     def get_flows_for_pose(cls, pose_id):
-        with sqlite3.connect(DB_FILE) as conn:
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(FLOW_SELECT + " JOIN flow_poses ON flows.id = flow_poses.flow_id WHERE flow_poses.pose_id = ?", (pose_id,))
+            return cursor.fetchall()
+
+
+@instrument
+class FlowCatalog:
+    # Read side of the catalog tables (see catalog.py), which are kept up to date by the Pose and Flow writes
+    @classmethod
+    @cached('flow_catalog')
+    def find_by_flow_id(cls, flow_id):
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute("""SELECT flow_catalog.flow_id, chakra_catalog.pose_count, chakra_catalog.easy_count,
+                                     chakra_catalog.intermediate_count, chakra_catalog.advanced_count,
+                                     flow_catalog.estimated_seconds
+                              FROM flow_catalog JOIN flows ON flows.id = flow_catalog.flow_id
+                              JOIN chakra_catalog ON chakra_catalog.chakra_id = flows.chakra_id
+                              WHERE flow_catalog.flow_id = ?""", (flow_id,))
+            return cursor.fetchone()
+
+    @classmethod
+    @cached('flow_catalog')
+    def eligible_pose_ids(cls, flow_id):
+        # Returns None if the flow is not in the catalog. The ids come in order from the chakra_poses primary key.
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT chakra_id FROM flows JOIN flow_catalog ON flow_catalog.flow_id = flows.id "
+                           "WHERE flows.id = ?", (flow_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute("SELECT pose_id FROM chakra_poses WHERE chakra_id = ?", (row[0],))
+            return [pose_id for pose_id, in cursor.fetchall()]
+
+    @classmethod
+    @cached('flow_catalog', 'poses')
+    def eligible_poses(cls, flow_id):
+        # The pose rows of eligible_pose_ids(), which is what the composer picks from
+        pose_ids = cls.eligible_pose_ids(flow_id)
+        return None if pose_ids is None else Pose.get_many(pose_ids)
+
+    @classmethod
+    def get_page(cls, after_id=0, limit=PAGE_SIZE, chakra=None, duration=None, difficulty=None):
+        # Flow templates together with their catalog stats
+        where, params = where_clause(after_id, 'flows', **id_filters(chakra, difficulty, duration=duration))
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(FLOW_CATALOG_SELECT + where + " ORDER BY flows.id LIMIT ?", params + (limit,))
+            return cursor.fetchall()
+
+
+@instrument
+class History:
+    # Read side of the history tables (see history.py), which are written in batches by HistoryWriter
+    @classmethod
+    @cached('sessions', 'generated_flows')
+    def recent_sessions(cls, user_id, limit=10):
+        # Newest first, uses idx_sessions_user_started
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute("""SELECT sessions.*, generated_flows.flow_id, generated_flows.chakra,
+                                     generated_flows.duration, generated_flows.difficulty
+                              FROM sessions JOIN generated_flows ON generated_flows.id = sessions.generated_flow_id
+                              WHERE sessions.user_id IS ? ORDER BY sessions.started_at DESC LIMIT ?""",
+                           (user_id, limit))
+            return cursor.fetchall()
+
+    @classmethod
+    @cached('pose_usage', 'poses')
+    def most_used_poses(cls, limit=10):
+        # Walks idx_pose_usage_count from the top, so only `limit` rows are read
+        with connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT flows.* FROM flows JOIN flow_pose ON flows.id = flow_pose.flow_id WHERE flow_pose.pose_id = ?", (pose_id,))
+            cursor.row_factory = sqlite3.Row
+            cursor.execute("""SELECT poses.id, poses.name, chakras.name AS chakra, difficulties.name AS difficulty,
+                                     poses.hold_seconds, pose_usage.count, pose_usage.last_used_at
+                              FROM pose_usage JOIN poses ON poses.id = pose_usage.pose_id
+                              JOIN chakras ON chakras.id = poses.chakra_id
+                              JOIN difficulties ON difficulties.id = poses.difficulty_id
+                              ORDER BY pose_usage.count DESC LIMIT ?""", (limit,))
             return cursor.fetchall()
 
+    @classmethod
+    @cached('session_poses')
+    def session_pose_ids(cls, session_id):
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT pose_id FROM session_poses WHERE session_id = ? ORDER BY position", (session_id,))
+            return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def recent_pose_ids(cls, user_id, sessions=1):
+        # Poses of the user's last sessions, e.g. to avoid repeating yesterday's sequence
+        pose_ids = set()
+        for session in cls.recent_sessions(user_id, sessions):
+            pose_ids.update(cls.session_pose_ids(session['id']))
+        return pose_ids
+
+    @classmethod
+    @cached('generated_flows')
+    def find_generated_flow(cls, generated_flow_id):
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute("SELECT * FROM generated_flows WHERE id = ?", (generated_flow_id,))
+            return cursor.fetchone()
+
+    @classmethod
+    def replay(cls, generated_flow_id):
+        # Rebuilds the plan of a generated flow with the same poses in the same order (None if it doesn't exist)
+        from db.plan import plan_from_poses
+        generated = cls.find_generated_flow(generated_flow_id)
+        if generated is None:
+            return None
+        poses = Pose.get_many(json.loads(generated['pose_ids']))
+        return plan_from_poses(poses, generated['chakra'], generated['duration'], generated['difficulty'], generated['seed'])
+
 
+@instrument
 class Flow:
     def __init__(self, chakra, duration, difficulty):
-        self.chakra = chakra
-        self.duration = duration
-        self.difficulty = difficulty
+        # Checks the values like Pose does; duration must be an int (the CLI converts what is typed)
+        # and long enough for at least one pose
+        from db.plan import check_duration
+        self.chakra = chakra_name(chakra)
+        self.duration = check_duration(whole_number(duration, "duration"))
+        self.difficulty = difficulty_name(difficulty)
 
     @classmethod
     def create(cls, chakra, duration, difficulty):
-        with sqlite3.connect(DB_FILE) as conn:
+        from db import catalog
+        flow = cls(chakra, duration, difficulty)
+        with transaction() as conn:
             cursor = conn.cursor()
-            cursor.execute("INSERT INTO flows (chakra, duration, difficulty) VALUES (?,?,?)",
-                           (chakra, duration, difficulty))
-            conn.commit()
+            cursor.execute("INSERT INTO flows (chakra_id, duration, difficulty_id) VALUES (?,?,?)",
+                           (chakra_id(flow.chakra), flow.duration, difficulty_id(flow.difficulty)))
+            flow_id = cursor.lastrowid
+            catalog.add_flow(cursor, flow_id, chakra_id(flow.chakra), flow.duration)
+        invalidate('flows', 'flow_catalog')
+        return flow_id
     
     @classmethod
     def delete(cls, flow_id):
-        with sqlite3.connect(DB_FILE) as conn:
+        from db import catalog
+        with transaction() as conn:
             cursor = conn.cursor()
+            cursor.execute("DELETE FROM flow_poses WHERE flow_id = ?", (flow_id,))
             cursor.execute("DELETE FROM flows WHERE id = ?", (flow_id,))
-            conn.commit()
+            catalog.remove_flow(cursor, flow_id)
+        invalidate('flows', 'flow_poses', 'flow_catalog')
         
     @classmethod
+    @cached('flows')
     def get_all(cls):
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row  # Access columns by name
+        with connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT id, chakra, duration, difficulty FROM flows")
+            cursor.row_factory = sqlite3.Row  # Access columns by name
+            cursor.execute(FLOW_SELECT)
             return cursor.fetchall()
 
     @classmethod
+    @cached('flows')
     def find_by_id(cls, flow_id):
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row 
+        with connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM flows WHERE id = ?", (flow_id,))
+            cursor.row_factory = sqlite3.Row 
+            cursor.execute(FLOW_SELECT + " WHERE flows.id = ?", (flow_id,))
             return cursor.fetchone()
     
     # Filter flow templates
     @classmethod
+    @cached('flows')
     def filter_by_chakra(cls, chakra):
-        with sqlite3.connect(DB_FILE) as conn:
+        with connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM flows WHERE chakra = ?", (chakra,))
+            cursor.execute(FLOW_SELECT + " WHERE flows.chakra_id = ?", (filter_ids(chakra_id, chakra),))
             return cursor.fetchall()
 
     @classmethod
+    @cached('flows')
     def filter_by_duration(cls, duration):
-        with sqlite3.connect(DB_FILE) as conn:
+        with connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM flows WHERE duration = ?", (duration,))
+            cursor.execute(FLOW_SELECT + " WHERE flows.duration = ?", (duration,))
             return cursor.fetchall()
 
     @classmethod
+    @cached('flows')
     def filter_by_difficulty(cls, difficulty):
-        with sqlite3.connect(DB_FILE) as conn:
+        with connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM flows WHERE difficulty = ?", (difficulty,))
+            cursor.execute(FLOW_SELECT + " WHERE flows.difficulty_id = ?", (filter_ids(difficulty_id, difficulty),))
             return cursor.fetchall()
 
+    # Multi-criteria search. Chakras sort in the order of CHAKRAS (Root first) and difficulties from Easy to Advanced.
+    SORT_COLUMNS = {'id': 'id', 'chakra': 'chakra_id', 'duration': 'duration', 'difficulty': 'difficulty_id'}
+
+    @classmethod
+    def search(cls, chakra=None, difficulty=None, duration=None, min_duration=None, max_duration=None,
+               sort='id', limit=None, offset=0):
+        # chakra, difficulty and duration take a single value or a list of values. The duration range is inclusive.
+        # sort is a column name, prefixed with '-' for descending order. Everything runs as one query
+        # (served by idx_flows_chakra_difficulty_duration) and rows include the flow catalog stats.
+        conditions = []
+        params = []
+
+        filters = id_filters(chakra, difficulty, duration=duration)
+        for column, value in filters.items():
+            if value is None:
+                continue
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            if not values:
+                continue
+            conditions.append(f"flows.{column} IN ({', '.join('?' for _ in values)})")
+            params.extend(values)
+
+        if min_duration is not None:
+            conditions.append("flows.duration >= ?")
+            params.append(min_duration)
+
+        if max_duration is not None:
+            conditions.append("flows.duration <= ?")
+            params.append(max_duration)
+
+        descending = sort.startswith('-')
+        sort_column = sort.lstrip('-')
+        if sort_column not in cls.SORT_COLUMNS:
+            raise ValueError(f"Can't sort by '{sort}', use one of {', '.join(cls.SORT_COLUMNS)}.")
+
+        query = FLOW_CATALOG_SELECT
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += f" ORDER BY flows.{cls.SORT_COLUMNS[sort_column]} {'DESC' if descending else 'ASC'}"
+        if sort_column != 'id':
+            query += ", flows.id"  # Stable order for paging
+        if limit is not None or offset:
+            query += " LIMIT ? OFFSET ?"
+            params.extend([-1 if limit is None else limit, offset])
+
+        return cls.run_search(query, tuple(params))
+
+    @classmethod
+    @cached('flows', 'flow_catalog')
+    def run_search(cls, query, params):
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    # Paging
+    @classmethod
+    def get_page(cls, after_id=0, limit=PAGE_SIZE, chakra=None, duration=None, difficulty=None):
+        # Returns the next limit flows with an id greater than after_id
+        where, params = where_clause(after_id, 'flows', **id_filters(chakra, difficulty, duration=duration))
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(FLOW_SELECT + where + " ORDER BY flows.id LIMIT ?", params + (limit,))
+            return cursor.fetchall()
+
+    @classmethod
+    def iter_all(cls, batch_size=BATCH_SIZE, chakra=None, duration=None, difficulty=None):
+        where, params = where_clause(table='flows', **id_filters(chakra, difficulty, duration=duration))
+        return iter_rows(FLOW_SELECT + where + " ORDER BY flows.id", params, batch_size)
+
     @classmethod
     def countdown_timer(cls, message, duration):
         for remaining in range(duration, 0, -1):
@@ -172,37 +618,112 @@ class Flow:
         print("\033[K", end="\r")
 
     @classmethod
-    def generate_flow_with_timers(cls, chakra, duration_minutes):
-        # CHANGED DURATION FOR TESTING
-        duration_seconds = duration_minutes # * 60
+    def plan(cls, chakra, duration, difficulty=None, seed=None):
+        # Builds the sequence of breaths and poses without playing it
+        from db import snapshot  # Imported here to keep startup fast
+        if snapshot.is_enabled():
+            return snapshot.get_pose_index().plan(chakra, duration, difficulty, seed)
+
+        from db.plan import build_plan
+        matching_poses = Pose.filter_by_chakra(chakra)
+        return build_plan(matching_poses, chakra, duration, difficulty, seed)
 
-        # Get all poses that match the specified chakra
-        poses = Pose.get_all()
-        matching_poses = [pose for pose in poses if pose[2] == chakra]
-        # Makes sure there are enough matching poses
-        if len(matching_poses) < 3:
+    @classmethod
+    def plan_for_flow(cls, flow_id, seed=None):
+        # Builds a plan for a flow template from the poses listed for it in the flow catalog.
+        # Only the ids are sampled; just the selected poses are loaded. Returns None if the flow doesn't exist.
+        from db import snapshot
+        from db.plan import MIN_POSES, plan_from_poses, poses_needed
+        from db.sampler import PoseSampler
+
+        flow = cls.find_by_id(flow_id)
+        if flow is None:
+            return None
+        if snapshot.is_enabled():
+            # The eligible poses of a flow are the poses with its chakra, which the snapshot keeps in a bucket
+            return cls.plan(flow['chakra'], flow['duration'], flow['difficulty'], seed)
+
+        pose_ids = FlowCatalog.eligible_pose_ids(flow['id'])
+        if pose_ids is None:
+            # Not in the catalog (e.g. an old database that was not migrated)
+            return cls.plan(flow['chakra'], flow['duration'], flow['difficulty'], seed)
+        if len(pose_ids) < MIN_POSES:
             raise ValueError("There are not enough poses matching the chakra.")
 
-        # Initial round of breath
-        print("Inhale\n")     
-        cls.countdown_timer("Remaining Time", 3)
-        print("\nExhale\n")
-        cls.countdown_timer("Remaining Time", 3)
-
-        total_time = 0
-
-        # Iterate over selected poses
-        while total_time < duration_seconds:
-            if not matching_poses:
-                break  # If no poses left, exit loop
-            selected_pose = random.choice(matching_poses)
-            print(f"Pose: {selected_pose['name']}\n")
-            matching_poses.remove(selected_pose)  # Remove selected pose
-            cls.countdown_timer("Remaining Time", 3)
-            total_time += 4  # Pose duration is 3 seconds plus 1 second pause
-            time.sleep(1)  # Pause for 1 second between poses
+        selected = PoseSampler(pose_ids, seed=seed).sample(poses_needed(flow['duration']))
+        return plan_from_poses(Pose.get_many(selected), flow['chakra'], flow['duration'], flow['difficulty'], seed)
+
+    @classmethod
+    def compose(cls, chakra, duration, difficulty=None, seed=None):
+        # Builds a plan that lasts exactly the duration, from poses no harder than difficulty (see composer.py)
+        from db.composer import compose
+        return compose(Pose.filter_by_chakra(chakra), chakra, duration, difficulty, seed)
+
+    @classmethod
+    def compose_for_flow(cls, flow_id, seed=None):
+        # Composes from the poses the flow catalog lists for the flow. Returns None if the flow doesn't exist.
+        from db.composer import compose
+
+        flow = cls.find_by_id(flow_id)
+        if flow is None:
+            return None
+        poses = FlowCatalog.eligible_poses(flow_id)
+        if poses is None:
+            # Not in the catalog (e.g. an old database that was not migrated)
+            poses = Pose.filter_by_chakra(flow['chakra'])
+        return compose(poses, flow['chakra'], flow['duration'], flow['difficulty'], seed)
+
+    @classmethod
+    def walk(cls, chakra, duration, difficulty=None, seed=None):
+        # Builds a plan whose poses follow each other along the pose transition graph (see transitions.py)
+        from db import transitions
+        from db.composer import difficulty_level
+        from db.plan import MIN_POSES, plan_from_poses, poses_needed
+
+        graph = transitions.get_graph(chakra)
+        level = difficulty_level(difficulty)
+        if len(graph.nodes.get(level, ())) < MIN_POSES:
+            level = None  # Too few poses up to this difficulty, use them all
+        pose_ids = graph.walk(poses_needed(duration), seed, level)
+        if len(pose_ids) < MIN_POSES:
+            raise ValueError("There are not enough poses matching the chakra.")
+        return plan_from_poses(Pose.get_many(pose_ids), chakra, duration, difficulty, seed)
+
+    @classmethod
+    def walk_for_flow(cls, flow_id, seed=None):
+        # Returns None if the flow doesn't exist
+        flow = cls.find_by_id(flow_id)
+        if flow is None:
+            return None
+        return cls.walk(flow['chakra'], flow['duration'], flow['difficulty'], seed)
+
+    @classmethod
+    def play(cls, plan, writer=None, user_id=None, flow_id=None):
+        # With a HistoryWriter (see history.py) the session is recorded, and written in the writer's next batch
+        record = writer.start(plan, user_id, flow_id) if writer is not None else None
+        try:
+            for segment in plan.segments:
+                if segment.kind == 'breath':
+                    print(f"{segment.name}\n")
+                else:
+                    print(f"Pose: {segment.name}\n")
+                cls.countdown_timer("Remaining Time", segment.seconds)
+                if record is not None and segment.kind == 'pose':
+                    record.pose_completed(segment)
+                if segment.pause:
+                    time.sleep(segment.pause)  # Pause between poses
+        except KeyboardInterrupt:
+            if record is not None:
+                record.finish('cancelled')
+            raise
+        if record is not None:
+            record.finish('complete')
 
         print("\nYou have completed your practice!!\n")
         time.sleep(1)
         print("Namaste\n")
-        time.sleep(3)
\ No newline at end of file
+        time.sleep(3)
+
+    @classmethod
+    def generate_flow_with_timers(cls, chakra, duration_minutes, seed=None):
+        cls.play(cls.compose(chakra, duration_minutes, seed=seed))
@@ -0,0 +1,68 @@
+# This file builds flow plans: the ordered list of breaths and poses that make up a practice.
+# Building a plan never sleeps or prints, so plans can be generated (and cached) instantly.
+# Playing a plan with timers is done separately by Flow.play.
+
+from collections import namedtuple
+
+from db.sampler import PoseSampler
+
+BREATH_SECONDS = 3
+POSE_SECONDS = 3
+PAUSE_SECONDS = 1  # Pause between poses
+MIN_POSES = 3
+
+# One step of the practice. kind is 'breath' or 'pose', pose_id is None for breaths.
+Segment = namedtuple('Segment', ['kind', 'name', 'seconds', 'pause', 'pose_id'])
+
+FlowPlan = namedtuple('FlowPlan', ['chakra', 'duration', 'difficulty', 'seed', 'segments', 'total_seconds'])
+
+
+def duration_seconds(duration):
+    # CHANGED DURATION FOR TESTING
+    return duration # * 60
+
+
+def check_duration(duration):
+    """Raise ValueError if a flow of this duration has no room for a single pose after the opening breaths."""
+    needed = 2 * BREATH_SECONDS + POSE_SECONDS + PAUSE_SECONDS
+    if duration_seconds(duration) < needed:
+        raise ValueError(f"A flow of {duration} is too short, it needs {needed} seconds for the breaths and one pose.")
+    return duration
+
+
+def poses_needed(duration):
+    """Number of poses it takes to fill the duration (each pose is followed by a pause)."""
+    seconds = duration_seconds(duration)
+    return max(0, -(-seconds // (POSE_SECONDS + PAUSE_SECONDS)))
+
+
+def build_plan(poses, chakra, duration, difficulty=None, seed=None):
+    """Build a FlowPlan from the poses matching the chakra. The same poses and seed always give the same plan."""
+    if len(poses) < MIN_POSES:
+        raise ValueError("There are not enough poses matching the chakra.")
+
+    # Each pose is only picked once
+    selected = PoseSampler(poses, seed=seed).sample(poses_needed(duration))
+    return plan_from_poses(selected, chakra, duration, difficulty, seed)
+
+
+def plan_from_poses(poses, chakra, duration, difficulty=None, seed=None, holds=None):
+    """Build a FlowPlan that uses the given poses in the given order.
+    holds are the seconds each pose is held for (POSE_SECONDS for every pose by default)."""
+    if holds is None:
+        holds = [POSE_SECONDS] * len(poses)
+    # Initial round of breath
+    segments = [
+        Segment('breath', 'Inhale', BREATH_SECONDS, 0, None),
+        Segment('breath', 'Exhale', BREATH_SECONDS, 0, None),
+    ]
+    segments.extend(Segment('pose', pose['name'], hold, PAUSE_SECONDS, pose['id']) for pose, hold in zip(poses, holds))
+
+    total_seconds = sum(segment.seconds + segment.pause for segment in segments)
+    return FlowPlan(chakra, duration, difficulty, seed, tuple(segments), total_seconds)
+
+
+def plan_to_dict(plan):
+    data = plan._asdict()
+    data['segments'] = [segment._asdict() for segment in plan.segments]
+    return data
@@ -0,0 +1,147 @@
+# This file plays flow plans with asyncio so one process can guide many practice sessions at once.
+# Every tick is scheduled against a monotonic clock from the start of the session, so timing does not drift
+# the way a chain of time.sleep(1) calls does. Output goes to a sink instead of straight to stdout.
+
+import asyncio
+import itertools
+import math
+import time
+
+
+# SINKS
+# A sink is any callable taking (session, event). Events are dicts with a 'type' key:
+#   segment  - a breath or pose starts ('segment' holds the Segment)
+#   tick     - countdown update ('remaining' seconds left in the segment)
+#   complete - the practice is over
+#   cancelled
+
+def print_sink(session, event):
+    """Writes the same output as Flow.play."""
+    if event['type'] == 'segment':
+        segment = event['segment']
+        if segment.kind == 'breath':
+            print(f"{segment.name}\n")
+        else:
+            print(f"Pose: {segment.name}\n")
+    elif event['type'] == 'tick':
+        if event['remaining']:
+            print(f"Remaining Time: {event['remaining']}", end="\r")
+        else:
+            print("\033[K", end="\r")
+    elif event['type'] == 'complete':
+        print("\nYou have completed your practice!!\n")
+        print("Namaste\n")
+
+
+class ListSink:
+    """Keeps every event in memory, handy for inspecting a session afterwards."""
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, session, event):
+        self.events.append(event)
+
+
+def null_sink(session, event):
+    pass
+
+
+class Session:
+    _ids = itertools.count(1)
+
+    def __init__(self, plan, sink=print_sink, tick_seconds=1.0, clock=time.monotonic):
+        # A nan, infinite or non-positive tick would make _wait_until spin without ever sleeping
+        if not (math.isfinite(tick_seconds) and tick_seconds > 0):
+            raise ValueError("tick_seconds must be a positive number of seconds.")
+        self.id = next(self._ids)
+        self.plan = plan
+        self.sink = sink
+        self.tick_seconds = tick_seconds  # Length of one countdown second, lower it to speed a session up
+        self.clock = clock
+        self.task = None
+        self.max_lag = 0.0  # Largest delay seen between a tick's deadline and when it fired
+        self._running = asyncio.Event()
+        self._running.set()
+        self._paused_at = None
+        self._start = None
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def pause(self):
+        if not self.paused:
+            self._paused_at = self.clock()
+            self._running.clear()
+
+    def resume(self):
+        if self.paused:
+            # Shift the schedule by the time spent paused. A session paused before it ran has no schedule yet,
+            # run() starts it on resume.
+            if self._start is not None:
+                self._start += self.clock() - self._paused_at
+            self._paused_at = None
+            self._running.set()
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _wait_until(self, offset):
+        while True:
+            await self._running.wait()
+            delay = self._start + offset * self.tick_seconds - self.clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # A pause during the sleep moves the deadline, so check again
+            if not self.paused and self._start + offset * self.tick_seconds <= self.clock():
+                self.max_lag = max(self.max_lag, self.clock() - (self._start + offset * self.tick_seconds))
+                return
+
+    async def run(self):
+        offset = 0  # Seconds into the practice, in plan time
+        try:
+            await self._running.wait()
+            self._start = self.clock()
+            for segment in self.plan.segments:
+                self.sink(self, {'type': 'segment', 'segment': segment})
+                for remaining in range(segment.seconds, 0, -1):
+                    self.sink(self, {'type': 'tick', 'remaining': remaining})
+                    offset += 1
+                    await self._wait_until(offset)
+                self.sink(self, {'type': 'tick', 'remaining': 0})
+                if segment.pause:
+                    offset += segment.pause
+                    await self._wait_until(offset)
+        except asyncio.CancelledError:
+            self.sink(self, {'type': 'cancelled'})
+            raise
+        self.sink(self, {'type': 'complete'})
+
+
+class SessionPlayer:
+    """Runs any number of sessions on the current event loop."""
+    def __init__(self):
+        self.sessions = {}
+
+    def start(self, plan, sink=print_sink, tick_seconds=1.0):
+        session = Session(plan, sink, tick_seconds)
+        session.task = asyncio.get_running_loop().create_task(session.run())
+        session.task.add_done_callback(lambda task: self.sessions.pop(session.id, None))
+        self.sessions[session.id] = session
+        return session
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    async def wait(self):
+        tasks = [session.task for session in self.sessions.values()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def play_async(plan, sink=print_sink, tick_seconds=1.0):
+    """Play a single plan without blocking the event loop."""
+    session = Session(plan, sink, tick_seconds)
+    session.task = asyncio.current_task()
+    await session.run()
+    return session
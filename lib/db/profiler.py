@@ -0,0 +1,282 @@
+# This file contains the optional profiler for the database layer. It is off by default; turn it on with
+# profiler.configure(enabled=True) or by setting PY_FLOWS_PROFILE=1.
+#
+# When it is on it records, per model method and per SQL statement, a latency histogram and the number of rows
+# returned, counts opened and waited-for connections, and keeps the slowest statements together with their
+# EXPLAIN QUERY PLAN. summary() returns everything as a dict and format_summary() as a table.
+# When it is off, connections are plain sqlite3 connections and model methods are not wrapped at all.
+
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+_config = {
+    'enabled': os.environ.get('PY_FLOWS_PROFILE', '') not in ('', '0'),
+    'slow_ms': 50.0,  # Statements slower than this are logged with their query plan
+}
+
+_lock = threading.Lock()
+_methods = {}  # name -> Histogram
+_queries = {}  # sql -> Histogram
+_counters = {}
+_slow_queries = deque(maxlen=50)
+_instrumented = []  # (class, name, plain classmethod, timed classmethod)
+
+
+class Histogram:
+    """Latency histogram with power-of-two buckets in microseconds, plus call and row counts."""
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}  # bucket -> count, bucket b holds calls of less than 2 ** b microseconds
+
+    def add(self, seconds, rows=0):
+        self.calls += 1
+        self.rows += rows
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of calls, in ms."""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= fraction * self.calls:
+                return min(2 ** bucket / 1000, self.max * 1000)
+        return 0.0
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'rows': self.rows,
+            'total_ms': self.total * 1000,
+            'mean_ms': self.total * 1000 / self.calls if self.calls else 0.0,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.max * 1000,
+        }
+
+
+def is_enabled():
+    return _config['enabled']
+
+
+def configure(enabled=None, slow_ms=None):
+    """Change the settings. Connections opened before the change are closed so they pick it up."""
+    if slow_ms is not None:
+        _config['slow_ms'] = slow_ms
+    if enabled is not None and enabled != _config['enabled']:
+        _config['enabled'] = enabled
+        for cls, name, plain, timed_method in _instrumented:
+            setattr(cls, name, timed_method if enabled else plain)
+        from db.connection import close_all
+        close_all()
+
+
+def reset():
+    with _lock:
+        _methods.clear()
+        _queries.clear()
+        _counters.clear()
+        _slow_queries.clear()
+
+
+def count(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def record(table, key, seconds, rows=0):
+    with _lock:
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram()
+        histogram.add(seconds, rows)
+
+
+def row_count(value):
+    if isinstance(value, (list, tuple)) and not hasattr(value, '_fields'):
+        return len(value)
+    return 0 if value is None else 1
+
+
+# MODEL METHODS
+
+def timed(name):
+    """Record the latency of every call of the decorated function under name when the profiler is on."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _config['enabled']:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                value = func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+            record(_methods, name, elapsed, row_count(value))
+            return value
+        return wrapper
+    return decorator
+
+
+def instrument(cls):
+    """Class decorator: time every public classmethod of a model as 'Class.method'.
+    The timed versions are only installed while the profiler is on, so a disabled profiler costs nothing."""
+    for name, attr in list(vars(cls).items()):
+        if isinstance(attr, classmethod) and not name.startswith('_'):
+            timed_method = classmethod(timed(f"{cls.__name__}.{name}")(attr.__func__))
+            _instrumented.append((cls, name, attr, timed_method))
+            if _config['enabled']:
+                setattr(cls, name, timed_method)
+    return cls
+
+
+# SQL STATEMENTS
+
+class ProfilingCursor(sqlite3.Cursor):
+    # A statement is timed from execute() until its rows are used up (or the cursor moves on or is closed)
+    _sql = None
+
+    def _finish(self):
+        if self._sql is not None:
+            elapsed = time.perf_counter() - self._start
+            rows = self._rows if self._rows else max(self.rowcount, 0)
+            record(_queries, self._sql, elapsed, rows)
+            if elapsed * 1000 >= _config['slow_ms']:
+                self._log_slow(elapsed)
+            self._sql = None
+
+    def _log_slow(self, elapsed):
+        try:
+            explain = sqlite3.Cursor(self.connection)
+            explain.execute("EXPLAIN QUERY PLAN " + self._sql, self._params)
+            plan = [row[-1] for row in explain.fetchall()]
+        except sqlite3.Error:
+            plan = []
+        with _lock:
+            _slow_queries.append({'sql': self._sql, 'ms': elapsed * 1000, 'plan': plan})
+        import logging  # Only needed once a slow query is seen
+        logging.getLogger('py_flows.profiler').warning("Slow query (%.1f ms): %s%s", elapsed * 1000, self._sql,
+                                                       "".join("\n  " + step for step in plan))
+
+    def _begin(self, sql, params):
+        self._finish()
+        self._sql = " ".join(sql.split())
+        self._params = params
+        self._rows = 0
+        self._start = time.perf_counter()
+
+    def execute(self, sql, params=()):
+        self._begin(sql, params)
+        return super().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        self._begin(sql, ())
+        super().executemany(sql, seq_of_params)
+        self._finish()
+        return self
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._finish()
+            raise
+        self._rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass  # e.g. at interpreter exit
+
+
+class ProfilingConnection(sqlite3.Connection):
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    # The built-in shortcuts don't go through cursor(), so route them through a ProfilingCursor
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def connection_factory():
+    """Connection class for new connections: instrumented only when the profiler is on."""
+    if _config['enabled']:
+        count('connections opened')
+        return ProfilingConnection
+    return sqlite3.Connection
+
+
+# REPORTS
+
+def summary():
+    with _lock:
+        return {
+            'methods': {name: histogram.to_dict() for name, histogram in _methods.items()},
+            'queries': {sql: histogram.to_dict() for sql, histogram in _queries.items()},
+            'counters': dict(_counters),
+            'slow_queries': list(_slow_queries),
+        }
+
+
+def format_summary(limit=20):
+    """The summary as text tables, slowest (by total time) first."""
+    data = summary()
+    lines = []
+    columns = ('calls', 'rows', 'total_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+    header = f"{'':60} " + " ".join(f"{column:>9}" for column in columns)
+    for title in ('methods', 'queries'):
+        lines.append(f"\n{title.upper()}\n" + header)
+        entries = sorted(data[title].items(), key=lambda item: item[1]['total_ms'], reverse=True)[:limit]
+        for name, stats in entries:
+            name = name if len(name) <= 60 else name[:57] + "..."
+            lines.append(f"{name:60} " + " ".join(
+                f"{stats[column]:9d}" if isinstance(stats[column], int) else f"{stats[column]:9.3f}"
+                for column in columns))
+    lines.append("\nCOUNTERS")
+    lines.extend(f"{name:60} {value:9d}" for name, value in sorted(data['counters'].items()))
+    if data['slow_queries']:
+        lines.append(f"\nSLOW QUERIES (over {_config['slow_ms']} ms)")
+        for query in data['slow_queries']:
+            lines.append(f"{query['ms']:9.3f} ms  {query['sql']}")
+            lines.extend(f"             {step}" for step in query['plan'])
+    return "\n".join(lines)
@@ -0,0 +1,33 @@
+# This file contains the random sampler used to pick poses for a flow.
+# Poses are drawn without replacement in O(1) per draw, so a whole flow is generated in linear time.
+
+import random
+
+
+class PoseSampler:
+    def __init__(self, items, seed=None):
+        self.rng = random.Random(seed)
+        self.items = list(items)
+        self.remaining = len(self.items)
+
+    def __len__(self):
+        return self.remaining
+
+    def draw(self):
+        if self.remaining == 0:
+            raise IndexError("There are no items left to draw.")
+
+        last = self.remaining - 1
+        # Partial Fisher-Yates: swap a random item into the last live slot and shrink the range
+        index = self.rng.randint(0, last)
+        self.items[index], self.items[last] = self.items[last], self.items[index]
+        self.remaining = last
+        return self.items[last]
+
+    def sample(self, count):
+        """Draw up to count items (fewer if the sampler runs out)."""
+        return [self.draw() for _ in range(min(count, self.remaining))]
+
+    def __iter__(self):
+        while self.remaining:
+            yield self.draw()
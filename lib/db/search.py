@@ -0,0 +1,85 @@
+# This file sets up full-text search over pose names with SQLite FTS5.
+# poses_fts answers word and prefix queries ("warr" finds "Warrior II Pose"), poses_trigram is used as a
+# fuzzy fallback for typos when this SQLite build has the trigram tokenizer. Both index the name column of poses
+# and are kept in sync by triggers.
+
+import re
+import sqlite3
+
+# Each table with the triggers that keep it in sync. poses_trigram needs the trigram tokenizer (SQLite 3.34+);
+# without it search still works, just without the fuzzy fallback.
+SEARCH_TABLES = {
+    'poses_fts': '''CREATE VIRTUAL TABLE IF NOT EXISTS poses_fts USING fts5(
+           name, content='poses', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+       )''',
+    'poses_trigram': '''CREATE VIRTUAL TABLE IF NOT EXISTS poses_trigram USING fts5(
+           name, content='poses', content_rowid='id', tokenize='trigram'
+       )''',
+}
+
+SEARCH_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON poses BEGIN
+           INSERT INTO {table} (rowid, name) VALUES (new.id, new.name);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON poses BEGIN
+           INSERT INTO {table} ({table}, rowid, name) VALUES ('delete', old.id, old.name);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS {table}_update AFTER UPDATE OF name ON poses BEGIN
+           INSERT INTO {table} ({table}, rowid, name) VALUES ('delete', old.id, old.name);
+           INSERT INTO {table} (rowid, name) VALUES (new.id, new.name);
+       END''',
+)
+
+# Older versions had one set of triggers for both tables
+OLD_TRIGGERS = ('poses_search_insert', 'poses_search_delete', 'poses_search_update')
+
+
+def create_search_tables(cursor):
+    """Create the search tables this SQLite build supports, and their triggers. Returns the names of the tables
+    (empty if there is no FTS5)."""
+    for name in OLD_TRIGGERS:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    created = []
+    for table, statement in SEARCH_TABLES.items():
+        try:
+            cursor.execute(statement)
+        except sqlite3.OperationalError as error:
+            if 'no such module' in str(error) or 'tokenizer' in str(error):
+                continue
+            raise
+        for trigger in SEARCH_TRIGGERS:
+            cursor.execute(trigger.format(table=table))
+        created.append(table)
+    return created
+
+
+def rebuild_search_tables(cursor, tables=tuple(SEARCH_TABLES)):
+    # Re-index every pose (used when the search tables are added to an existing database)
+    for table in tables:
+        cursor.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
+
+
+def drop_search_tables(cursor):
+    for table in SEARCH_TABLES:
+        for suffix in ('insert', 'delete', 'update'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_{suffix}")
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    for name in OLD_TRIGGERS:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+
+def words(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def prefix_query(text):
+    """'warr 2' -> '"warr"* "2"*' : every word must match the start of a word in the name."""
+    return " ".join(f'"{word}"*' for word in words(text))
+
+
+def trigram_query(text):
+    """Any three-letter piece of the text may match, so misspelt names still find candidates."""
+    text = " ".join(words(text))
+    trigrams = {text[index:index + 3] for index in range(len(text) - 2)}
+    trigrams = [trigram for trigram in trigrams if ' ' not in trigram]
+    return " OR ".join(f'"{trigram}"' for trigram in sorted(trigrams))
@@ -1,45 +1,36 @@
 # This file is used for populating the database with initial data.
 # It contains scripts or functions that insert predefined data into the database tables.
+#
+# Seeding runs on a single connection in a single transaction with bulk-load pragmas. Synthetic poses and flows
+# can be added at any scale, and --seed makes the result reproducible:
+#
+# $ python lib/db/seed.py --poses 1000000 --flows 100000 --seed 42
 
-import sqlite3
+import argparse
+import os
 import random
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
 
-DB_FILE = 'yoga.db'
-
-def drop_tables():
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DROP TABLE IF EXISTS flows")
-        cursor.execute("DROP TABLE IF EXISTS poses")
-        cursor.execute("DROP TABLE IF EXISTS flow_poses")
-        conn.commit()
+if __name__ == "__main__":
+    # Make the lib directory importable when this file is run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import catalog, history, lookup, search, transitions
+from db.connection import get_db_file
+from db.constants import CHAKRAS, DIFFICULTIES, DURATIONS, SCHEMA_VERSION
+from db.sampler import PoseSampler
 
-def create_tables():
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS flows (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            chakra TEXT NOT NULL,
-                            duration INTEGER NOT NULL,
-                            difficulty TEXT NOT NULL
-                        )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS poses (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            name TEXT NOT NULL,
-                            chakra TEXT NOT NULL,
-                            difficulty TEXT NOT NULL
-                        )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS flow_poses (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            flow_id INTEGER,
-                            pose_id INTEGER,
-                            FOREIGN KEY(flow_id) REFERENCES flows(id),
-                            FOREIGN KEY(pose_id) REFERENCES poses(id)
-                        )''')
-        conn.commit()
+# Only used while seeding: nothing is journaled or synced until the data is in
+BULK_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+    'temp_store': 'MEMORY',
+    'cache_size': -200000,  # ~200 MB
+}
 
-def insert_yoga_poses():
-    yoga_poses = [
+YOGA_POSES = [
     ("Conquer Breath", "Root", "Easy"),
     ("Easy Pose", "Sacral", "Easy"),
     ("Staff Pose", "Solar Plexus", "Easy"),
@@ -92,63 +83,366 @@ def insert_yoga_poses():
     ("Butterfly Pose", "Root", "Easy")
 ]
 
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.executemany("INSERT INTO poses (name, chakra, difficulty) VALUES (?, ?, ?)", yoga_poses)
-        conn.commit()
+YOGA_FLOWS = [
+    ("Root", 30, "Easy"),
+    ("Sacral", 20, "Easy"),
+    ("Solar Plexus", 40, "Easy"),
+    ("Heart", 30, "Easy"),
+    ("Throat", 20, "Easy"),
+    ("Third Eye", 40, "Intermediate"),
+    ("Crown", 30, "Intermediate")
+]
 
-def insert_yoga_flows():
-    yoga_flows = [
-        ("Root", 30, "Easy"),
-        ("Sacral", 20, "Easy"),
-        ("Solar Plexus", 40, "Easy"),
-        ("Heart", 30, "Easy"),
-        ("Throat", 20, "Easy"),
-        ("Third Eye", 40, "Intermediate"),
-        ("Crown", 30, "Intermediate")
-    ]
-
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.executemany("INSERT INTO flows (chakra, duration, difficulty) VALUES (?, ?, ?)", yoga_flows)
+@contextmanager
+def seeding_cursor(cursor=None):
+    # Steps run on the caller's cursor (see seed_database), or on their own connection when called on their own
+    if cursor is not None:
+        yield cursor
+        return
+    with sqlite3.connect(get_db_file()) as conn:
+        yield conn.cursor()
         conn.commit()
 
-def insert_flow_poses():
-    with sqlite3.connect(DB_FILE) as conn:
+def drop_tables(cursor=None):
+    with seeding_cursor(cursor) as cursor:
+        search.drop_search_tables(cursor)
+        cursor.execute("DROP TABLE IF EXISTS flows")
+        cursor.execute("DROP TABLE IF EXISTS poses")
+        cursor.execute("DROP TABLE IF EXISTS flow_poses")
+        lookup.drop_tables(cursor)
+        catalog.drop_tables(cursor)
+        transitions.drop_table(cursor)
+        history.drop_tables(cursor)
+
+def create_tables(cursor=None, indexes=True):
+    with seeding_cursor(cursor) as cursor:
+        lookup.create_tables(cursor)
+        create_flows_table(cursor)
+        create_poses_table(cursor)
+        create_flow_poses_table(cursor)
+        catalog.create_table(cursor)
+        transitions.create_table(cursor)
+        search.create_search_tables(cursor)
+        history.create_tables(cursor)
+        if indexes:
+            create_indexes(cursor)
+
+def create_flows_table(cursor, name="flows"):
+    # chakra_id and difficulty_id refer to the lookup tables (see lookup.py); duration must be stored as an integer
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {name} (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chakra_id INTEGER NOT NULL,
+                        duration INTEGER NOT NULL CHECK (typeof(duration) = 'integer' AND duration > 0),
+                        difficulty_id INTEGER NOT NULL,
+                        FOREIGN KEY(chakra_id) REFERENCES chakras(id),
+                        FOREIGN KEY(difficulty_id) REFERENCES difficulties(id)
+                    )''')
+
+def create_poses_table(cursor, name="poses"):
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {name} (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT NOT NULL,
+                        chakra_id INTEGER NOT NULL,
+                        difficulty_id INTEGER NOT NULL,
+                        hold_seconds INTEGER CHECK (hold_seconds IS NULL OR (typeof(hold_seconds) = 'integer' AND hold_seconds > 0)),
+                        FOREIGN KEY(chakra_id) REFERENCES chakras(id),
+                        FOREIGN KEY(difficulty_id) REFERENCES difficulties(id)
+                    )''')
+
+def create_flow_poses_table(cursor, name="flow_poses"):
+    # One row per pose in a flow, position is the order of the pose within the flow
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {name} (
+                        flow_id INTEGER NOT NULL,
+                        pose_id INTEGER NOT NULL,
+                        position INTEGER NOT NULL,
+                        PRIMARY KEY (flow_id, pose_id),
+                        FOREIGN KEY(flow_id) REFERENCES flows(id),
+                        FOREIGN KEY(pose_id) REFERENCES poses(id)
+                    ) WITHOUT ROWID''')
+
+def create_indexes(cursor=None):
+    with seeding_cursor(cursor) as cursor:
+        # Poses are looked up by chakra (optionally with difficulty) when generating a flow
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_poses_chakra_difficulty ON poses (chakra_id, difficulty_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_poses_difficulty ON poses (difficulty_id)")
+        # Used by the Flow.filter_by_* searches
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_flows_chakra ON flows (chakra_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_flows_duration ON flows (duration)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_flows_difficulty ON flows (difficulty_id)")
+        # Used by Flow.search, which combines the filters in one query
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_flows_chakra_difficulty_duration ON flows (chakra_id, difficulty_id, duration)")
+        # Reverse lookup for FlowPose.get_flows_for_pose (the primary key covers flow -> poses)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_flow_poses_pose ON flow_poses (pose_id, flow_id)")
+
+def table_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in cursor.fetchall()]
+
+def migrate_flow_poses(cursor=None):
+    # Older databases have flow_poses(id, flow_id, pose_id) without a position or a unique key
+    with seeding_cursor(cursor) as cursor:
+        columns = table_columns(cursor, "flow_poses")
+        if not columns or 'position' in columns:
+            return
+
+        create_flow_poses_table(cursor, "flow_poses_new")
+        # Keep the first copy of any duplicated pair and number poses in insertion order
+        cursor.execute('''INSERT OR IGNORE INTO flow_poses_new (flow_id, pose_id, position)
+                          SELECT flow_id, pose_id, ROW_NUMBER() OVER (PARTITION BY flow_id ORDER BY id)
+                          FROM flow_poses
+                          WHERE flow_id IS NOT NULL AND pose_id IS NOT NULL
+                          ORDER BY id''')
+        cursor.execute("DROP TABLE flow_poses")
+        cursor.execute("ALTER TABLE flow_poses_new RENAME TO flow_poses")
+
+def migrate_lookup_columns(cursor=None):
+    # Older databases store chakra and difficulty as text in every row of poses and flows (and the CLI could store
+    # a duration as text). The tables are rebuilt with lookup ids, keeping every id; a value that can't be matched
+    # to a known chakra or difficulty stops the migration instead of being guessed.
+    with seeding_cursor(cursor) as cursor:
+        pose_columns = table_columns(cursor, "poses")
+        flow_columns = table_columns(cursor, "flows")
+        if 'chakra' not in pose_columns and 'chakra' not in flow_columns:
+            return
+
+        lookup.create_tables(cursor)
+        search.drop_search_tables(cursor)  # Their triggers are on the old poses table
+        matches = '''JOIN chakras ON chakras.name = TRIM(old.chakra) COLLATE NOCASE
+                     JOIN difficulties ON difficulties.name = TRIM(old.difficulty) COLLATE NOCASE'''
+
+        if 'chakra' in pose_columns:
+            create_poses_table(cursor, "poses_new")
+            hold = "old.hold_seconds" if 'hold_seconds' in pose_columns else "NULL"
+            cursor.execute(f'''INSERT INTO poses_new (id, name, chakra_id, difficulty_id, hold_seconds)
+                              SELECT old.id, old.name, chakras.id, difficulties.id, {hold}
+                              FROM poses AS old {matches} ORDER BY old.id''')
+            check_migrated(cursor, "poses", "poses_new")
+            cursor.execute("DROP TABLE poses")
+            cursor.execute("ALTER TABLE poses_new RENAME TO poses")
+
+        if 'chakra' in flow_columns:
+            create_flows_table(cursor, "flows_new")
+            cursor.execute(f'''INSERT INTO flows_new (id, chakra_id, duration, difficulty_id)
+                              SELECT old.id, chakras.id, CAST(TRIM(old.duration) AS INTEGER), difficulties.id
+                              FROM flows AS old {matches}
+                              WHERE CAST(TRIM(old.duration) AS INTEGER) > 0 ORDER BY old.id''')
+            check_migrated(cursor, "flows", "flows_new")
+            cursor.execute("DROP TABLE flows")
+            cursor.execute("ALTER TABLE flows_new RENAME TO flows")
+
+        # The derived tables are keyed by the old text columns; migrate() rebuilds them
+        catalog.drop_tables(cursor)
+
+def check_migrated(cursor, table, new_table):
+    cursor.execute(f"SELECT id FROM {table} WHERE id NOT IN (SELECT id FROM {new_table}) ORDER BY id LIMIT 10")
+    skipped = [row[0] for row in cursor.fetchall()]
+    if skipped:
+        raise ValueError(f"Can't migrate {table} with ids {', '.join(map(str, skipped))}: unknown chakra or "
+                         f"difficulty, or a duration that is not a positive whole number. Fix them and run again.")
+
+def migrate_hold_seconds(cursor=None):
+    # Poses got a hold time for the flow composer; NULL means the default for the pose's difficulty
+    with seeding_cursor(cursor) as cursor:
+        columns = table_columns(cursor, "poses")
+        if columns and 'hold_seconds' not in columns:
+            cursor.execute("ALTER TABLE poses ADD COLUMN hold_seconds INTEGER")
+
+def build_flow_catalog(cursor=None):
+    # Rebuilds the catalog tables (see catalog.py) from flows and poses
+    with seeding_cursor(cursor) as cursor:
+        return catalog.refresh(cursor)
+
+def build_transitions(cursor=None, seed=0):
+    # Rebuilds the pose transition graph from poses (see transitions.py)
+    with seeding_cursor(cursor) as cursor:
+        return transitions.build(cursor, seed)
+
+def build_search_index(cursor=None):
+    # Indexes the names of poses that were added before the search tables existed (or while they were dropped)
+    with seeding_cursor(cursor) as cursor:
+        tables = search.create_search_tables(cursor)
+        if tables:
+            search.rebuild_search_tables(cursor, tables)
+
+def migrate(cursor=None):
+    # Brings an existing database up to date without dropping any data
+    with seeding_cursor(cursor) as cursor:
+        migrate_flow_poses(cursor)
+        migrate_lookup_columns(cursor)
+        migrate_hold_seconds(cursor)
+        create_tables(cursor)
+        build_flow_catalog(cursor)
+        build_transitions(cursor)
+        build_search_index(cursor)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+def upgrade(conn):
+    """Migrate the database of conn (an autocommit connection) once if it was made by an older version,
+    in one transaction. Returns True if it was migrated. Called by the connection pool when it opens a database."""
+    conn.execute("BEGIN IMMEDIATE")  # Another process opening the database at the same time waits for this one
+    try:
         cursor = conn.cursor()
-        
-        # Retrieve the IDs of all flows
-        cursor.execute("SELECT id FROM flows")
-        flow_ids = [row[0] for row in cursor.fetchall()]
-        
-        # Retrieve the IDs of all poses
+        cursor.execute("PRAGMA user_version")
+        outdated = cursor.fetchone()[0] < SCHEMA_VERSION and table_columns(cursor, "poses")
+        if outdated:
+            migrate(cursor)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return bool(outdated)
+
+def insert_yoga_poses(cursor=None):
+    with seeding_cursor(cursor) as cursor:
+        cursor.executemany("INSERT INTO poses (name, chakra_id, difficulty_id) VALUES (?, ?, ?)",
+                           [(name, lookup.chakra_id(chakra), lookup.difficulty_id(difficulty))
+                            for name, chakra, difficulty in YOGA_POSES])
+        return len(YOGA_POSES)
+
+def insert_yoga_flows(cursor=None):
+    with seeding_cursor(cursor) as cursor:
+        cursor.executemany("INSERT INTO flows (chakra_id, duration, difficulty_id) VALUES (?, ?, ?)",
+                           [(lookup.chakra_id(chakra), duration, lookup.difficulty_id(difficulty))
+                            for chakra, duration, difficulty in YOGA_FLOWS])
+        return len(YOGA_FLOWS)
+
+def synthetic_poses(count, rng):
+    # Variations of the built-in poses, e.g. "Tree Pose 1042", with a random chakra and difficulty (as lookup ids)
+    for number in range(1, count + 1):
+        name = YOGA_POSES[rng.randrange(len(YOGA_POSES))][0]
+        yield (f"{name} {number}", rng.randrange(len(CHAKRAS)) + 1, rng.randrange(len(DIFFICULTIES)) + 1)
+
+def synthetic_flows(count, rng):
+    for _ in range(count):
+        yield (rng.randrange(len(CHAKRAS)) + 1, DURATIONS[rng.randrange(len(DURATIONS))],
+               rng.randrange(len(DIFFICULTIES)) + 1)
+
+def insert_synthetic_poses(count, seed=None, cursor=None):
+    with seeding_cursor(cursor) as cursor:
+        cursor.executemany("INSERT INTO poses (name, chakra_id, difficulty_id) VALUES (?, ?, ?)",
+                           synthetic_poses(count, random.Random(seed)))
+        return count
+
+def insert_synthetic_flows(count, seed=None, cursor=None):
+    with seeding_cursor(cursor) as cursor:
+        cursor.executemany("INSERT INTO flows (chakra_id, duration, difficulty_id) VALUES (?, ?, ?)",
+                           synthetic_flows(count, random.Random(seed)))
+        return count
+
+def pick_poses(pose_ids, exclude, count, rng):
+    # Picks count distinct ids that are not in exclude. Random probing is O(count) while most ids are free;
+    # when few are left the free ids are listed and sampled instead.
+    if len(pose_ids) - len(exclude) <= 2 * count:
+        return PoseSampler([pose_id for pose_id in pose_ids if pose_id not in exclude], seed=rng.random()).sample(count)
+    picked = []
+    seen = set(exclude)
+    while len(picked) < count:
+        pose_id = pose_ids[rng.randrange(len(pose_ids))]
+        if pose_id not in seen:
+            seen.add(pose_id)
+            picked.append(pose_id)
+    return picked
+
+def insert_flow_poses(seed=None, cursor=None, poses_per_flow=5):
+    if poses_per_flow <= 0:
+        return 0
+    with seeding_cursor(cursor) as cursor:
         cursor.execute("SELECT id FROM poses")
         pose_ids = [row[0] for row in cursor.fetchall()]
-        
-        # Create mappings between flows and poses for each flow
-        flow_poses = []
-        for flow_id in flow_ids:
-            # Retrieve the poses that match the chakra of the current flow
-            cursor.execute("SELECT pose_id FROM flow_poses WHERE flow_id = ?", (flow_id,))
-            poses_in_flow = [row[0] for row in cursor.fetchall()]
-            
-            # Ensure that each chakra flow has a unique set of poses
-            available_poses = [pose_id for pose_id in pose_ids if pose_id not in poses_in_flow]
-            
-            # Randomly select poses for the flow
-            selected_poses = random.sample(available_poses, 5)  # Adjust the number of poses as needed
-            
-            # Create mappings between the current flow and the selected poses
-            flow_poses.extend([(flow_id, pose_id) for pose_id in selected_poses])
-        
-        # Insert the mappings into the flow_poses table
-        cursor.executemany("INSERT INTO flow_poses (flow_id, pose_id) VALUES (?, ?)", flow_poses)
-        conn.commit()
+
+        # Poses already in each flow, loaded with one query instead of one per flow
+        cursor.execute("SELECT flow_id, pose_id FROM flow_poses")
+        existing = {}
+        for flow_id, pose_id in cursor.fetchall():
+            existing.setdefault(flow_id, set()).add(pose_id)
+
+        rng = random.Random(seed)  # Same seed, same mappings
+
+        def flow_poses():
+            flows = cursor.connection.execute("SELECT id FROM flows ORDER BY id")
+            for (flow_id,) in flows:
+                in_flow = existing.get(flow_id, set())
+                selected = pick_poses(pose_ids, in_flow, poses_per_flow, rng)
+                for position, pose_id in enumerate(selected, len(in_flow) + 1):
+                    yield (flow_id, pose_id, position)
+
+        cursor.executemany("INSERT INTO flow_poses (flow_id, pose_id, position) VALUES (?, ?, ?)", flow_poses())
+        return cursor.rowcount
+
+def seed_database(poses=0, flows=0, poses_per_flow=5, seed=None, builtin=True, report=None):
+    """Drop and recreate every table and fill it, on one connection in one transaction.
+
+    poses and flows are the numbers of synthetic rows added to the built-in poses and flows (leave out the
+    built-in ones with builtin=False). The same seed gives the same database. report(step, rows, seconds) is
+    called after each step. Returns the total number of rows written.
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(get_db_file(), isolation_level=None)
+    try:
+        # If the load fails half way the database is left incomplete (there is no journal to roll back),
+        # which is fine here since seeding starts from scratch anyway
+        for name, value in BULK_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+
+        def recreate_tables():
+            drop_tables(cursor)
+            create_tables(cursor, indexes=False)
+            # Rebuilt once at the end instead of being updated by a trigger for every pose
+            search.drop_search_tables(cursor)
+
+        steps = [("tables", recreate_tables)]
+        if builtin:
+            steps += [("poses", lambda: insert_yoga_poses(cursor)), ("flows", lambda: insert_yoga_flows(cursor))]
+        steps += [
+            ("synthetic poses", lambda: insert_synthetic_poses(poses, rng.random(), cursor)),
+            ("synthetic flows", lambda: insert_synthetic_flows(flows, rng.random(), cursor)),
+            ("flow_poses", lambda: insert_flow_poses(rng.random(), cursor, poses_per_flow)),
+            ("indexes", lambda: create_indexes(cursor)),
+            ("search index", lambda: build_search_index(cursor)),
+            ("flow_catalog", lambda: build_flow_catalog(cursor)),
+            ("transitions", lambda: build_transitions(cursor, rng.random())),
+        ]
+
+        total = 0
+        for step, run in steps:
+            start = time.perf_counter()
+            rows = run() or 0
+            total += rows
+            if report:
+                report(step, rows, time.perf_counter() - start)
+
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        cursor.execute("COMMIT")
+        conn.execute("PRAGMA journal_mode = WAL")  # What the app uses (see connection.py)
+    finally:
+        conn.close()
+    return total
+
+def print_report(step, rows, seconds):
+    rate = f" ({rows / seconds:.0f} rows/sec)" if rows and seconds else ""
+    print(f"{step:16} {rows:10} rows in {seconds:.2f}s{rate}")
 
 
 if __name__ == "__main__":
-        drop_tables()
-        create_tables()
-        insert_yoga_poses()
-        insert_yoga_flows()
-        insert_flow_poses()
+    parser = argparse.ArgumentParser(description="Create and fill the Py Flows database.")
+    parser.add_argument('command', nargs='?', choices=['migrate'], help="update an existing database instead")
+    parser.add_argument('--poses', type=int, default=0, help="number of synthetic poses to add")
+    parser.add_argument('--flows', type=int, default=0, help="number of synthetic flows to add")
+    parser.add_argument('--poses-per-flow', type=int, default=5, help="poses linked to each flow in flow_poses")
+    parser.add_argument('--seed', type=int, help="random seed, the same seed gives the same database")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        conn = sqlite3.connect(get_db_file(), isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            migrate(conn.cursor())
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+    else:
+        start = time.perf_counter()
+        rows = seed_database(args.poses, args.flows, args.poses_per_flow, args.seed, report=print_report)
+        print_report("total", rows, time.perf_counter() - start)
@@ -0,0 +1,189 @@
+# This file keeps an optional in-memory snapshot of the poses table for fast flow generation.
+# Poses are stored column-wise in arrays, with chakra and difficulty interned to small integer codes
+# and the row positions of every chakra (and chakra + difficulty) kept in buckets, so a plan can be built
+# without querying SQLite or creating a Row per pose. The snapshot is reloaded after poses change through the models
+# or the bulk importer, and after max_age seconds in case another process changed the database.
+#
+# snapshot.configure(enabled=True) makes Flow.plan and Flow.plan_for_flow use it.
+
+import sys
+import threading
+import time
+from array import array
+
+from db.cache import on_invalidate
+from db.connection import connection
+from db.lookup import POSE_SELECT
+
+_config = {
+    'enabled': False,
+    'max_age': 60.0,
+}
+
+_index = None
+_loaded_at = 0.0
+_lock = threading.Lock()
+
+
+class PoseRecord:
+    """A single pose taken from the index. Supports pose['name'] like a sqlite3.Row."""
+    __slots__ = ('id', 'name', 'chakra', 'difficulty', 'hold_seconds')
+
+    def __init__(self, id, name, chakra, difficulty, hold_seconds=None):
+        self.id = id
+        self.name = name
+        self.chakra = chakra
+        self.difficulty = difficulty
+        self.hold_seconds = hold_seconds
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.__slots__)
+
+
+class Codes:
+    """Interns strings to small integers."""
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class PoseIndex:
+    def __init__(self):
+        self.ids = array('q')
+        self.names = []
+        self.chakras = array('B')
+        self.difficulties = array('B')
+        self.holds = array('l')  # hold_seconds, 0 when the pose has none
+        self.chakra_codes = Codes()
+        self.difficulty_codes = Codes()
+        self.by_chakra = {}  # chakra code -> array of row positions
+        self.by_chakra_difficulty = {}  # (chakra code, difficulty code) -> array of row positions
+        self.chakra_poses = {}  # chakra -> records of all its poses, built by compose() the first time it needs them
+
+    @classmethod
+    def load(cls, batch_size=5000):
+        index = cls()
+        with connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(POSE_SELECT + " ORDER BY poses.id")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    index.add(*row[:5])
+        return index
+
+    def add(self, pose_id, name, chakra, difficulty, hold_seconds=None):
+        position = len(self.ids)
+        chakra_code = self.chakra_codes.code(chakra)
+        difficulty_code = self.difficulty_codes.code(difficulty)
+        self.ids.append(pose_id)
+        self.names.append(sys.intern(name))
+        self.chakras.append(chakra_code)
+        self.difficulties.append(difficulty_code)
+        self.holds.append(hold_seconds or 0)
+        self.chakra_poses.clear()
+        self.by_chakra.setdefault(chakra_code, array('l')).append(position)
+        self.by_chakra_difficulty.setdefault((chakra_code, difficulty_code), array('l')).append(position)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def record(self, position):
+        return PoseRecord(self.ids[position], self.names[position],
+                          self.chakra_codes.values[self.chakras[position]],
+                          self.difficulty_codes.values[self.difficulties[position]],
+                          self.holds[position] or None)
+
+    def bucket(self, chakra, difficulty=None):
+        chakra_code = self.chakra_codes.codes.get(chakra)
+        if difficulty is None:
+            return self.by_chakra.get(chakra_code, array('l'))
+        difficulty_code = self.difficulty_codes.codes.get(difficulty)
+        return self.by_chakra_difficulty.get((chakra_code, difficulty_code), array('l'))
+
+    def count(self, chakra, difficulty=None):
+        return len(self.bucket(chakra, difficulty))
+
+    def poses(self, chakra, difficulty=None):
+        return [self.record(position) for position in self.bucket(chakra, difficulty)]
+
+    def plan(self, chakra, duration, difficulty=None, seed=None):
+        """Same as Flow.plan, but built from the index. Only the selected poses are turned into records."""
+        import random
+        from db.plan import MIN_POSES, plan_from_poses, poses_needed
+
+        bucket = self.bucket(chakra)
+        if len(bucket) < MIN_POSES:
+            raise ValueError("There are not enough poses matching the chakra.")
+
+        # random.sample over a range picks distinct positions without copying the bucket
+        count = min(len(bucket), poses_needed(duration))
+        positions = random.Random(seed).sample(range(len(bucket)), count)
+        selected = [self.record(bucket[position]) for position in positions]
+        return plan_from_poses(selected, chakra, duration, difficulty, seed)
+
+    def compose(self, chakra, duration, difficulty=None, seed=None):
+        """Same as Flow.compose, but from the index. The records of a chakra are built once and reused."""
+        from db.composer import compose
+
+        poses = self.chakra_poses.get(chakra)
+        if poses is None:
+            poses = self.chakra_poses[chakra] = self.poses(chakra)
+        return compose(poses, chakra, duration, difficulty, seed)
+
+    def footprint(self):
+        """Approximate memory used by the index in bytes."""
+        size = sys.getsizeof(self.ids) + sys.getsizeof(self.chakras) + sys.getsizeof(self.difficulties)
+        size += sys.getsizeof(self.holds)
+        size += sys.getsizeof(self.names) + sum(sys.getsizeof(name) for name in set(self.names))
+        size += sys.getsizeof(self.by_chakra) + sys.getsizeof(self.by_chakra_difficulty)
+        size += sum(sys.getsizeof(bucket) for bucket in self.by_chakra.values())
+        size += sum(sys.getsizeof(bucket) for bucket in self.by_chakra_difficulty.values())
+        return size
+
+
+def get_pose_index():
+    """Returns the current snapshot, loading it first if poses changed since the last load."""
+    global _index, _loaded_at
+    with _lock:
+        if _index is None or time.monotonic() - _loaded_at > _config['max_age']:
+            _index = PoseIndex.load()
+            _loaded_at = time.monotonic()
+        return _index
+
+
+def configure(enabled=None, max_age=None):
+    """Change the settings. The snapshot is reloaded on the next call."""
+    global _index
+    if enabled is not None:
+        _config['enabled'] = enabled
+    if max_age is not None:
+        _config['max_age'] = max_age
+    with _lock:
+        _index = None
+
+
+def is_enabled():
+    return _config['enabled']
+
+
+def _poses_changed(tables):
+    global _index
+    if not tables or 'poses' in tables:
+        with _lock:
+            _index = None
+
+
+on_invalidate(_poses_changed)
@@ -0,0 +1,292 @@
+# This file maintains pose_transitions, a graph of which pose can follow which, and walks it to sequence flows.
+# Every pose gets EDGES outgoing edges to poses of the same chakra. An edge is weighted by how smooth the transition
+# is: poses in the same body position (standing, kneeling, prone, seated, supine) and with the same difficulty are the
+# most likely to follow each other. The body position is guessed from the pose name.
+#
+# build() creates every edge in one pass without comparing every pair of poses (poses are grouped by body position and
+# difficulty and the targets are drawn from the groups), and add_pose/remove_pose keep the graph up to date when a
+# single pose is created or deleted. TransitionGraph.walk() then picks each next pose from the current pose's edges,
+# so sequencing a flow costs O(flow length) once the graph of a chakra is loaded.
+# Like catalog.py, the functions that write take a cursor so they run inside the caller's transaction.
+
+import random
+import threading
+from bisect import bisect
+
+from db.cache import on_invalidate
+from db.connection import connection
+from db.constants import DIFFICULTIES
+from db.lookup import CHAKRA_IDS, DIFFICULTY_IDS
+
+EDGES = 6  # Outgoing edges per pose
+SAMPLE_SIZE = 32  # Poses read per difficulty when looking for the neighbours of a single pose
+
+CREATE_TABLE = '''CREATE TABLE IF NOT EXISTS pose_transitions (
+                    from_pose_id INTEGER NOT NULL,
+                    to_pose_id INTEGER NOT NULL,
+                    weight REAL NOT NULL,
+                    PRIMARY KEY (from_pose_id, to_pose_id),
+                    FOREIGN KEY(from_pose_id) REFERENCES poses(id),
+                    FOREIGN KEY(to_pose_id) REFERENCES poses(id)
+                ) WITHOUT ROWID'''
+
+# Finds the edges into a pose when it is deleted (the primary key covers the edges out of it)
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS idx_pose_transitions_to ON pose_transitions (to_pose_id, from_pose_id)"
+
+# First match wins, so more specific names come first ("Cow Face Pose" is seated, "Cow Pose" kneeling,
+# "Heron Pose" seated, "Hero Pose" kneeling)
+POSITION_KEYWORDS = (
+    ('seated', 'seated'), ('cow face', 'seated'), ('standing', 'standing'), ('warrior', 'standing'),
+    ('mountain', 'standing'), ('tree', 'standing'), ('chair', 'standing'), ('lunge', 'standing'),
+    ('side angle', 'standing'), ('wide legged', 'standing'), ('side stretch', 'standing'), ('garland', 'standing'),
+    ('triangle', 'standing'), ('cat', 'kneeling'), ('cow', 'kneeling'), ('child', 'kneeling'), ('heron', 'seated'), ('hero', 'kneeling'),
+    ('gate', 'kneeling'), ('puppy', 'kneeling'), ('lion', 'kneeling'), ('camel', 'kneeling'), ('cobra', 'prone'),
+    ('sphinx', 'prone'), ('locust', 'prone'), ('plank', 'prone'), ('four limbed', 'prone'), ('dog', 'prone'),
+    ('pigeon', 'prone'), ('bow', 'prone'), ('corpse', 'supine'), ('happy baby', 'supine'), ('bridge', 'supine'),
+    ('fish pose', 'supine'), ('reclining', 'supine'), ('legs-up', 'supine'), ('shoulder stand', 'supine'),
+)
+DEFAULT_POSITION = 'seated'
+
+# Rough height of each position; moving between far apart positions makes a rougher transition
+POSITION_LEVELS = {'standing': 0, 'kneeling': 1, 'prone': 2, 'seated': 2, 'supine': 3}
+POSITION_WEIGHTS = (1.0, 0.5, 0.2, 0.1)  # By difference in level
+DIFFICULTY_WEIGHTS = (1.0, 0.6, 0.15)  # By difference in difficulty
+
+_graphs = {}  # chakra -> TransitionGraph
+_lock = threading.Lock()
+
+
+def body_position(name):
+    name = name.lower()
+    for keyword, position in POSITION_KEYWORDS:
+        if keyword in name:
+            return position
+    return DEFAULT_POSITION
+
+
+def difficulty_level(difficulty_id):
+    # Lookup ids start at 1 in the order of DIFFICULTIES
+    return difficulty_id - 1
+
+
+def transition_weight(from_group, to_group):
+    """Weight of an edge between poses in the given (position, difficulty level) groups."""
+    (from_position, from_level), (to_position, to_level) = from_group, to_group
+    distance = abs(POSITION_LEVELS[from_position] - POSITION_LEVELS[to_position])
+    if distance == 0 and from_position != to_position:
+        distance = 1  # Prone and seated are at the same height but still need a change of position
+    return POSITION_WEIGHTS[distance] * DIFFICULTY_WEIGHTS[abs(from_level - to_level)]
+
+
+def pose_group(name, difficulty_id):
+    return body_position(name), difficulty_level(difficulty_id)
+
+
+def create_table(cursor):
+    cursor.execute(CREATE_TABLE)
+    cursor.execute(CREATE_INDEX)
+
+
+def drop_table(cursor):
+    cursor.execute("DROP TABLE IF EXISTS pose_transitions")
+
+
+def target_table(group, groups):
+    """How targets are drawn for a pose in group: a group is picked in proportion to its transition weight times its
+    size, then a pose is picked from it. Returns [(pose ids, weight)] and the cumulative weights."""
+    choices = []
+    cumulative = []
+    total = 0.0
+    for other, members in groups.items():
+        weight = transition_weight(group, other)
+        if members and weight:
+            total += weight * len(members)
+            choices.append((members, weight))
+            cumulative.append(total)
+    return choices, cumulative
+
+
+def pick_targets(rng, pose_id, table, count):
+    """Choose up to count other poses with a table from target_table(). Returns [(pose id, weight)]."""
+    choices, cumulative = table
+    if not choices:
+        return []
+    targets = {}
+    # A few extra draws in case the same pose comes up twice
+    for members, weight in rng.choices(choices, cum_weights=cumulative, k=count + count // 2 + 1):
+        target = members[int(rng.random() * len(members))]
+        if target != pose_id:
+            targets[target] = weight
+            if len(targets) == count:
+                break
+    return sorted(targets.items())
+
+
+def build(cursor, seed=0):
+    """Rebuild the whole graph. Costs O(poses * EDGES): targets are drawn from groups instead of compared pairwise.
+    Returns the number of edges."""
+    rng = random.Random(seed)
+    cursor.execute("DELETE FROM pose_transitions")
+    cursor.execute("SELECT id, name, chakra_id, difficulty_id FROM poses ORDER BY id")
+    poses = [(pose_id, chakra, pose_group(name, difficulty)) for pose_id, name, chakra, difficulty in cursor.fetchall()]
+    chakras = {}  # chakra id -> {group: [pose ids]}
+    for pose_id, chakra, group in poses:
+        chakras.setdefault(chakra, {}).setdefault(group, []).append(pose_id)
+    tables = {(chakra, group): target_table(group, groups)
+              for chakra, groups in chakras.items() for group in groups}
+
+    # Rows are written in primary key order, which keeps the inserts into the table's B-tree cheap
+    edges = 0
+    for start in range(0, len(poses), 10000):
+        rows = [(pose_id, target, weight) for pose_id, chakra, group in poses[start:start + 10000]
+                for target, weight in pick_targets(rng, pose_id, tables[chakra, group], EDGES)]
+        cursor.executemany("INSERT INTO pose_transitions (from_pose_id, to_pose_id, weight) VALUES (?, ?, ?)", rows)
+        edges += len(rows)
+    return edges
+
+
+def sample_neighbours(cursor, chakra_id, rng):
+    """Groups a sample of the poses of a chakra: SAMPLE_SIZE poses per difficulty, starting at a random id.
+    Served by idx_poses_chakra_difficulty, so it doesn't read the whole chakra."""
+    cursor.execute("SELECT MAX(id) FROM poses")
+    start = rng.randrange((cursor.fetchone()[0] or 0) + 1)
+    groups = {}
+    for difficulty in DIFFICULTY_IDS.values():
+        cursor.execute('''SELECT id, name FROM poses WHERE chakra_id = ? AND difficulty_id = ? AND id >= ?
+                          ORDER BY id LIMIT ?''', (chakra_id, difficulty, start, SAMPLE_SIZE))
+        rows = cursor.fetchall()
+        if len(rows) < SAMPLE_SIZE:
+            # Wrap around to the lowest ids
+            cursor.execute('''SELECT id, name FROM poses WHERE chakra_id = ? AND difficulty_id = ? AND id < ?
+                              ORDER BY id LIMIT ?''', (chakra_id, difficulty, start, SAMPLE_SIZE - len(rows)))
+            rows += cursor.fetchall()
+        for pose_id, name in rows:
+            groups.setdefault(pose_group(name, difficulty), []).append(pose_id)
+    return groups
+
+
+def add_pose(cursor, pose_id):
+    """Connect a new pose: EDGES edges out of it and EDGES edges into it from poses of the same chakra."""
+    cursor.execute("SELECT name, chakra_id, difficulty_id FROM poses WHERE id = ?", (pose_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return
+    name, chakra_id, difficulty_id = row
+    rng = random.Random(pose_id)
+    group = pose_group(name, difficulty_id)
+    groups = sample_neighbours(cursor, chakra_id, rng)
+
+    # Weights are symmetric, so the same draw gives the poses that lead into it
+    table = target_table(group, groups)
+    rows = [(pose_id, target, weight) for target, weight in pick_targets(rng, pose_id, table, EDGES)]
+    rows += [(source, pose_id, weight) for source, weight in pick_targets(rng, pose_id, table, EDGES)]
+    cursor.executemany("INSERT OR IGNORE INTO pose_transitions (from_pose_id, to_pose_id, weight) VALUES (?, ?, ?)",
+                       rows)
+
+
+def remove_pose(cursor, pose_id, chakra_id=None):
+    """Remove the edges of a pose. Poses that led into it get a new edge each, so they keep EDGES edges.
+    chakra_id is the chakra of the pose (needed if it is already deleted)."""
+    cursor.execute("SELECT from_pose_id FROM pose_transitions WHERE to_pose_id = ?", (pose_id,))
+    sources = [row[0] for row in cursor.fetchall()]
+    cursor.execute("DELETE FROM pose_transitions WHERE from_pose_id = ? OR to_pose_id = ?", (pose_id, pose_id))
+    if not sources or chakra_id is None:
+        return
+
+    rng = random.Random(pose_id)
+    groups = sample_neighbours(cursor, chakra_id, rng)
+    groups = {group: [other for other in members if other != pose_id] for group, members in groups.items()}
+    placeholders = ", ".join("?" for _ in sources)
+    cursor.execute(f"SELECT id, name, difficulty_id FROM poses WHERE id IN ({placeholders})", sources)
+    rows = []
+    for source, name, difficulty in cursor.fetchall():
+        table = target_table(pose_group(name, difficulty), groups)
+        rows.extend((source, target, weight) for target, weight in pick_targets(rng, source, table, 1))
+    cursor.executemany("INSERT OR IGNORE INTO pose_transitions (from_pose_id, to_pose_id, weight) VALUES (?, ?, ?)",
+                       rows)
+
+
+class TransitionGraph:
+    """The edges between the poses of one chakra, held in memory for walking."""
+    def __init__(self, chakra):
+        self.chakra = chakra
+        self.levels = {}  # pose id -> difficulty level
+        self.edges = {}  # pose id -> ([target ids], [cumulative weights])
+        self.nodes = {}  # difficulty level -> ids of the poses with that level or lower
+
+    @classmethod
+    def load(cls, chakra):
+        graph = cls(chakra)
+        with connection() as conn:
+            cursor = conn.cursor()
+            chakra_id = CHAKRA_IDS.get(chakra, 0)
+            cursor.execute("SELECT id, difficulty_id FROM poses WHERE chakra_id = ? ORDER BY id", (chakra_id,))
+            graph.levels = {pose_id: difficulty_level(difficulty) for pose_id, difficulty in cursor.fetchall()}
+            cursor.execute('''SELECT t.from_pose_id, t.to_pose_id, t.weight
+                              FROM poses p JOIN pose_transitions t ON t.from_pose_id = p.id
+                              WHERE p.chakra_id = ? ORDER BY t.from_pose_id, t.to_pose_id''', (chakra_id,))
+            for from_pose_id, to_pose_id, weight in cursor.fetchall():
+                targets, cumulative = graph.edges.setdefault(from_pose_id, ([], []))
+                targets.append(to_pose_id)
+                cumulative.append((cumulative[-1] if cumulative else 0.0) + weight)
+        for level in range(len(DIFFICULTIES)):
+            graph.nodes[level] = [pose_id for pose_id, pose_level in graph.levels.items() if pose_level <= level]
+        return graph
+
+    def walk(self, length, seed=None, max_level=None):
+        """Returns up to length pose ids, each following the previous one along a weighted edge where possible.
+        Poses harder than max_level are skipped and no pose is used twice."""
+        rng = random.Random(seed)
+        max_level = len(DIFFICULTIES) - 1 if max_level is None else max_level
+        nodes = self.nodes[max_level]
+        length = min(length, len(nodes))
+        if not length:
+            return []
+
+        easiest = self.nodes[0] or nodes
+        current = easiest[rng.randrange(len(easiest))]
+        sequence = [current]
+        visited = {current}
+        while len(sequence) < length:
+            current = self.step(rng, current, visited, max_level) or self.jump(rng, nodes, visited)
+            sequence.append(current)
+            visited.add(current)
+        return sequence
+
+    def step(self, rng, current, visited, max_level, tries=3):
+        # Follow a weighted edge to an unused pose, or give up after a few tries (the caller then jumps)
+        targets, cumulative = self.edges.get(current, ((), ()))
+        for _ in range(tries if targets else 0):
+            target = targets[bisect(cumulative, rng.random() * cumulative[-1])]
+            if target not in visited and self.levels[target] <= max_level:
+                return target
+        return None
+
+    def jump(self, rng, nodes, visited):
+        # Restart from a random unused pose; mostly a few random draws, a scan only when nearly every pose is used
+        for _ in range(8):
+            node = nodes[rng.randrange(len(nodes))]
+            if node not in visited:
+                return node
+        remaining = [node for node in nodes if node not in visited]
+        return remaining[rng.randrange(len(remaining))]
+
+
+def get_graph(chakra):
+    """Returns the graph of a chakra, loading it first if poses or edges changed since the last load."""
+    with _lock:
+        graph = _graphs.get(chakra)
+    if graph is None:
+        graph = TransitionGraph.load(chakra)
+        with _lock:
+            _graphs[chakra] = graph
+    return graph
+
+
+def _graph_changed(tables):
+    if not tables or 'poses' in tables or 'pose_transitions' in tables:
+        with _lock:
+            _graphs.clear()
+
+
+on_invalidate(_graph_changed)
@@ -0,0 +1,115 @@
+# This file load-tests a running Py Flows server (python lib/cli.py serve) from the same machine.
+# Every client holds one keep-alive connection and sends GET requests back to back, cycling through the paths,
+# for the given number of seconds. It prints requests/sec and latency percentiles.
+#
+# $ python lib/loadtest.py --url http://127.0.0.1:8000 --connections 50 --seconds 10 "/flows?chakra=Heart" /poses/3
+# $ python lib/loadtest.py --revalidate /flows   # send If-None-Match, so cached responses come back as 304
+
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from urllib.parse import urlsplit
+
+DEFAULT_PATHS = ('/flows', '/flows?chakra=Heart&sort=-duration', '/poses?limit=20', '/poses/search?q=warrior',
+                 '/flows/1', '/flows/1/plan?seed=1')
+
+
+async def read_response(reader):
+    """Returns (status, headers, body) of one response with a Content-Length."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("The server closed the connection.")
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers, body
+
+
+async def client(host, port, paths, deadline, latencies, errors, revalidate):
+    reader, writer = await asyncio.open_connection(host, port)
+    etags = {}
+    index = 0
+    try:
+        while time.perf_counter() < deadline:
+            path = paths[index % len(paths)]
+            index += 1
+            request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+            if revalidate and path in etags:
+                request += f"If-None-Match: {etags[path]}\r\n"
+            start = time.perf_counter()
+            writer.write((request + "\r\n").encode('latin-1'))
+            status, headers, _ = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors[status] = errors.get(status, 0) + 1
+            if 'etag' in headers:
+                etags[path] = headers['etag']
+    finally:
+        writer.close()
+
+
+def percentile(values, fraction):
+    # Nearest rank on sorted values
+    return values[max(0, math.ceil(fraction * len(values)) - 1)] if values else 0.0
+
+
+async def run(url, paths=DEFAULT_PATHS, connections=20, seconds=5.0, revalidate=False):
+    """Load-test the server at url and return the statistics as a dict."""
+    parts = urlsplit(url)
+    latencies = []
+    errors = {}
+    start = time.perf_counter()
+    await asyncio.gather(*(client(parts.hostname, parts.port or 80, list(paths), start + seconds, latencies, errors,
+                                  revalidate)
+                           for _ in range(connections)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Load-test a running Py Flows server")
+    parser.add_argument('paths', nargs='*', help="paths to request in turn (default: a mix of the read endpoints)")
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--connections', type=int, default=20, help="concurrent keep-alive connections")
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--revalidate', action='store_true', help="send the last ETag of every path back")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    try:
+        stats = asyncio.run(run(args.url, args.paths or DEFAULT_PATHS, args.connections, args.seconds,
+                                args.revalidate))
+    except OSError as error:
+        print(f"Could not reach {args.url}: {error}")
+        return 1
+    if args.json:
+        print(json.dumps(stats))
+    else:
+        print(f"{stats['requests']} requests in {stats['seconds']:.2f}s over {args.connections} connection(s)")
+        print(f"{stats['requests_per_sec']:.0f} requests/sec")
+        print(f"latency p50 {stats['p50_ms']:.2f} ms, p99 {stats['p99_ms']:.2f} ms, max {stats['max_ms']:.2f} ms")
+        if stats['errors']:
+            print("errors: " + ", ".join(f"{count} x {status}" for status, count in sorted(stats['errors'].items())))
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,541 @@
+# This file serves Py Flows as a local HTTP/JSON service, so other apps can search flows, manage poses and generate
+# plans without the terminal menu. It only uses asyncio streams from the standard library. Connections are kept alive
+# between requests, model calls run on a thread pool no larger than the SQLite connection pool (so the event loop never
+# waits on the database), and GET responses are kept with an ETag until a write invalidates the tables.
+# /flows/{id}/countdown streams a practice as server-sent events instead of printing the countdown to stdout.
+#
+# $ python lib/cli.py serve --port 8000
+# $ curl "localhost:8000/flows?chakra=Heart&sort=-duration"
+# $ curl -N "localhost:8000/flows/3/countdown?seed=7"
+
+import asyncio
+import hashlib
+import json
+import math
+import re
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from db import profiler
+from db.cache import on_invalidate, query_cache, remove_listener
+from db.connection import DatabaseBusy, get_pool
+from db.history import FLUSH_SECONDS, TABLES as HISTORY_TABLES, HistorySink, HistoryWriter
+from db.models import Flow, FlowPose, Pose, PAGE_SIZE
+from db.plan import plan_to_dict
+from db.player import Session
+
+_config = {
+    'workers': None,  # Threads running model calls, defaults to the connection pool size
+    'cache_size': 512,  # GET responses kept for revalidation
+    'keep_alive': 15.0,  # Seconds an idle connection stays open
+    'max_body': 64 * 1024,  # Largest request body accepted, in bytes
+    'min_tick': 0.01,  # Shortest countdown second accepted from ?tick=
+    'max_tick': 60.0,  # Longest one
+}
+
+
+def configure(workers=None, cache_size=None, keep_alive=None, max_body=None):
+    if workers is not None:
+        if workers < 1:
+            raise ValueError("workers must be at least 1.")
+        _config['workers'] = workers
+    if cache_size is not None:
+        _config['cache_size'] = cache_size
+    if keep_alive is not None:
+        _config['keep_alive'] = keep_alive
+    if max_body is not None:
+        _config['max_body'] = max_body
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None, headers=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+        self.headers = headers or {}
+
+
+def error_for(request, error):
+    """The HTTPError to send for an exception raised while handling request. Unexpected ones are logged."""
+    if isinstance(error, HTTPError):
+        return error
+    if isinstance(error, ValueError):
+        return HTTPError(HTTPStatus.BAD_REQUEST, str(error))
+    if isinstance(error, DatabaseBusy):
+        return HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, str(error), {'Retry-After': '1'})
+    sys.stderr.write(f"{request.method} {request.target} failed: {error!r}\n")
+    return HTTPError(HTTPStatus.INTERNAL_SERVER_ERROR)
+
+
+# RESPONSE CACHE
+
+class ResponseCache:
+    """Encoded GET responses with their ETags, keyed by path and query. Every invalidate() clears it, and entries
+    expire after ttl seconds (the query cache's ttl by default) in case another process changed the database."""
+    def __init__(self, max_size, ttl=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.generation = 0  # Bumped on every clear, so a response computed before a write is not stored
+        self._entries = OrderedDict()  # key -> (expires, (etag, body))
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, entry = item
+            if expires <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, generation):
+        ttl = query_cache.ttl if self.ttl is None else self.ttl
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (self.clock() + ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+
+def make_etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(etag, if_none_match):
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    # A weak validator ("W/...") matches too, GET only needs the weak comparison
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
+
+
+# ROUTES
+# Handlers are plain functions run on the thread pool. They take the path parameters, the parsed query and the
+# decoded JSON body and return (status, payload). Errors are raised as HTTPError (or ValueError, which becomes a 400).
+
+ROUTES = []
+
+
+def route(method, pattern, cacheable=False):
+    """Register a handler. cacheable is True, False or a function of the query deciding it per request."""
+    def decorator(func):
+        ROUTES.append((method, re.compile(pattern + '$'), func, cacheable))
+        return func
+    return decorator
+
+
+def query_value(query, name, kind=str, default=None):
+    values = query.get(name)
+    if not values:
+        return default
+    try:
+        return kind(values[-1])
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be a whole number.")
+
+
+def countdown_tick(query):
+    # Length of a countdown second from ?tick=. nan or inf would leave the session spinning on the event loop.
+    try:
+        tick = float(query_value(query, 'tick', default='1'))
+    except ValueError:
+        tick = math.nan
+    if not (math.isfinite(tick) and _config['min_tick'] <= tick <= _config['max_tick']):
+        raise HTTPError(HTTPStatus.BAD_REQUEST,
+                        f"tick must be a number of seconds from {_config['min_tick']} to {_config['max_tick']}.")
+    return tick
+
+
+def query_list(query, name, kind=str):
+    # ?chakra=Heart&chakra=Root and ?chakra=Heart,Root both give two values
+    values = [value for item in query.get(name, ()) for value in item.split(',') if value]
+    try:
+        return [kind(value) for value in values] or None
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be a whole number.")
+
+
+def query_flag(query, name):
+    return query_value(query, name, default='0').lower() in ('1', 'true', 'yes')
+
+
+def found(row, kind, row_id):
+    if row is None:
+        raise HTTPError(HTTPStatus.NOT_FOUND, f"{kind} {row_id} not found.")
+    return dict(row)
+
+
+@route('GET', r'/flows', cacheable=True)
+def flows_search(params, query, body):
+    rows = Flow.search(chakra=query_list(query, 'chakra'), difficulty=query_list(query, 'difficulty'),
+                       duration=query_list(query, 'duration', int),
+                       min_duration=query_value(query, 'min_duration', int),
+                       max_duration=query_value(query, 'max_duration', int),
+                       sort=query_value(query, 'sort', default='id'),
+                       limit=query_value(query, 'limit', int, PAGE_SIZE),
+                       offset=query_value(query, 'offset', int, 0))
+    return HTTPStatus.OK, [dict(row) for row in rows]
+
+
+@route('GET', r'/flows/(\d+)', cacheable=True)
+def flows_show(params, query, body):
+    flow_id = int(params[0])
+    flow = found(Flow.find_by_id(flow_id), "Flow", flow_id)
+    flow['poses'] = [dict(pose) for pose in FlowPose.get_poses_for_flows([flow_id])[flow_id]]
+    return HTTPStatus.OK, flow
+
+
+def build_plan(flow_id, query):
+    seed = query_value(query, 'seed', int)
+    if query_flag(query, 'walk'):
+        plan = Flow.walk_for_flow(flow_id, seed=seed)
+    else:
+        plan = Flow.compose_for_flow(flow_id, seed=seed)
+    if plan is None:
+        raise HTTPError(HTTPStatus.NOT_FOUND, f"Flow {flow_id} not found.")
+    return plan
+
+
+# A plan only repeats when it is seeded, so unseeded plans are never cached
+@route('GET', r'/flows/(\d+)/plan', cacheable=lambda query: 'seed' in query)
+def flows_plan(params, query, body):
+    return HTTPStatus.OK, plan_to_dict(build_plan(int(params[0]), query))
+
+
+@route('GET', r'/poses', cacheable=True)
+def poses_list(params, query, body):
+    rows = Pose.get_page(query_value(query, 'after_id', int, 0), query_value(query, 'limit', int, PAGE_SIZE),
+                         chakra=query_value(query, 'chakra'), difficulty=query_value(query, 'difficulty'))
+    return HTTPStatus.OK, [dict(row) for row in rows]
+
+
+@route('GET', r'/poses/search', cacheable=True)
+def poses_search(params, query, body):
+    text = query_value(query, 'q')
+    if not text:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Give the text to search for as ?q=.")
+    return HTTPStatus.OK, [dict(row) for row in Pose.search(text, limit=query_value(query, 'limit', int, 10))]
+
+
+@route('GET', r'/poses/(\d+)', cacheable=True)
+def poses_show(params, query, body):
+    pose_id = int(params[0])
+    return HTTPStatus.OK, found(Pose.find_by_id(pose_id), "Pose", pose_id)
+
+
+POSE_FIELDS = ('name', 'chakra', 'difficulty', 'hold_seconds')
+
+
+def pose_fields(body):
+    if not isinstance(body, dict):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "The body must be a JSON object.")
+    unknown = sorted(set(body) - set(POSE_FIELDS))
+    if unknown:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Unknown fields: {', '.join(unknown)}.")
+    return body
+
+
+@route('POST', r'/poses')
+def poses_create(params, query, body):
+    fields = pose_fields(body)
+    missing = [field for field in POSE_FIELDS[:3] if field not in fields]
+    if missing:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Missing fields: {', '.join(missing)}.")
+    pose_id = Pose.create(fields['name'], fields['chakra'], fields['difficulty'], fields.get('hold_seconds'))
+    return HTTPStatus.CREATED, {'id': pose_id}
+
+
+@route('PATCH', r'/poses/(\d+)')
+def poses_update(params, query, body):
+    pose_id = int(params[0])
+    fields = pose_fields(body)
+    found(Pose.find_by_id(pose_id), "Pose", pose_id)
+    Pose.update(pose_id, **fields)
+    return HTTPStatus.OK, {'updated': pose_id}
+
+
+@route('DELETE', r'/poses/(\d+)')
+def poses_delete(params, query, body):
+    pose_id = int(params[0])
+    found(Pose.find_by_id(pose_id), "Pose", pose_id)
+    Pose.delete(pose_id)
+    return HTTPStatus.OK, {'deleted': pose_id}
+
+
+@route('GET', r'/profile')
+def profile(params, query, body):
+    # Profiler statistics (start the server with PY_FLOWS_PROFILE=1 to collect them)
+    return HTTPStatus.OK, profiler.summary()
+
+
+def match(method, path):
+    """Returns (handler, path parameters, cacheable), raises 404 or 405."""
+    allowed = []
+    for route_method, pattern, handler, cacheable in ROUTES:
+        found_route = pattern.match(path)
+        if found_route is None:
+            continue
+        if route_method == method:
+            return handler, found_route.groups(), cacheable
+        allowed.append(route_method)
+    if allowed:
+        raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, headers={'Allow': ", ".join(allowed)})
+    raise HTTPError(HTTPStatus.NOT_FOUND, f"No endpoint at {path}.")
+
+
+COUNTDOWN = re.compile(r'/flows/(\d+)/countdown$')
+
+
+# SERVER
+
+class Request:
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers  # Lower-case names
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+class FlowServer:
+    def __init__(self, workers=None, cache_size=None, keep_alive=None):
+        self.workers = workers or _config['workers'] or get_pool().size
+        self.keep_alive = keep_alive or _config['keep_alive']
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='py-flows')
+        self.cache = ResponseCache(cache_size or _config['cache_size'])
+        on_invalidate(self.tables_changed)
+        # Sessions are written from the thread pool by flush_history, never on the event loop
+        self.history = HistoryWriter(batch_size=math.inf, flush_seconds=math.inf)
+        self.requests = 0
+        self._server = None
+        self._flusher = None
+
+    def tables_changed(self, tables):
+        # No endpoint reads the history tables, so recording sessions leaves the cached responses alone
+        if not tables or not set(tables) <= set(HISTORY_TABLES):
+            self.cache.clear()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    async def start(self, host='127.0.0.1', port=8000):
+        self._server = await asyncio.start_server(self.handle_connection, host, port)
+        self._flusher = asyncio.get_running_loop().create_task(self.flush_history())
+        return self._server
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._flusher.cancel()
+        await self.run(self.history.flush)
+        self.executor.shutdown()
+        remove_listener(self.tables_changed)
+
+    async def flush_history(self):
+        while True:
+            await asyncio.sleep(FLUSH_SECONDS)
+            try:
+                await self.run(self.history.flush)
+            except Exception as error:
+                # The sessions stay pending and the next flush tries again
+                sys.stderr.write(f"Could not write session history: {error}\n")
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), self.keep_alive)
+                except HTTPError as error:
+                    await self.send_error(writer, error, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                self.requests += 1
+
+                countdown = COUNTDOWN.match(urlsplit(request.target).path)
+                if countdown and request.method == 'GET':
+                    # The stream has no length, so the connection ends with it
+                    await self.stream_countdown(request, writer, int(countdown.group(1)))
+                    break
+                await self.respond(request, writer)
+                if not request.keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass  # Idle for too long or closed by the client
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line.")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'transfer-encoding' in headers:
+            raise HTTPError(HTTPStatus.NOT_IMPLEMENTED, "Chunked request bodies are not supported.")
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length.")
+        if length > _config['max_body']:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b''
+        return Request(method, target, version, headers, body)
+
+    async def respond(self, request, writer):
+        try:
+            status, body, headers = await self.dispatch(request)
+        except Exception as error:
+            await self.send_error(writer, error_for(request, error), request.keep_alive)
+            return
+
+        etag = headers.get('ETag')
+        if etag and etag_matches(etag, request.headers.get('if-none-match')):
+            status, body = HTTPStatus.NOT_MODIFIED, b''
+        await self.send(writer, status, body, headers, request.keep_alive)
+
+    async def dispatch(self, request):
+        """Returns (status, encoded body, headers) for a request, using the response cache for GETs."""
+        url = urlsplit(request.target)
+        handler, params, cacheable = match(request.method, url.path)
+        query = parse_qs(url.query)
+        if callable(cacheable):
+            cacheable = cacheable(query)
+
+        if not cacheable:
+            status, payload = await self.run(handler, params, query, self.decode_body(request))
+            return status, json.dumps(payload).encode(), {}
+
+        # Equivalent queries share an entry whatever the order of their parameters
+        key = url.path + '?' + urlencode(sorted((name, value) for name, values in query.items() for value in values))
+        entry = self.cache.get(key)
+        if entry is None:
+            generation = self.cache.generation
+            status, payload = await self.run(handler, params, query, None)
+            body = json.dumps(payload).encode()
+            entry = (make_etag(body), body)
+            self.cache.set(key, entry, generation)
+        etag, body = entry
+        # no-cache: clients may store the response but revalidate it with If-None-Match every time
+        return HTTPStatus.OK, body, {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+    def decode_body(self, request):
+        if not request.body:
+            return None
+        try:
+            return json.loads(request.body)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "The body is not valid JSON.")
+
+    async def send(self, writer, status, body, headers=None, keep_alive=True):
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}", "Content-Type: application/json",
+                 f"Content-Length: {len(body)}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+
+    async def send_error(self, writer, error, keep_alive):
+        body = json.dumps({'error': str(error)}).encode()
+        await self.send(writer, error.status, body, error.headers, keep_alive)
+
+    async def stream_countdown(self, request, writer, flow_id):
+        """Play a plan as server-sent events: a plan event, then segment and tick events, then complete.
+        ?tick= sets the length of a countdown second and ?user= records the session in that user's history.
+        Closing the connection cancels the session."""
+        query = parse_qs(urlsplit(request.target).query)
+        try:
+            tick = countdown_tick(query)
+            plan = await self.run(build_plan, flow_id, query)
+        except Exception as error:
+            await self.send_error(writer, error_for(request, error), keep_alive=False)
+            return
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+        events = asyncio.Queue()
+        sink = HistorySink(self.history, lambda session, event: events.put_nowait(event),
+                           user_id=query_value(query, 'user'), flow_id=flow_id)
+        session = Session(plan, sink, tick)
+        session.task = asyncio.get_running_loop().create_task(session.run())
+        try:
+            writer.write(server_event('plan', plan_to_dict(plan)))
+            while True:
+                event = await events.get()
+                if event['type'] == 'segment':
+                    writer.write(server_event('segment', event['segment']._asdict()))
+                elif event['type'] == 'tick':
+                    writer.write(server_event('tick', {'remaining': event['remaining']}))
+                else:
+                    writer.write(server_event(event['type'], {}))
+                    break
+                await writer.drain()
+            await writer.drain()
+        finally:
+            # Ends the session (recorded as cancelled) if the client went away before it completed
+            session.cancel()
+
+
+def server_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+async def serve_forever(host, port, workers=None):
+    server = FlowServer(workers)
+    await server.start(host, port)
+    print(f"Serving Py Flows on http://{host}:{server.port} with {server.workers} worker(s)", flush=True)
+    stop = asyncio.Event()
+    try:
+        # Stop cleanly on SIGTERM too, so pending session history is written
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:
+        pass  # Windows
+    try:
+        await stop.wait()
+    finally:
+        await server.close()
+
+
+def serve(host='127.0.0.1', port=8000, workers=None):
+    try:
+        asyncio.run(serve_forever(host, port, workers))
+    except KeyboardInterrupt:
+        pass
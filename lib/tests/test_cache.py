@@ -0,0 +1,71 @@
+import unittest
+
+from db import cache
+from db.cache import QueryCache, cached
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class QueryCacheTest(unittest.TestCase):
+    def test_set_is_stored(self):
+        query_cache = QueryCache()
+        query_cache.set('key', frozenset({'poses'}), 'value', query_cache.generation)
+        self.assertEqual(query_cache.get('key'), (True, 'value'))
+
+    def test_set_after_invalidate_is_skipped(self):
+        # A result read before a write must not be stored once the write has invalidated the table
+        query_cache = QueryCache()
+        generation = query_cache.generation
+        query_cache.invalidate('poses')
+        query_cache.set('key', frozenset({'poses'}), 'stale', generation)
+        self.assertEqual(query_cache.get('key'), (False, None))
+
+    def test_invalidate_only_drops_tagged_entries(self):
+        query_cache = QueryCache()
+        query_cache.set('poses', frozenset({'poses'}), 1)
+        query_cache.set('flows', frozenset({'flows'}), 2)
+        query_cache.invalidate('poses')
+        self.assertEqual(query_cache.get('poses'), (False, None))
+        self.assertEqual(query_cache.get('flows'), (True, 2))
+
+    def test_entries_expire(self):
+        clock = FakeClock()
+        query_cache = QueryCache(ttl=10, clock=clock)
+        query_cache.set('key', frozenset({'poses'}), 'value')
+        clock.now = 11
+        self.assertEqual(query_cache.get('key'), (False, None))
+
+
+class CachedTest(unittest.TestCase):
+    def setUp(self):
+        cache.configure(enabled=True)
+
+    def tearDown(self):
+        cache.configure()
+
+    def test_write_during_query_is_not_cached(self):
+        calls = []
+
+        class Model:
+            @classmethod
+            @cached('poses')
+            def get_all(cls):
+                calls.append(1)
+                if len(calls) == 1:
+                    cache.invalidate('poses')  # Another thread writes while the query runs
+                return ['old' if len(calls) == 1 else 'new']
+
+        self.assertEqual(Model.get_all(), ['old'])
+        self.assertEqual(Model.get_all(), ['new'])
+        self.assertEqual(Model.get_all(), ['new'])
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
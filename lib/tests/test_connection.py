@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from db import connection
+from db.connection import transaction
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.db_file = connection.get_db_file()
+        self.directory = tempfile.mkdtemp()
+        connection.configure(db_file=os.path.join(self.directory, 'test.db'))
+        with connection.connection() as conn:
+            conn.execute("CREATE TABLE notes (text TEXT NOT NULL)")
+
+    def tearDown(self):
+        connection.configure(db_file=self.db_file)
+        shutil.rmtree(self.directory)
+
+    def notes(self):
+        with connection.connection() as conn:
+            return [row[0] for row in conn.execute("SELECT text FROM notes ORDER BY rowid")]
+
+    def test_nested_blocks_commit_once(self):
+        with transaction() as conn:
+            conn.execute("INSERT INTO notes (text) VALUES ('outer')")
+            with transaction() as inner:
+                self.assertIs(inner, conn)
+                inner.execute("INSERT INTO notes (text) VALUES ('inner')")
+            self.assertTrue(conn.in_transaction)
+        self.assertEqual(self.notes(), ['outer', 'inner'])
+
+    def test_error_in_nested_block_rolls_back_everything(self):
+        with self.assertRaises(RuntimeError):
+            with transaction() as conn:
+                conn.execute("INSERT INTO notes (text) VALUES ('outer')")
+                with transaction() as inner:
+                    inner.execute("INSERT INTO notes (text) VALUES ('inner')")
+                    raise RuntimeError("fail")
+        self.assertEqual(self.notes(), [])
+
+    def test_error_after_nested_block_rolls_it_back(self):
+        with self.assertRaises(RuntimeError):
+            with transaction() as conn:
+                with transaction() as inner:
+                    inner.execute("INSERT INTO notes (text) VALUES ('inner')")
+                raise RuntimeError("fail")
+        self.assertEqual(self.notes(), [])
+
+    def test_transaction_after_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with transaction():
+                with transaction():
+                    raise RuntimeError("fail")
+        with transaction() as conn:
+            conn.execute("INSERT INTO notes (text) VALUES ('after')")
+        self.assertEqual(self.notes(), ['after'])
+
+
+if __name__ == '__main__':
+    unittest.main()